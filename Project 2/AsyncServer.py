@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+
+from Broadcast import LiveChannels
+from FrameScheduler import FrameScheduler
+from Interleaved import INTERLEAVED_HEADER, INTERLEAVED_MAGIC
+from Profiler import spanTarget
+from RtcpSession import RtcpChannel
+from ServerWorker import ServerWorker
+from SessionRegistry import REAP_INTERVAL, SessionRegistry
+from UdpSender import BatchSender
+
+# Bytes queued on a transport beyond which RTP frames are skipped
+MAX_WRITE_BUFFER = 256 * 1024
+
+log = logging.getLogger(__name__)
+
+
+class LoopFrameScheduler(FrameScheduler):
+    """A FrameScheduler driven by event loop timers instead of a thread."""
+
+    def __init__(self, loop):
+        super().__init__(clock=loop.time)
+        self.loop = loop
+        self.timer = None
+
+    def wake(self, deadline):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_at(deadline, self.tick)
+
+    def tick(self):
+        # Sends run on the loop's thread, which `remove` must not wait on
+        self.thread = threading.current_thread()
+        self.timer = None
+        deadline = self.runDue()
+        if deadline is not None:
+            self.timer = self.loop.call_at(deadline, self.tick)
+
+
+class LoopRtcpChannel(RtcpChannel, asyncio.DatagramProtocol):
+    """An RtcpChannel on an event loop datagram endpoint."""
+
+    def __init__(self):
+        super().__init__()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.receive(data, addr)
+
+    def sendto(self, data, address):
+        self.transport.sendto(data, address)
+
+    def port(self):
+        return self.transport.get_extra_info("sockname")[1]
+
+
+class LoopRtpSender(asyncio.DatagramProtocol):
+    """Sends RTP from an event loop datagram endpoint without joining packets.
+
+    Transports only take whole datagrams, so packets go out through a
+    BatchSender on a duplicate of the transport's socket instead, straight
+    from their buffers. When the kernel has no room, the rest of the frame
+    is joined and queued on the transport, which sends it once the socket
+    is writable, and later frames queue behind it to keep their order.
+    Frames are skipped while more than MAX_WRITE_BUFFER bytes are queued.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.sender = None
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info("socket")
+        duplicate = socket.socket(sock.family, sock.type, fileno=os.dup(sock.fileno()))
+        self.sender = BatchSender(duplicate)
+
+    def connection_lost(self, exc):
+        self.sender.sock.close()
+
+    def send(self, packets, address):
+        queued = self.transport.get_write_buffer_size()
+        if queued > MAX_WRITE_BUFFER:
+            self.dropped += 1
+            return
+        if queued:
+            self.queue(packets, address)
+            return
+        try:
+            self.sender.send(packets, address)
+        except BlockingIOError:
+            self.queue(packets[self.sender.sentPackets :], address)
+
+    def queue(self, packets, address):
+        for packet in packets:
+            self.transport.sendto(b"".join(packet), address)
+
+    def port(self):
+        return self.transport.get_extra_info("sockname")[1]
+
+
+class AsyncServerWorker(ServerWorker):
+    """A ServerWorker driven by an asyncio event loop instead of threads.
+
+    RTSP requests arrive through `RtspProtocol` and go through the same
+    SETUP/PLAY/PAUSE/TEARDOWN state machine as the threaded worker. RTP is sent
+    from the server's shared datagram transport, or written interleaved on the
+    RTSP transport for RTP/AVP/TCP sessions, paced by the loop's frame
+    scheduler.
+    """
+
+    def __init__(
+        self, clientInfo, rtspTransport, rtpSender, scheduler, rtcpChannel, liveChannels=None
+    ):
+        super().__init__(clientInfo, scheduler, rtcpChannel, liveChannels)
+        self.rtspTransport = rtspTransport
+        self.rtpSender = rtpSender
+
+    def openRtp(self):
+        pass
+
+    def localRtpPort(self):
+        return self.rtpSender.port()
+
+    def closeRtp(self):
+        if "live" in self.clientInfo:
+            self.stopRtp()
+        if "pacing" in self.clientInfo:
+            self.scheduler.remove(self.clientInfo.pop("pacing"))
+        self.closeVideo()
+        self.closeRtcp()
+
+    def closeConnection(self, connSocket):
+        self.rtspTransport.close()
+
+    def sendPackets(self, packets):
+        if "interleaved" in self.clientInfo:
+            self.writeInterleaved(packets, self.clientInfo["interleaved"][0])
+            return
+
+        address = (self.clientInfo["rtspSocket"][1][0], int(self.clientInfo["rtpPort"]))
+        self.rtpSender.send(packets, address)
+
+    def writeInterleaved(self, packets, channel):
+        # Skip frames rather than queue them for a client that can't keep up
+        if self.rtspTransport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            return
+        buffers = []
+        for packet in packets:
+            length = sum(len(b) for b in packet)
+            buffers.append(INTERLEAVED_HEADER.pack(INTERLEAVED_MAGIC, channel, length))
+            buffers.extend(packet)
+        # Joined into bytes, as the transport may queue what it can't
+        # write now, and the headers are restamped for the next frame and
+        # for each subscriber of a broadcast before it goes out
+        self.rtspTransport.write(b"".join(buffers))
+
+    def sendRtsp(self, data):
+        self.rtspTransport.write(data)
+
+
+# Interleaved sends go through the RTSP transport rather than a BatchSender
+spanTarget(AsyncServerWorker, "writeInterleaved", "sendto")
+
+
+class RtspProtocol(asyncio.Protocol):
+    """RTSP control connection of one client."""
+
+    def __init__(self, rtpSender, scheduler, rtcpChannel, liveChannels=None):
+        self.rtpSender = rtpSender
+        self.scheduler = scheduler
+        self.rtcpChannel = rtcpChannel
+        self.liveChannels = liveChannels
+        self.worker = None
+
+    def connection_made(self, transport):
+        clientInfo = {
+            "rtspSocket": (
+                transport.get_extra_info("socket"),
+                transport.get_extra_info("peername"),
+            )
+        }
+        self.worker = AsyncServerWorker(
+            clientInfo,
+            transport,
+            self.rtpSender,
+            self.scheduler,
+            self.rtcpChannel,
+            self.liveChannels,
+        )
+
+    def data_received(self, data):
+        try:
+            self.worker.feedRtsp(data)
+        except Exception as e:
+            log.warning("failed to process RTSP request: %s", e)
+
+    def connection_lost(self, exc):
+        self.worker.disconnect(self.worker.clientInfo["rtspSocket"][0])
+
+
+class AsyncServer:
+    """Single event loop RTSP/RTP server for many concurrent sessions."""
+
+    def __init__(self, port, live=False):
+        self.port = port
+        self.live = live
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+
+        # All sessions share one UDP socket for RTP
+        _, rtpSender = await loop.create_datagram_endpoint(
+            LoopRtpSender, local_addr=("0.0.0.0", 0)
+        )
+
+        # and another for RTCP
+        _, rtcpChannel = await loop.create_datagram_endpoint(
+            LoopRtcpChannel, local_addr=("0.0.0.0", 0)
+        )
+
+        scheduler = LoopFrameScheduler(loop)
+        self.reapSessions(loop)
+        liveChannels = LiveChannels(scheduler) if self.live else None
+
+        server = await loop.create_server(
+            lambda: RtspProtocol(rtpSender, scheduler, rtcpChannel, liveChannels),
+            "",
+            self.port,
+            reuse_address=True,
+            backlog=1024,
+        )
+        async with server:
+            await server.serve_forever()
+
+    def reapSessions(self, loop):
+        """Time out idle sessions on the loop, every REAP_INTERVAL seconds."""
+        SessionRegistry.shared().reap()
+        loop.call_later(REAP_INTERVAL, self.reapSessions, loop)
+
+    def main(self):
+        asyncio.run(self.serve())
@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+from typing import Dict, Tuple
+
+import JpegPayload
+from FrameScheduler import FrameScheduler
+from RtpPacket import HEADER_SIZE, RTP_CLOCK_RATE, RtpEncoder
+from VideoStream import VideoStream
+
+log = logging.getLogger(__name__)
+
+
+class BroadcastChannel:
+    """One video played live to every session subscribed to it.
+
+    Each frame is read and packetized once per channel rather than once per
+    viewer. The packets are built complete in shared buffers, and each
+    subscriber's `sendShared` only rewrites the sequence number and SSRC in
+    place before sending them. The channel loops back to the start at the end
+    of the video, and keeps its timestamps counting up across the loop.
+    """
+
+    subscribers: Tuple[object, ...]
+
+    def __init__(self, filename):
+        self.stream = VideoStream(filename)
+        self.subscribers = ()
+        self.entry = None
+        self.frames = 0
+        # Sequence numbers and SSRC are stamped per subscriber
+        self.encoder = RtpEncoder(2, 0, 0, 0, 26, 0)
+
+    def add(self, session):
+        self.subscribers = self.subscribers + (session,)
+
+    def remove(self, session) -> int:
+        """Unsubscribe a session and return how many are left."""
+        self.subscribers = tuple(s for s in self.subscribers if s is not session)
+        return len(self.subscribers)
+
+    def sendFrame(self):
+        """Packetize the next frame and send it to every subscriber."""
+        data = self.stream.nextFrame()
+        if not data:
+            self.stream.seek(0)
+            data = self.stream.nextFrame()
+            if not data:
+                return False
+
+        self.frames += 1
+        timestamp = round(self.frames * RTP_CLOCK_RATE / self.stream.fps)
+        packets = self.packetize(data, timestamp)
+        octets = len(data) + len(packets) * JpegPayload.JPEG_HEADER_SIZE
+
+        # The tuple is replaced, never changed, as sessions come and go
+        for session in self.subscribers:
+            try:
+                session.sendShared(packets, timestamp, octets)
+            except Exception as e:
+                log.warning("broadcast send failed: %s", e)
+        return True
+
+    def packetize(self, data, timestamp):
+        """Build the frame's packets, each a one-buffer list ready to send."""
+        fragments = JpegPayload.fragment(data)
+        count = len(fragments)
+        packets = []
+        for i, (jpegHeader, chunk) in enumerate(fragments):
+            packet = bytearray(HEADER_SIZE + len(jpegHeader) + len(chunk))
+            self.encoder.packInto(packet, 0, i, i == count - 1, timestamp)
+            packet[HEADER_SIZE : HEADER_SIZE + len(jpegHeader)] = jpegHeader
+            packet[HEADER_SIZE + len(jpegHeader) :] = chunk
+            packets.append([packet])
+        return packets
+
+    def close(self):
+        self.stream.close()
+
+
+class LiveChannels:
+    """The broadcast channels of a server, one per video being watched live.
+
+    A channel starts on the scheduler when its first session subscribes and
+    is closed when the last one leaves, so a later viewer starts a fresh one.
+    """
+
+    channels: Dict[str, BroadcastChannel]
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, filename, session) -> BroadcastChannel:
+        """Add a session to the channel playing `filename`, starting it if needed."""
+        key = os.path.realpath(filename)
+        with self.lock:
+            if self.scheduler is None:
+                self.scheduler = FrameScheduler.shared()
+            channel = self.channels.get(key)
+            if channel is None:
+                channel = self.channels[key] = BroadcastChannel(filename)
+            channel.add(session)
+            if channel.entry is None:
+                channel.entry = self.scheduler.add(channel, 1 / channel.stream.fps)
+        return channel
+
+    def unsubscribe(self, channel, session):
+        """Remove a session, stopping its channel if nobody is left watching."""
+        key = os.path.realpath(channel.stream.filename)
+        with self.lock:
+            if channel.remove(session):
+                return
+            if self.channels.get(key) is channel:
+                del self.channels[key]
+
+        self.scheduler.remove(channel.entry)
+        channel.close()
@@ -1,46 +1,63 @@
 from tkinter import *
 from tkinter import messagebox
-from PIL import Image, ImageTk
-import threading, sys, traceback, os
-from socket import socket, INADDR_ANY, AF_INET, SOCK_DGRAM, SHUT_RDWR, SOCK_STREAM
-import os
-from RtspPacket import RtspMethod, RtspResponse, RtspRequest, RtspStatus
+from PIL import ImageTk
+import threading, sys, traceback, os, queue, logging
+from time import monotonic
 
-from RtpPacket import RtpPacket
+from RtspClient import RtspClient
+from JitterBuffer import JitterBuffer, DEFAULT_LATENCY
+from FrameDecoder import FrameDecoder, FrameRate, DISPLAY_SIZE
 
 # import sys
 # print(sys.executable)
 
-CACHE_FILE_NAME = "cache-"
-CACHE_FILE_EXT = ".jpg"
+# Decoded frames waiting for the GUI
+FRAME_QUEUE_SIZE = 2
 
+# Screen refreshes per second. The GUI shows at most one frame per refresh,
+# the newest, however fast they are decoded.
+REFRESH_RATE = 60
 
-class Client:
-    INIT = 0
-    READY = 1
-    PLAYING = 2
-    state = INIT
+# Seconds between updates of the stats overlay
+OVERLAY_INTERVAL = 0.5
 
-    SETUP = 0
-    PLAY = 1
-    PAUSE = 2
-    TEARDOWN = 3
+log = logging.getLogger(__name__)
 
+
+class Client(RtspClient):
     # Initiation..
-    def __init__(self, master, serveraddr, serverport, rtpport, filename):
+    def __init__(
+        self,
+        master,
+        serveraddr,
+        serverport,
+        rtpport,
+        filename,
+        latency=DEFAULT_LATENCY,
+        interleaved=False,
+        displaySize=DISPLAY_SIZE,
+        refreshRate=REFRESH_RATE,
+        overlay=False,
+    ):
         self.master = master
         self.master.protocol("WM_DELETE_WINDOW", self.handler)
         self.createWidgets()
-        self.serverAddr = serveraddr
-        self.serverPort = int(serverport)
-        self.rtpPort = int(rtpport)
-        self.fileName = filename
-        self.rtspSeq = 0
-        self.sessionId = 0
-        self.requestSent = -1
-        self.teardownAcked = 0
-        self.connectToServer()
         self.frameNbr = 0
+        self.playThread = None
+        self.jitterBuffer = JitterBuffer(latency)
+        # Decoded frames handed from the playout thread to the Tk main loop
+        self.frameQueue = queue.Queue(FRAME_QUEUE_SIZE)
+        self.staleFrames = 0
+        # Frames are decoded off the playout thread, straight to display size
+        self.decoder = FrameDecoder(self.queueFrame, displaySize)
+        # The Tk image frames are pasted into, made again only if their size changes
+        self.photo = None
+        self.renderRate = FrameRate()
+        self.refreshMs = max(1, round(1000 / refreshRate))
+        self.overlay = self.createOverlay() if overlay else None
+        self.overlayDue = 0.0
+        self.master.after(self.refreshMs, self.renderFrame)
+        super().__init__(serveraddr, serverport, rtpport, filename, interleaved)
 
     def createWidgets(self):
         """Build GUI."""
@@ -74,254 +91,111 @@ class Client:
             row=0, column=0, columnspan=4, sticky=W + E + N + S, padx=5, pady=5
         )
 
-    def setupMovie(self):
-        """Setup button handler."""
-        if self.state == self.INIT:
-            self.sendRtspRequest(self.SETUP)
+    def createOverlay(self):
+        """Build the stats overlay in the top left corner of the video."""
+        overlay = Label(self.master, font="TkFixedFont", fg="white", bg="black", justify=LEFT)
+        overlay.place(in_=self.label, x=4, y=4, anchor=NW)
+        return overlay
 
     def exitClient(self):
         """Teardown button handler."""
-        self.sendRtspRequest(self.TEARDOWN)
+        self.teardownMovie()
         self.master.destroy()  # Close the gui window
-        cache_file_path = CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT
-        if os.path.exists(cache_file_path):
-            os.remove(cache_file_path)  # Delete the cache image from video
-            print("Cache file deleted:", cache_file_path)
-        else:
-            print("Cache file does not exist:", cache_file_path)
-        # os.remove(CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT) # Delete the cache image from video
-
-    def pauseMovie(self):
-        """Pause button handler."""
-        if self.state == self.PLAYING:
-            self.sendRtspRequest(self.PAUSE)
+        self.decoder.close()
+        log.info("Playout stats: %s", self.jitterBuffer.stats)
+        log.info("Decode stats: %s", self.decoder.stats)
+        log.info("Stale frames skipped by the GUI: %d", self.staleFrames)
 
     def playMovie(self):
         """Play button handler."""
         if self.state == self.READY:
-            # Create a new thread to listen for RTP packets
-            threading.Thread(target=self.listenRtp).start()
-            self.playEvent = threading.Event()
-            self.playEvent.clear()
-            self.sendRtspRequest(self.PLAY)
-
-    def listenRtp(self):
-        """Listen for RTP packets."""
+            # Playout restarts on the new stream position. This also wakes the
+            # thread of the last PLAY, which must be gone before the next starts.
+            self.jitterBuffer.reset()
+            if self.playThread is not None:
+                self.playThread.join()
+            super().playMovie()
+            # Create a new thread to play frames out
+            self.playThread = threading.Thread(target=self.playRtp, args=(self.playEvent,))
+            self.playThread.start()
+
+    def onPacket(self, rtpPacket, size):
+        currFrameNbr = rtpPacket.seqNum()
+        log.debug("Current Seq Num: %d", currFrameNbr)
+        self.jitterBuffer.addPacket(currFrameNbr)
+
+    def onFrame(self, frame, timestamp):
+        # Leave the ordering and timing to the jitter buffer
+        self.jitterBuffer.push(timestamp, frame)
+
+    def playRtp(self, stopped):
+        """Hand frames from the jitter buffer to the decoder until `stopped` is set."""
+        while not stopped.is_set() and self.teardownAcked == 0:
+            frame = self.jitterBuffer.pop()
+            if frame:
+                self.frameNbr += 1
+                self.decoder.submit(self.frameNbr, frame)
+            else:
+                self.jitterBuffer.wait(0.5)
+
+    def queueFrame(self, image):
+        """Hand a decoded frame to the GUI, replacing one it hasn't shown yet."""
         while True:
             try:
-                data = self.rtpSocket.recv(20480)
-                if data:
-                    rtpPacket = RtpPacket()
-                    rtpPacket.decode(data)
-
-                    currFrameNbr = rtpPacket.seqNum()
-                    print("Current Seq Num: " + str(currFrameNbr))
-
-                    if currFrameNbr > self.frameNbr:  # Discard the late packet
-                        self.frameNbr = currFrameNbr
-                        self.updateMovie(self.writeFrame(rtpPacket.getPayload()))
-            except TimeoutError:
-                print("xy: Timeout occurred while waiting for data on RTP socket")
+                self.frameQueue.put_nowait(image)
+                return
+            except queue.Full:
+                try:
+                    self.frameQueue.get_nowait()
+                    self.staleFrames += 1
+                except queue.Empty:
+                    pass
+
+    def renderFrame(self):
+        """Show the newest decoded frame, once per screen refresh. Runs on the Tk main loop."""
+        image = None
+        while True:
+            try:
+                newer = self.frameQueue.get_nowait()
+            except queue.Empty:
                 break
-                # Handle the timeout error gracefully
-            except OSError as e:
-                if e.errno == 57:
-                    print("xy: Socket is not connected")
-                    break
-            except:
-                # Stop listening upon requesting PAUSE or TEARDOWN
-                if self.playEvent.isSet():
-                    break
-
-                # Upon receiving ACK for TEARDOWN request,
-                # close the RTP socket
-                if self.teardownAcked == 1:
-                    self.rtpSocket.shutdown(socket.SHUT_RDWR)
-                    self.rtpSocket.close()
-                    break
-
-    def writeFrame(self, data):
-        """Write the received frame to a temp image file. Return the image file."""
-        cachename = CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT
-        file = open(cachename, "wb")
-        file.write(data)
-        file.close()
-
-        return cachename
-
-    def updateMovie(self, imageFile):
-        """Update the image file as video frame in the GUI."""
-        photo = ImageTk.PhotoImage(Image.open(imageFile))
-        self.label.configure(image=photo, height=288)
-        self.label.image = photo
-
-    def connectToServer(self):
-        """Connect to the Server. Start a new RTSP/TCP session."""
-        self.rtspSocket = socket(AF_INET, SOCK_STREAM)
-        try:
-            self.rtspSocket.connect((self.serverAddr, self.serverPort))
-        except:
-            messagebox.showwarning(
-                "Connection Failed", "Connection to '%s' failed." % self.serverAddr
-            )
-
-    def sendRtspRequest(self, requestCode):
-        """Send RTSP request to the server."""
-
-        # Setup request
-        if requestCode == self.SETUP and self.state == self.INIT:
-            threading.Thread(target=self.recvRtspReply).start()
-            # Fill in Start
-            # Update RTSP sequence number.
-            self.rtspSeq += 1
-            # Write the RTSP request to be sent.
-
-            request = RtspRequest(method=RtspMethod.SETUP, filename=self.fileName)
-            request.set_header("CSeq", self.rtspSeq)
-            request.set_header("Transport", f"RTP/UDP; client_port= {self.rtpPort}")
-            # Keep track of the sent request.
-            self.requestSent = self.SETUP
-            # Fill in End
-
-        # Play request
-        elif requestCode == self.PLAY and self.state == self.READY:
-            # Fill in Start
-            # Update RTSP sequence number.
-            self.rtspSeq += 1
-            # Write the RTSP request to be sent.
-            request = RtspRequest(method=RtspMethod.PLAY, filename=self.fileName)
-            request.set_header("CSeq", self.rtspSeq)
-            request.set_header("Session", self.sessionId)
-            # Keep track of the sent request.
-            self.requestSent = self.PLAY
-            # Fill in End
-
-            # Pause request
-        elif requestCode == self.PAUSE and self.state == self.PLAYING:
-            # Fill in Start
-            # Update RTSP sequence number.
-            # self.rtspSeq ...
-            self.rtspSeq += 1
-            # Write the RTSP request to be sent.
-            request = RtspRequest(method=RtspMethod.PAUSE, filename=self.fileName)
-            request.set_header("CSeq", self.rtspSeq)
-            request.set_header("Session", self.sessionId)
-            # Keep track of the sent request.
-            self.requestSent = self.PAUSE
-            # Fill in End
-
-        # Teardown request
-        elif requestCode == self.TEARDOWN and not self.state == self.INIT:
-            # Fill in Start
-            # Update RTSP sequence number.
-            self.rtspSeq += 1
-            # Write the RTSP request to be sent.
-            request = RtspRequest(method=RtspMethod.TEARDOWN, filename=self.fileName)
-            request.set_header("CSeq", self.rtspSeq)
-            request.set_header("Session", self.sessionId)
-            # Keep track of the sent request.
-            self.requestSent = self.TEARDOWN
+            if image is not None:
+                self.staleFrames += 1
+            image = newer
+
+        if image is not None:
+            self.updateMovie(image)
+        if self.overlay is not None:
+            self.updateOverlay()
+        self.master.after(self.refreshMs, self.renderFrame)
+
+    def updateMovie(self, image):
+        """Update the image as video frame in the GUI."""
+        if self.photo is not None and (self.photo.width(), self.photo.height()) == image.size:
+            self.photo.paste(image)
         else:
+            self.photo = ImageTk.PhotoImage(image)
+            self.label.configure(image=self.photo, height=self.decoder.size[1])
+        self.renderRate.record()
+
+    def updateOverlay(self):
+        """Show rendered fps, dropped frames and jitter buffer depth."""
+        now = monotonic()
+        if now < self.overlayDue:
             return
+        self.overlayDue = now + OVERLAY_INTERVAL
 
-        # Send the RTSP request using rtspSocket.
-        # Fill in Start
-        # Fill in End
-        payload = request.encode()
-        
-        self.rtspSocket.send(payload.encode())
-
-        print("Data sent: ", payload)
-
-    def recvRtspReply(self):
-        """Receive RTSP reply from the server."""
-        while True:
-            reply = self.rtspSocket.recv(1024).decode()
-            print(reply)
-
-            response = RtspResponse.decode(reply)
-
-            # print("replycode is:", replycode)
-            if response.status() == RtspStatus.NOT_FOUND:
-                print("xy: the file does not exist on server\n")
-            elif response.status() == RtspStatus.CONNECTION_ERROR:
-                print("xy: there is a connection problem\n")
-            elif reply:
-                self.parseRtspReply(reply)
-
-            # Close the RTSP socket upon requesting Teardown
-            if self.requestSent == self.TEARDOWN:
-                try:
-                    if (
-                        self.rtspSocket.fileno() != -1
-                    ):  # Check if the socket is connected
-                        self.rtspSocket.shutdown(SHUT_RDWR)
-                        self.rtspSocket.close()
-                except OSError as e:
-                    print("Error:", e)
-                # self.rtspSocket.shutdown(socket.SHUT_RDWR)
-                # self.rtspSocket.close()
-                break
-
-    def parseRtspReply(self, data):
-        """Parse the RTSP reply from the server."""
-        reply = RtspResponse.decode(data)
-
-        seqNumStr = reply.get_header("CSeq")
-
-        if seqNumStr is None:
-            raise ValueError("CSeq header missing in RTSP response")
-
-        seqNum = int(seqNumStr)
-
-        sessionStr = reply.get_header("Session")
-
-        if sessionStr is None:
-            raise ValueError("Session header missing in RTSP response")
-
-        session = int(sessionStr )
-
-
-        # Process only if the server reply's sequence number is the same as the request's
-        if seqNum == self.rtspSeq:
-            # New RTSP session ID
-            if self.sessionId == 0:
-                self.sessionId = session
-
-            # Process only if the session ID is the same
-            if self.sessionId == session:
-                if reply.status() == RtspStatus.OK:
-                    if self.requestSent == self.SETUP:
-                        # Fill in Start
-                        # Update RTSP state.
-                        self.state = self.READY
-                        # Open RTP port.
-                        self.openRtpPort()
-                    elif self.requestSent == self.PLAY:
-                        self.state = self.PLAYING
-                    elif self.requestSent == self.PAUSE:
-                        self.state = self.READY
-                        # The play thread exits. A new thread is created on resume.
-                        self.playEvent.set()
-                    elif self.requestSent == self.TEARDOWN:
-                        self.state = self.TEARDOWN
-                        # Fill in End
-                        # Flag the teardownAcked to close the socket.
-                        self.teardownAcked = 1
+        stats = self.jitterBuffer.stats
+        dropped = stats.dropped + stats.late + self.staleFrames + self.decoder.stats.failed
+        text = (
+            f"{self.renderRate.fps():5.1f} fps  dropped {dropped}  "
+            f"buffer {self.jitterBuffer.depth()}"
+        )
+        if text != self.overlay["text"]:
+            self.overlay.configure(text=text)
 
-    def openRtpPort(self):
-        """Open RTP socket binded to a specified port."""
-        # Fill in Start
-        # Create a new datagram socket to receive RTP packets from the server
-        self.rtpSocket = socket(AF_INET, SOCK_DGRAM)
-        # Set the timeout value of the socket to 0.5sec
-        self.rtpSocket.settimeout(0.5)
-        try:
-            # Bind the socket to the address using the RTP port given by the client user
-            self.rtpSocket.bind(("0.0.0.0", self.rtpPort))
-        # Fill in End
-        except Exception as e:
-            messagebox.showwarning("Unable to Bind", f"Unable to bind PORT={self.rtpPort}\n" + str(e))
+    def showWarning(self, title, message):
+        messagebox.showwarning(title, message)
 
     def handler(self):
         """Handler on explicitly closing the GUI window."""
@@ -1,21 +1,33 @@
 import sys
 from tkinter import Tk
 from Client import Client
+from JitterBuffer import DEFAULT_LATENCY
 
 if __name__ == "__main__":
+    # Flags may come anywhere, so take them out before the positional arguments
+    flags = {arg for arg in sys.argv[1:] if arg.startswith("--")}
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
     try:
-        serverAddr = sys.argv[1]
-        serverPort = sys.argv[2]
-        rtpPort = sys.argv[3]
-        fileName = sys.argv[4]
-    except:
+        if flags - {"--tcp", "--stats"} or not 4 <= len(args) <= 5:
+            raise ValueError("Bad arguments")
+        serverAddr, serverPort, rtpPort, fileName = args[:4]
+        # Optional jitter buffer latency target in milliseconds
+        latency = int(args[4]) / 1000 if len(args) > 4 else DEFAULT_LATENCY
+        # RTP over the RTSP connection, for networks that block UDP
+        interleaved = "--tcp" in flags
+        # Overlay of rendered fps, dropped frames and jitter buffer depth
+        overlay = "--stats" in flags
+    except ValueError:
         print(
-            "[Usage: ClientLauncher.py Server_name Server_port RTP_port Video_file]\n"
+            "[Usage: ClientLauncher.py Server_name Server_port RTP_port Video_file [Latency_ms] [--tcp] [--stats]]\n"
         )
+        sys.exit(1)
 
     root = Tk()
 
     # Create a new client
-    app = Client(root, serverAddr, serverPort, rtpPort, fileName)
+    app = Client(
+        root, serverAddr, serverPort, rtpPort, fileName, latency, interleaved, overlay=overlay
+    )
     app.master.title("RTPClient")
     root.mainloop()
@@ -0,0 +1,157 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+from Metrics import Registry
+
+# Default memory budget of the shared cache
+DEFAULT_BUDGET = 64 * 1024 * 1024
+
+# Rough bookkeeping cost of each cached fragment beyond its bytes
+FRAGMENT_OVERHEAD = 96
+
+Fragments = List[Tuple[bytes, bytes]]
+
+
+class CacheStats:
+    """Counters kept by a FrameCache."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hitRate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        return (
+            f"hits={self.hits} misses={self.misses} evictions={self.evictions} "
+            f"hit rate={self.hitRate():.1%}"
+        )
+
+
+class FrameCache:
+    """Least recently used cache of packetized frames, shared by all sessions.
+
+    Entries are the (JPEG header, data) fragments of one frame, keyed by
+    (video, frame number, quality tier), so a session hitting the cache
+    skips both reading the frame and fragmenting it and only has to stamp
+    its own RTP headers. The fragments are copied out of the frame store, so
+    cached frames don't pin its memory map. The total size is kept under
+    `budget` bytes by evicting the least recently used frames; a budget of 0
+    turns caching off.
+
+    With `copy` off the fragments are kept as zero-copy views of the frame
+    store, so the cached frame data stays in the page cache shared by every
+    process mapping the video, and only the bookkeeping counts against the
+    budget.
+    """
+
+    _shared = None
+    _sharedLock = threading.Lock()
+
+    entries: "OrderedDict[Hashable, Tuple[Fragments, int]]"
+
+    def __init__(self, budget=DEFAULT_BUDGET, copy=True):
+        self.budget = budget
+        self.copy = copy
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+
+    @classmethod
+    def shared(cls) -> "FrameCache":
+        """Return the process-wide cache."""
+        with cls._sharedLock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def get(self, key) -> Optional[Fragments]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry[0]
+
+    def put(self, key, fragments) -> Fragments:
+        """Cache a frame's fragments. Return the cached copy, or the fragments
+        as given if they don't fit the budget."""
+        if self.copy:
+            size = sum(
+                len(header) + len(data) + FRAGMENT_OVERHEAD for header, data in fragments
+            )
+        else:
+            size = sum(len(header) + FRAGMENT_OVERHEAD for header, _ in fragments)
+        if size > self.budget:
+            return fragments
+
+        if self.copy:
+            fragments = [(bytes(header), bytes(data)) for header, data in fragments]
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (fragments, size)
+            self.size += size
+            self.evict(self.budget)
+        return fragments
+
+    def resize(self, budget):
+        """Change the memory budget, evicting frames to fit it."""
+        with self.lock:
+            self.budget = budget
+            self.evict(budget)
+
+    def evict(self, budget):
+        while self.size > budget and self.entries:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+            self.stats.evictions += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def sharedStat(read):
+    """Read a figure from the shared cache, if there is one yet."""
+    cache = FrameCache._shared
+    return read(cache) if cache is not None else None
+
+
+metrics = Registry.shared()
+metrics.gauge(
+    "frame_cache_hits_total",
+    "Frame cache hits",
+    lambda: sharedStat(lambda c: c.stats.hits),
+    kind="counter",
+)
+metrics.gauge(
+    "frame_cache_misses_total",
+    "Frame cache misses",
+    lambda: sharedStat(lambda c: c.stats.misses),
+    kind="counter",
+)
+metrics.gauge(
+    "frame_cache_evictions_total",
+    "Frames evicted from the cache",
+    lambda: sharedStat(lambda c: c.stats.evictions),
+    kind="counter",
+)
+metrics.gauge(
+    "frame_cache_hit_ratio",
+    "Fraction of frame lookups served from the cache",
+    lambda: sharedStat(lambda c: c.stats.hitRate()),
+)
+metrics.gauge(
+    "frame_cache_bytes",
+    "Bytes counted against the cache budget",
+    lambda: sharedStat(lambda c: c.size),
+)
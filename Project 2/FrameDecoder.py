@@ -0,0 +1,151 @@
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from io import BytesIO
+from time import monotonic, perf_counter
+
+from PIL import Image
+
+# Largest frame shown, in pixels; the video label was always 288 high
+DISPLAY_SIZE = (512, 288)
+
+# Frames being decoded at once. More keep the threads no busier, they only
+# add latency.
+DECODE_WINDOW = 3
+
+# Seconds of decoded frames the frame rate is measured over
+FPS_WINDOW = 2.0
+
+log = logging.getLogger(__name__)
+
+
+def decode(data, size=None):
+    """Decode a JPEG frame to fit within `size`, if given. Return the image.
+
+    libjpeg is asked to decode at the smallest of 1/2, 1/4 or 1/8 scale
+    still covering `size`, which skips most of the work for frames much
+    larger than the display, and whatever is left over is scaled down.
+    """
+    image = Image.open(BytesIO(data))
+    if size is not None:
+        image.draft(image.mode, size)
+    image.load()
+    if size is not None and (image.width > size[0] or image.height > size[1]):
+        image.thumbnail(size, Image.BILINEAR)
+    return image
+
+
+class FrameRate:
+    """Frames per second over the last `window` seconds."""
+
+    def __init__(self, window=FPS_WINDOW):
+        self.window = window
+        self.times = deque()
+        self.lock = threading.Lock()
+
+    def record(self):
+        now = monotonic()
+        with self.lock:
+            self.times.append(now)
+            while self.times[0] < now - self.window:
+                self.times.popleft()
+
+    def fps(self) -> float:
+        with self.lock:
+            if len(self.times) < 2:
+                return 0.0
+            return (len(self.times) - 1) / max(self.times[-1] - self.times[0], 1e-6)
+
+
+class DecodeStats:
+    """Frames decoded by a FrameDecoder and the time they took."""
+
+    def __init__(self):
+        self.frames = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.maxSeconds = 0.0
+        self.rate = FrameRate()
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.frames += 1
+            self.seconds += seconds
+            self.maxSeconds = max(self.maxSeconds, seconds)
+        self.rate.record()
+
+    def fps(self) -> float:
+        """Get the frames decoded per second over the last FPS_WINDOW seconds."""
+        return self.rate.fps()
+
+    def meanSeconds(self) -> float:
+        return self.seconds / self.frames if self.frames else 0.0
+
+    def __str__(self):
+        return (
+            f"frames decoded={self.frames} failed={self.failed} fps={self.fps():.1f} "
+            f"decode mean={self.meanSeconds() * 1000:.1f}ms max={self.maxSeconds * 1000:.1f}ms"
+        )
+
+
+class FrameDecoder:
+    """Decodes frames on a pool of threads and hands them on in order.
+
+    Pillow lets go of the GIL while libjpeg decodes, so the next frames
+    decode while the GUI shows the last one. At most `window` frames are in
+    flight; `submit` blocks until one of them is done beyond that.
+    """
+
+    def __init__(self, onImage, size=DISPLAY_SIZE, workers=None, window=DECODE_WINDOW):
+        self.onImage = onImage
+        self.size = size
+        self.executor = ThreadPoolExecutor(
+            workers or min(window, os.cpu_count() or 1), thread_name_prefix="decode"
+        )
+        self.pending = deque()
+        self.slots = threading.BoundedSemaphore(window)
+        self.lock = threading.Lock()
+        self.stats = DecodeStats()
+
+    def submit(self, frameNbr, data):
+        """Start decoding frame `frameNbr`."""
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.decode, data)
+        except RuntimeError:  # Closed
+            self.slots.release()
+            return
+        with self.lock:
+            self.pending.append((frameNbr, future))
+        future.add_done_callback(self.collect)
+
+    def decode(self, data):
+        start = perf_counter()
+        image = decode(data, self.size)
+        self.stats.record(perf_counter() - start)
+        return image
+
+    def collect(self, future=None):
+        """Hand on every decoded frame that no earlier frame is holding back."""
+        with self.lock:
+            while self.pending and self.pending[0][1].done():
+                frameNbr, future = self.pending.popleft()
+                self.slots.release()
+                try:
+                    image = future.result()
+                except CancelledError:
+                    continue
+                except Exception as e:
+                    # Not only OSError: a damaged frame can make Pillow
+                    # raise anything, and the frames after it must go on
+                    self.stats.failed += 1
+                    log.warning("could not decode frame %d: %s", frameNbr, e)
+                    continue
+                self.onImage(image)
+
+    def close(self):
+        """Drop the frames still waiting to be decoded."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,175 @@
+import mmap
+import os
+import struct
+import tempfile
+from typing import NamedTuple, Optional, Sequence
+
+INDEX_EXT = ".idx"
+INDEX_MAGIC = b"MJIX"
+INDEX_VERSION = 1
+
+# magic, version, source size, source mtime (ns), frame count
+INDEX_HEADER = struct.Struct("<4sHQQI")
+# offset of the frame data, frame length, frame number
+INDEX_ENTRY = struct.Struct("<QII")
+
+LENGTH_PREFIX_SIZE = 5
+
+
+class FrameEntry(NamedTuple):
+    offset: int
+    length: int
+    number: int
+
+
+class MappedEntries:
+    """Index entries read on demand from a memory map of a saved index.
+
+    Every process serving the video shares the pages of the map instead of
+    holding its own list of entries. The entries start at `start` in the map.
+    """
+
+    def __init__(self, map, count, start=INDEX_HEADER.size):
+        self.map = map
+        self.count = count
+        self.start = start
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> FrameEntry:
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("frame index out of range")
+        return FrameEntry(
+            *INDEX_ENTRY.unpack_from(self.map, self.start + i * INDEX_ENTRY.size)
+        )
+
+    def close(self):
+        """Unmap the entries, unless the map is a video whose frames are still in use."""
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+
+
+class FrameIndex:
+    """Offsets of every frame in a length-prefixed .Mjpeg file.
+
+    The index is built once by walking the 5-byte length prefixes and saved
+    next to the video as `<video>.idx`. It is rebuilt whenever the size or
+    modification time of the video no longer matches the saved copy. A saved
+    index is memory mapped rather than read in.
+    """
+
+    entries: Sequence[FrameEntry]
+
+    def __init__(self, entries: Sequence[FrameEntry]):
+        self.entries = entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getitem__(self, i: int) -> FrameEntry:
+        return self.entries[i]
+
+    def close(self):
+        """Release the memory map of a saved index."""
+        if isinstance(self.entries, MappedEntries):
+            self.entries.close()
+
+    @staticmethod
+    def index_path(filename: str) -> str:
+        return filename + INDEX_EXT
+
+    @staticmethod
+    def build(file) -> "FrameIndex":
+        """Scan an open .Mjpeg file and return its index."""
+        entries = []
+        size = os.fstat(file.fileno()).st_size
+        file.seek(0)
+
+        while True:
+            prefix = file.read(LENGTH_PREFIX_SIZE)
+            if len(prefix) < LENGTH_PREFIX_SIZE:
+                break
+
+            try:
+                length = int(prefix)
+            except ValueError:
+                break
+
+            offset = file.tell()
+            if file.seek(length, os.SEEK_CUR) > size:
+                break  # Truncated last frame
+
+            entries.append(FrameEntry(offset, length, len(entries) + 1))
+
+        file.seek(0)
+        return FrameIndex(entries)
+
+    @staticmethod
+    def load(filename: str) -> Optional["FrameIndex"]:
+        """Load the saved index for `filename`, or None if missing or stale."""
+        try:
+            st = os.stat(filename)
+            with open(FrameIndex.index_path(filename), "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # Missing or empty
+            return None
+
+        if len(data) < INDEX_HEADER.size:
+            return None
+
+        magic, version, size, mtime, count = INDEX_HEADER.unpack_from(data)
+        if (
+            magic != INDEX_MAGIC
+            or version != INDEX_VERSION
+            or size != st.st_size
+            or mtime != st.st_mtime_ns
+            or len(data) != INDEX_HEADER.size + count * INDEX_ENTRY.size
+        ):
+            data.close()
+            return None
+
+        return FrameIndex(MappedEntries(data, count))
+
+    def save(self, filename: str):
+        """Write the index next to `filename`."""
+        st = os.stat(filename)
+        data = bytearray(INDEX_HEADER.size + len(self.entries) * INDEX_ENTRY.size)
+        INDEX_HEADER.pack_into(
+            data, 0, INDEX_MAGIC, INDEX_VERSION, st.st_size, st.st_mtime_ns, len(self)
+        )
+        for i in range(len(self.entries)):
+            entry = self.entries[i]
+            INDEX_ENTRY.pack_into(data, INDEX_HEADER.size + i * INDEX_ENTRY.size, *entry)
+
+        # Write to a temp file of this writer's own first, so a concurrent
+        # reader never sees half an index and concurrent writers, such as
+        # prefork workers opening the video at once, don't clobber each other
+        path = FrameIndex.index_path(filename)
+        fd, tmp_path = tempfile.mkstemp(
+            suffix=".tmp", prefix=os.path.basename(path) + ".", dir=os.path.dirname(path) or "."
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def open(filename: str, file) -> "FrameIndex":
+        """Load the saved index, building and saving a new one if needed."""
+        index = FrameIndex.load(filename)
+        if index is None:
+            index = FrameIndex.build(file)
+            try:
+                index.save(filename)
+            except OSError:
+                pass  # Read-only media directory, keep the index in memory
+
+        return index
@@ -0,0 +1,177 @@
+import heapq
+import itertools
+import logging
+import threading
+from time import monotonic
+from typing import List, Optional, Tuple
+
+from Metrics import Registry
+
+# A session this many frame intervals behind restarts its clock instead of
+# bursting out every missed frame
+MAX_CATCHUP_FRAMES = 5
+
+# Lateness is within a frame interval unless the scheduler falls behind
+LATENESS_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 1.0)
+
+log = logging.getLogger(__name__)
+
+LATENESS = Registry.shared().histogram(
+    "frame_pacing_lateness_seconds",
+    "How late frames went out after their deadlines",
+    buckets=LATENESS_BUCKETS,
+)
+RESYNCS = Registry.shared().counter(
+    "frame_pacing_resyncs_total", "Times a session fell too far behind and restarted its clock"
+)
+
+
+class PacingStats:
+    """How late a session's frames went out relative to their deadlines."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.resyncs = 0
+
+    def record(self, lateness: float):
+        self.count += 1
+        self.total += lateness
+        self.last = lateness
+        if lateness > self.max:
+            self.max = lateness
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class ScheduleEntry:
+    """A playing session and its next frame deadline."""
+
+    __slots__ = ("session", "interval", "deadline", "stats", "active")
+
+    def __init__(self, session, interval: float, deadline: float):
+        self.session = session
+        self.interval = interval
+        self.deadline = deadline
+        self.stats = PacingStats()
+        self.active = True
+
+
+class FrameScheduler:
+    """Sends due frames for every playing session from one place.
+
+    Sessions are kept in a heap keyed on their next deadline on a monotonic
+    clock. Each deadline advances by exactly one frame interval from the last
+    deadline, not from when the send finished, so the time spent reading and
+    packetizing never accumulates into drift. Sessions only need a
+    `sendFrame()` method, returning False once there is nothing left to send,
+    which drops them from the schedule.
+
+    `run` drives the scheduler from a thread of its own; an event loop can
+    instead call `runDue` from a timer and override `wake`.
+    """
+
+    _shared = None
+    _sharedLock = threading.Lock()
+
+    heap: List[Tuple[float, int, ScheduleEntry]]
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.current = None
+        self.thread = None
+
+    @classmethod
+    def shared(cls) -> "FrameScheduler":
+        """Return the process-wide scheduler, starting its thread on first use."""
+        with cls._sharedLock:
+            if cls._shared is None:
+                cls._shared = cls()
+                cls._shared.start()
+            return cls._shared
+
+    def add(self, session, interval: float) -> ScheduleEntry:
+        """Start sending frames for `session`, the first one immediately."""
+        entry = ScheduleEntry(session, interval, self.clock())
+        with self.cond:
+            self._push(entry)
+            if self.heap[0][2] is entry:
+                self.wake(entry.deadline)
+        return entry
+
+    def remove(self, entry: ScheduleEntry):
+        """Stop sending frames for an entry, waiting out a send in progress."""
+        with self.cond:
+            entry.active = False
+            # Not from within the session's own send, which would wait for itself
+            while self.current is entry and threading.current_thread() is not self.thread:
+                self.cond.wait()
+
+    def wake(self, deadline: float):
+        """Called with the lock held when the earliest deadline moves earlier."""
+        self.cond.notify_all()
+
+    def runDue(self) -> Optional[float]:
+        """Send every frame that is due. Return the next deadline, if any."""
+        while True:
+            with self.cond:
+                if not self.heap:
+                    return None
+
+                deadline, _, entry = self.heap[0]
+                now = self.clock()
+                if deadline > now:
+                    return deadline
+
+                heapq.heappop(self.heap)
+                if not entry.active:
+                    continue
+                self.current = entry
+
+            entry.stats.record(now - deadline)
+            LATENESS.observe(now - deadline)
+            try:
+                more = entry.session.sendFrame()
+            except Exception as e:
+                log.warning("frame send failed: %s", e)
+                more = True
+
+            with self.cond:
+                self.current = None
+                self.cond.notify_all()
+                if not more:
+                    # At the end of its video, the session wakes no one
+                    entry.active = False
+                if entry.active:
+                    entry.deadline += entry.interval
+                    if now - entry.deadline > MAX_CATCHUP_FRAMES * entry.interval:
+                        entry.deadline = now + entry.interval
+                        entry.stats.resyncs += 1
+                        RESYNCS.inc()
+                    self._push(entry)
+
+    def run(self):
+        """Send frames forever from the calling thread."""
+        while True:
+            self.runDue()
+            with self.cond:
+                while True:
+                    timeout = None
+                    if self.heap:
+                        timeout = self.heap[0][0] - self.clock()
+                        if timeout <= 0:
+                            break
+                    self.cond.wait(timeout)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def _push(self, entry: ScheduleEntry):
+        heapq.heappush(self.heap, (entry.deadline, next(self.counter), entry))
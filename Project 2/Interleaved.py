@@ -0,0 +1,140 @@
+import os
+import select
+import socket
+import struct
+from time import monotonic
+from typing import NamedTuple
+
+# '$', channel, length of the packet that follows (RFC 2326 section 10.12)
+INTERLEAVED_HEADER = struct.Struct("!BBH")
+INTERLEAVED_MAGIC = 0x24
+
+# Default RTP and RTCP channels
+RTP_CHANNEL = 0
+RTCP_CHANNEL = 1
+
+# Buffers per sendmsg call
+try:
+    MAX_IOV = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    MAX_IOV = 1024
+
+# A frame that has started going out must finish within this many seconds
+SEND_TIMEOUT = 2.0
+
+
+class InterleavedFrame(NamedTuple):
+    """A packet received on an interleaved channel of the RTSP connection."""
+
+    channel: int
+    payload: bytes
+
+
+def parseChannels(transport):
+    """Return the (RTP, RTCP) channels of an interleaved Transport header, or None."""
+    for field in transport.split(";"):
+        key, _, value = field.strip().partition("=")
+        if key == "interleaved":
+            channels = value.split("-")
+            rtp = int(channels[0])
+            return rtp, int(channels[1]) if len(channels) > 1 else rtp + 1
+    return None
+
+
+def frame(channel, packet) -> bytes:
+    """Frame one packet for the RTSP connection."""
+    return INTERLEAVED_HEADER.pack(INTERLEAVED_MAGIC, channel, len(packet)) + packet
+
+
+def remaining(buffers, sent):
+    """Return what is left of `buffers` after the first `sent` bytes."""
+    for start, buffer in enumerate(buffers):
+        if sent < len(buffer):
+            return [memoryview(buffer)[sent:], *buffers[start + 1 :]]
+        sent -= len(buffer)
+    return []
+
+
+class InterleavedSender:
+    """Sends RTP packets `$`-framed over the RTSP connection.
+
+    Every packet of a frame goes out in one `sendmsg` call, each packet's
+    buffers preceded by its 4-byte frame header, so nothing is joined.
+    `send` runs on the frame scheduler thread and never waits: a frame is
+    skipped if the connection is busy or can't take any of it right away.
+    Once part of a frame is sent, the rest is kept for this session alone
+    and goes out ahead of anything else on the connection, so the framing
+    stays intact. RTSP replies and RTCP reports go through `sendMessage`,
+    which waits for the rest of the frame first. `lock` guards the
+    connection.
+    """
+
+    def __init__(self, sock, lock):
+        self.sock = sock
+        self.lock = lock
+        self.calls = 0
+        self.dropped = 0
+        # The unsent buffers of a frame partly sent, and when it started
+        self.pending = []
+        self.pendingSince = 0.0
+
+    def send(self, packets, channel=RTP_CHANNEL) -> bool:
+        """Send packets, each a list of buffers. Return False if the frame was skipped."""
+        buffers = []
+        for packet in packets:
+            length = sum(len(b) for b in packet)
+            buffers.append(INTERLEAVED_HEADER.pack(INTERLEAVED_MAGIC, channel, length))
+            buffers.extend(packet)
+
+        if not self.lock.acquire(blocking=False):
+            self.dropped += 1
+            return False
+        try:
+            # The last frame must be out before this one can start
+            if not self.flush():
+                self.dropped += 1
+                return False
+            sent = self.write(buffers)
+            if not sent:
+                self.dropped += 1
+                return False
+            # Copied, as the headers are restamped for the next frame, and
+            # for each subscriber of a broadcast, before the rest goes out
+            self.pending = [bytes(b) for b in remaining(buffers, sent)]
+            self.pendingSince = monotonic()
+            self.flush()
+        finally:
+            self.lock.release()
+        return True
+
+    def sendMessage(self, data):
+        """Send an RTSP message or a framed RTCP packet, after any partly sent frame."""
+        with self.lock:
+            while not self.flush():
+                _, writable, _ = select.select([], [self.sock], [], SEND_TIMEOUT)
+                if not writable:
+                    raise TimeoutError("Client stopped reading interleaved RTP")
+            self.sock.sendall(data)
+
+    def flush(self) -> bool:
+        """Send what the connection takes of a partly sent frame. Return True once it's all out.
+
+        The caller holds `lock`.
+        """
+        while self.pending:
+            sent = self.write(self.pending)
+            if not sent:
+                if monotonic() - self.pendingSince > SEND_TIMEOUT:
+                    raise TimeoutError("Client stopped reading interleaved RTP")
+                return False
+            self.pending = remaining(self.pending, sent)
+        return True
+
+    def write(self, buffers) -> int:
+        """Send as much of `buffers` as the connection takes now. Return how many bytes."""
+        try:
+            sent = self.sock.sendmsg(buffers[:MAX_IOV], [], socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return 0
+        self.calls += 1
+        return sent
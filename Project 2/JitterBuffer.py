@@ -0,0 +1,191 @@
+import heapq
+import threading
+from time import monotonic
+from typing import Dict, List, Optional
+
+from RtpPacket import RTP_CLOCK_RATE
+
+# Default and largest playout delay in seconds
+DEFAULT_LATENCY = 0.2
+MAX_LATENCY = 2.0
+
+# Frames held before the oldest is dropped
+MAX_FRAMES = 64
+
+# The playout delay follows this multiple of the measured jitter
+JITTER_MULTIPLIER = 3
+
+
+def extend(value, highest, bits):
+    """Unwrap a `bits`-wide counter to the extended value closest to `highest`."""
+    mask = (1 << bits) - 1
+    half = 1 << (bits - 1)
+    delta = (value - highest) & mask
+    if delta >= half:
+        delta -= 1 << bits
+    return highest + delta
+
+
+class JitterStats:
+    """Counters kept by a JitterBuffer."""
+
+    def __init__(self):
+        self.framesReceived = 0
+        self.framesPlayed = 0
+        self.late = 0
+        self.dropped = 0
+        self.duplicates = 0
+        self.packetsReceived = 0
+        self.firstSeq = None
+        self.highestSeq = None
+        self.jitter = 0.0
+
+    def packetsExpected(self) -> int:
+        if self.firstSeq is None:
+            return 0
+        return self.highestSeq - self.firstSeq + 1
+
+    def packetsLost(self) -> int:
+        return max(0, self.packetsExpected() - self.packetsReceived)
+
+    def __str__(self):
+        return (
+            f"frames received={self.framesReceived} played={self.framesPlayed} "
+            f"late={self.late} dropped={self.dropped} duplicates={self.duplicates} "
+            f"packets lost={self.packetsLost()}/{self.packetsExpected()} "
+            f"jitter={self.jitter * 1000:.1f}ms"
+        )
+
+
+class JitterBuffer:
+    """Reorder frames and release them on the sender's clock.
+
+    Frames are keyed on their RTP timestamp, extended past 32-bit wraparound,
+    and each is due at `first arrival + media time + delay`. The delay starts
+    at the latency target and grows with the interarrival jitter measured as
+    in RFC 3550, up to `maxLatency`. Frames arriving after a later frame was
+    already played count as late and are dropped. Packet sequence numbers are
+    extended past 16-bit wraparound to count losses.
+    """
+
+    frames: Dict[int, bytes]
+    heap: List[int]
+
+    def __init__(
+        self,
+        latency=DEFAULT_LATENCY,
+        maxLatency=MAX_LATENCY,
+        clockRate=RTP_CLOCK_RATE,
+        maxFrames=MAX_FRAMES,
+        clock=monotonic,
+    ):
+        self.latency = latency
+        self.maxLatency = max(latency, maxLatency)
+        self.clockRate = clockRate
+        self.maxFrames = maxFrames
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.stats = JitterStats()
+        self.reset()
+
+    def reset(self):
+        """Forget the playout clock, e.g. after a pause or seek."""
+        with self.cond:
+            self.frames = {}
+            self.heap = []
+            self.highestTs = None
+            self.lastPlayed = None
+            self.baseTs = None
+            self.baseTime = None
+            self.lastTransit = None
+            # Wake waiters, the frame they were waiting for is gone
+            self.cond.notify_all()
+
+    def delay(self) -> float:
+        """Current playout delay in seconds."""
+        return min(self.maxLatency, max(self.latency, JITTER_MULTIPLIER * self.stats.jitter))
+
+    def addPacket(self, seqNum):
+        """Count a received RTP packet for loss statistics."""
+        stats = self.stats
+        with self.cond:
+            stats.packetsReceived += 1
+            if stats.highestSeq is None:
+                stats.firstSeq = stats.highestSeq = seqNum
+                return
+            seq = extend(seqNum, stats.highestSeq, 16)
+            if seq > stats.highestSeq:
+                stats.highestSeq = seq
+
+    def push(self, timestamp, frame):
+        """Add a complete frame with its 32-bit RTP timestamp."""
+        now = self.clock()
+        stats = self.stats
+        with self.cond:
+            stats.framesReceived += 1
+            if self.highestTs is None:
+                ts = self.highestTs = self.baseTs = timestamp
+                self.baseTime = now
+            else:
+                ts = extend(timestamp, self.highestTs, 32)
+                self.highestTs = max(self.highestTs, ts)
+
+            # RFC 3550 interarrival jitter, in seconds
+            transit = now - ts / self.clockRate
+            if self.lastTransit is not None:
+                stats.jitter += (abs(transit - self.lastTransit) - stats.jitter) / 16
+            self.lastTransit = transit
+
+            if self.lastPlayed is not None and ts <= self.lastPlayed:
+                stats.late += 1
+                return
+            if ts in self.frames:
+                stats.duplicates += 1
+                return
+
+            self.frames[ts] = frame
+            heapq.heappush(self.heap, ts)
+            if len(self.heap) > self.maxFrames:
+                del self.frames[heapq.heappop(self.heap)]
+                stats.dropped += 1
+
+            self.cond.notify_all()
+
+    def depth(self) -> int:
+        """Number of frames waiting to be played."""
+        with self.cond:
+            return len(self.heap)
+
+    def playoutTime(self, ts) -> float:
+        return self.baseTime + (ts - self.baseTs) / self.clockRate + self.delay()
+
+    def nextDeadline(self) -> Optional[float]:
+        """When the next frame is due, or None if the buffer is empty."""
+        with self.cond:
+            return self.playoutTime(self.heap[0]) if self.heap else None
+
+    def pop(self) -> Optional[bytes]:
+        """Return the newest due frame, dropping any older due frames."""
+        now = self.clock()
+        with self.cond:
+            frame = None
+            while self.heap and self.playoutTime(self.heap[0]) <= now:
+                if frame is not None:
+                    self.stats.dropped += 1
+                ts = heapq.heappop(self.heap)
+                frame = self.frames.pop(ts)
+                self.lastPlayed = ts
+
+            if frame is not None:
+                self.stats.framesPlayed += 1
+            return frame
+
+    def wait(self, timeout=None):
+        """Block until the next frame is due, a frame arrives or `timeout` ends."""
+        with self.cond:
+            deadline = self.playoutTime(self.heap[0]) if self.heap else None
+            if deadline is not None:
+                wait = deadline - self.clock()
+                timeout = wait if timeout is None else min(timeout, wait)
+            if timeout is None or timeout > 0:
+                self.cond.wait(timeout)
@@ -0,0 +1,115 @@
+import struct
+from typing import Dict, List, Optional, Tuple
+
+from RtpPacket import HEADER_SIZE
+
+# Largest RTP packet we send, leaving room for IP/UDP headers in a 1500 byte MTU
+MAX_PACKET_SIZE = 1400
+
+# RFC 2435 main JPEG header: type-specific + 24-bit fragment offset, type, Q,
+# width / 8, height / 8
+JPEG_HEADER = struct.Struct("!IBBBB")
+JPEG_HEADER_SIZE = JPEG_HEADER.size
+
+# The payload carries the complete JFIF frame rather than the stripped scan
+# data, so the type is fixed and Q >= 128 marks the tables as in-band
+JPEG_TYPE = 1
+JPEG_Q = 255
+
+MAX_FRAGMENT_OFFSET = 0xFFFFFF
+
+# Number of incomplete frames kept before the oldest is given up on
+MAX_PENDING_FRAMES = 8
+
+
+def fragment(frame, max_packet_size=MAX_PACKET_SIZE) -> List[Tuple[bytes, memoryview]]:
+    """Split a JPEG frame into (JPEG header, data) fragments that fit one packet each."""
+    chunk_size = max_packet_size - HEADER_SIZE - JPEG_HEADER_SIZE
+    if chunk_size <= 0:
+        raise ValueError("Packet size too small for the RTP and JPEG headers.")
+
+    if len(frame) > MAX_FRAGMENT_OFFSET:
+        raise ValueError("Frame too large for a 24-bit fragment offset.")
+
+    view = memoryview(frame)
+    fragments = []
+    for offset in range(0, max(len(view), 1), chunk_size):
+        header = JPEG_HEADER.pack(offset, JPEG_TYPE, JPEG_Q, 0, 0)
+        fragments.append((header, view[offset : offset + chunk_size]))
+
+    return fragments
+
+
+def fragmentOffset(payload) -> int:
+    """Return the fragment offset of an RTP/JPEG payload."""
+    return JPEG_HEADER.unpack_from(payload)[0] & MAX_FRAGMENT_OFFSET
+
+
+class FrameReassembler:
+    """Rebuild JPEG frames from RTP/JPEG fragments, keyed by RTP timestamp.
+
+    Fragments may arrive in any order. A frame is complete once the fragment
+    carrying the marker bit has arrived and the fragments before it cover
+    every byte up to its end. Up to `max_pending` frames are reassembled at
+    once, so packets of neighbouring frames may interleave; beyond that the
+    oldest incomplete frame is dropped.
+    """
+
+    pending: Dict[int, Dict[int, bytes]]
+    ends: Dict[int, int]
+
+    def __init__(self, max_pending=MAX_PENDING_FRAMES):
+        self.max_pending = max_pending
+        self.pending = {}
+        self.ends = {}
+        self.dropped = 0
+
+    def add(self, packet) -> Optional[bytes]:
+        """Add an RTP packet, returning the frame it completes, if any."""
+        payload = packet.getPayload()
+        if len(payload) < JPEG_HEADER_SIZE:
+            return None
+
+        timestamp = packet.timestamp()
+        offset = fragmentOffset(payload)
+        data = payload[JPEG_HEADER_SIZE:]
+
+        fragments = self.pending.get(timestamp)
+        if fragments is None:
+            if len(self.pending) >= self.max_pending:
+                self._drop(next(iter(self.pending)))
+            fragments = self.pending[timestamp] = {}
+
+        fragments[offset] = data
+        if packet.marker():
+            self.ends[timestamp] = offset + len(data)
+
+        frame = self._complete(timestamp)
+        if frame is not None:
+            self.pending.pop(timestamp)
+            self.ends.pop(timestamp)
+
+        return frame
+
+    def _complete(self, timestamp) -> Optional[bytes]:
+        end = self.ends.get(timestamp)
+        if end is None:
+            return None
+
+        fragments = self.pending[timestamp]
+        if sum(len(data) for data in fragments.values()) != end:
+            return None
+
+        offsets = sorted(fragments)
+        pos = 0
+        for offset in offsets:
+            if offset != pos:
+                return None
+            pos += len(fragments[offset])
+
+        return b"".join(fragments[offset] for offset in offsets)
+
+    def _drop(self, timestamp):
+        self.pending.pop(timestamp, None)
+        self.ends.pop(timestamp, None)
+        self.dropped += 1
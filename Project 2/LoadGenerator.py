@@ -0,0 +1,186 @@
+import argparse
+import threading
+import time
+from time import monotonic
+
+from RtspClient import RtspClient
+
+# How long a viewer waits for each RTSP reply
+REPLY_TIMEOUT = 5.0
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of `values`, or 0 when empty."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[rank]
+
+
+class HeadlessClient(RtspClient):
+    """A simulated viewer that records delivery statistics instead of drawing.
+
+    Loss and jitter come from the `reception` statistics every client keeps
+    for its receiver reports.
+    """
+
+    def __init__(self, serveraddr, serverport, rtpport, filename, interleaved=False):
+        self.packets = 0
+        self.bytes = 0
+        self.frames = 0
+        self.replyLatencies = []
+        self.replied = threading.Event()
+        super().__init__(serveraddr, serverport, rtpport, filename, interleaved)
+
+    def onPacket(self, rtpPacket, size):
+        self.packets += 1
+        self.bytes += size
+
+    def onFrame(self, frame, timestamp):
+        self.frames += 1
+
+    def onReply(self, reply, latency):
+        self.replyLatencies.append(latency)
+        self.replied.set()
+
+    def request(self, action, state):
+        """Send a request with `action` and wait for the client to reach `state`."""
+        self.replied.clear()
+        action()
+        deadline = monotonic() + REPLY_TIMEOUT
+        while self.state != state and monotonic() < deadline:
+            self.replied.wait(0.05)
+        return self.state == state
+
+    def packetsLost(self):
+        return max(0, self.reception.packetsExpected() - self.reception.received)
+
+    def jitter(self):
+        """Get the RFC 3550 interarrival jitter in seconds."""
+        return self.reception.jitter / self.reception.clockRate
+
+
+class LoadGenerator:
+    """Run many headless viewers against one server and report on them.
+
+    Viewers are started at `rampRate` sessions per second, each on its own
+    RTP/RTCP port pair counting up from `basePort`. Once all have started, the run lasts
+    another `duration` seconds and then every session is torn down. With
+    `interleaved` set the viewers take RTP over their RTSP connections.
+    """
+
+    def __init__(
+        self,
+        serverAddr,
+        serverPort,
+        fileName,
+        sessions,
+        rampRate,
+        duration,
+        basePort,
+        interleaved=False,
+    ):
+        self.serverAddr = serverAddr
+        self.serverPort = serverPort
+        self.fileName = fileName
+        self.sessions = sessions
+        self.rampRate = rampRate
+        self.duration = duration
+        self.basePort = basePort
+        self.interleaved = interleaved
+        self.clients = []
+        self.failed = 0
+
+    def startClient(self, i):
+        client = HeadlessClient(
+            self.serverAddr,
+            self.serverPort,
+            self.basePort + 2 * i,
+            self.fileName,
+            self.interleaved,
+        )
+        if client.request(client.setupMovie, client.READY) and client.request(
+            client.playMovie, client.PLAYING
+        ):
+            self.clients.append(client)
+        else:
+            self.failed += 1
+
+    def run(self):
+        start = monotonic()
+        threads = []
+        for i in range(self.sessions):
+            # Ramp sessions up on schedule, whatever the setup time of each
+            delay = start + i / self.rampRate - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            thread = threading.Thread(target=self.startClient, args=(i,))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        measureStart = monotonic()
+        before = sum(c.bytes for c in self.clients), sum(c.frames for c in self.clients)
+        time.sleep(self.duration)
+        elapsed = monotonic() - measureStart
+        after = sum(c.bytes for c in self.clients), sum(c.frames for c in self.clients)
+
+        for client in self.clients:
+            client.teardownMovie()
+
+        return self.report((after[0] - before[0]) / elapsed, (after[1] - before[1]) / elapsed)
+
+    def report(self, bytesPerSec, framesPerSec):
+        packets = sum(c.packets for c in self.clients)
+        lost = sum(c.packetsLost() for c in self.clients)
+        jitters = [c.jitter() * 1000 for c in self.clients]
+        latencies = [l * 1000 for c in self.clients for l in c.replyLatencies]
+
+        return {
+            "sessions": len(self.clients),
+            "failed_sessions": self.failed,
+            "throughput_mbps": bytesPerSec * 8 / 1e6,
+            "frames_per_sec": framesPerSec,
+            "packet_loss_pct": 100 * lost / (packets + lost) if packets + lost else 0.0,
+            "jitter_ms_p50": percentile(jitters, 50),
+            "jitter_ms_p99": percentile(jitters, 99),
+            "rtsp_latency_ms_p50": percentile(latencies, 50),
+            "rtsp_latency_ms_p90": percentile(latencies, 90),
+            "rtsp_latency_ms_p99": percentile(latencies, 99),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless RTSP/RTP load generator")
+    parser.add_argument("server")
+    parser.add_argument("port", type=int)
+    parser.add_argument("video")
+    parser.add_argument("-n", "--sessions", type=int, default=10)
+    parser.add_argument("-r", "--ramp", type=float, default=5.0, help="sessions per second")
+    parser.add_argument("-d", "--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("-p", "--base-port", type=int, default=30000)
+    parser.add_argument(
+        "--tcp", action="store_true", help="interleave RTP on the RTSP connection"
+    )
+    args = parser.parse_args()
+
+    results = LoadGenerator(
+        args.server,
+        args.port,
+        args.video,
+        args.sessions,
+        args.ramp,
+        args.duration,
+        args.base_port,
+        args.tcp,
+    ).run()
+
+    for name, value in results.items():
+        print(f"{name}: {value:,.2f}")
+
+
+if __name__ == "__main__":
+    main()
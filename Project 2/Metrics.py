@@ -0,0 +1,239 @@
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+log = logging.getLogger(__name__)
+
+# Histogram bucket bounds for latencies, in seconds
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = Tuple[str, ...]
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def formatLabels(names, values, extra="") -> str:
+    """Render a label set as {name="value",...}, or "" when there are none."""
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def formatValue(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A count that only goes up, per label set."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, labels: Labels = ()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, labels: Labels = ()):
+        return self.values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [
+            f"{self.name}{formatLabels(self.labelNames, labels)} {formatValue(value)}"
+            for labels, value in values
+        ]
+
+
+class Histogram:
+    """Observations counted into fixed buckets, per label set.
+
+    Each observation is one bisect and two additions; the cumulative bucket
+    counts Prometheus expects are only summed up when scraped.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelNames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = tuple(buckets)
+        # Per label set: count in each bucket, the last one past the top
+        # bound, and the sum of everything observed
+        self.values: Dict[Labels, list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels: Labels = ()):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def count(self, labels: Labels = ()) -> int:
+        entry = self.values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = [
+                (labels, list(counts), total) for labels, (counts, total) in self.values.items()
+            ]
+
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = formatLabels(self.labelNames, labels, f'le="{formatValue(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            names = formatLabels(self.labelNames, labels)
+            lines.append(f"{self.name}_sum{names} {formatValue(total)}")
+            lines.append(f"{self.name}_count{names} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """A value read when scraped, from a function of no arguments.
+
+    The function returns a number, or a dict of numbers keyed by label values
+    for a gauge with labels. State the server already keeps, like sessions
+    and cache statistics, is exported this way at no cost to the hot path.
+    """
+
+    def __init__(self, name, help, labelNames=(), function: Callable = None, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.function = function
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        values = self.function()
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            f"{self.name}{formatLabels(self.labelNames, labels)} {formatValue(value)}"
+            for labels, value in values.items()
+        ]
+
+
+class Registry:
+    """The metrics of a server process, rendered in Prometheus text format."""
+
+    _shared = None
+    _sharedLock = threading.Lock()
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls) -> "Registry":
+        """Return the process-wide registry."""
+        with cls._sharedLock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def add(self, metric):
+        """Register a metric, or return the one already registered under its name."""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelNames=()) -> Counter:
+        return self.add(Counter(name, help, labelNames))
+
+    def histogram(self, name, help, labelNames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labelNames, buckets))
+
+    def gauge(self, name, help, function, labelNames=(), kind="gauge") -> Gauge:
+        return self.add(Gauge(name, help, labelNames, function, kind))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.render()
+            except Exception as e:
+                log.warning("failed to collect %s: %s", metric.name, e)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("%s " + format, self.address_string(), *args)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serves a registry at /metrics for Prometheus to scrape.
+
+    It listens on localhost only by default; put a proxy in front of it to
+    scrape from elsewhere.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port, registry=None, host="127.0.0.1"):
+        super().__init__((host, port), MetricsHandler)
+        self.registry = registry if registry is not None else Registry.shared()
+
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        log.info("metrics on http://%s:%d/metrics", self.server_address[0], self.port())
+        return self
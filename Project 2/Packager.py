@@ -0,0 +1,176 @@
+import argparse
+import glob
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+
+from PIL import Image
+
+from FrameIndex import FrameIndex
+from VideoContainer import ContainerWriter
+from VideoStream import VideoStream
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff", ".webp")
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+# JPEG quality of images that have to be encoded and no quality was asked for
+DEFAULT_QUALITY = 85
+
+# Frames queued per worker process, enough to keep them busy without
+# holding a long video in memory
+PENDING_PER_WORKER = 4
+
+
+def encodeFrame(data, scale, quality) -> bytes:
+    """Re-encode one image as a JPEG at `scale` times its size and the given quality."""
+    image = Image.open(io.BytesIO(data))
+    if scale != 1.0:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+
+    out = io.BytesIO()
+    image.convert("RGB").save(out, "JPEG", quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def imageSize(data):
+    """Return the (width, height) of an encoded image, reading only its header."""
+    try:
+        return Image.open(io.BytesIO(data)).size
+    except OSError:
+        return 0, 0  # Not an image PIL knows, keep the size unset
+
+
+def encodeTask(task):
+    """Produce one frame in a worker process. Return (JPEG, width, height).
+
+    The source is an image file or frame bytes. It is only encoded if asked
+    to be, or if it isn't a JPEG already.
+    """
+    source, scale, quality = task
+    isJpeg = True
+    if isinstance(source, str):
+        isJpeg = source.lower().endswith(JPEG_EXTENSIONS)
+        with open(source, "rb") as f:
+            source = f.read()
+
+    if quality is not None or scale != 1.0 or not isJpeg:
+        source = encodeFrame(source, scale, DEFAULT_QUALITY if quality is None else quality)
+    return (source, *imageSize(source))
+
+
+def orderedMap(executor, fn, items, window):
+    """Like `executor.map`, but with at most `window` items submitted at once."""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def imageFiles(source):
+    """Return the image files of a directory or glob pattern, in name order."""
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    else:
+        paths = glob.glob(source)
+    return sorted(path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def videoFrames(stream):
+    try:
+        while True:
+            data = stream.nextFrame()
+            if not data:
+                break
+            yield bytes(data)
+    finally:
+        stream.close()
+
+
+def package(source, dest, fps=None, quality=None, scale=1.0, executor=None):
+    """Write `source` to `dest` as a binary container. Return the frame count.
+
+    `source` is a video in either format, a directory of images or a glob
+    pattern matching them. Video frames are copied as they are unless a
+    quality or scale is given; images that need encoding are encoded across
+    `executor`'s processes, in order.
+    """
+    if os.path.isfile(source) and not source.lower().endswith(IMAGE_EXTENSIONS):
+        stream = VideoStream(source)
+        fps = fps or stream.fps
+        items = videoFrames(stream)
+        copy = quality is None and scale == 1.0
+    else:
+        items = imageFiles(source)
+        if not items:
+            raise ValueError(f"No images in {source}")
+        fps = fps or VideoStream.FPS
+        copy = False
+
+    with ContainerWriter(dest, fps) as writer:
+        if copy:
+            for frame in items:
+                if not writer.entries:
+                    writer.width, writer.height = imageSize(frame)
+                writer.write(frame)
+        else:
+            pool = executor or ProcessPoolExecutor()
+            window = PENDING_PER_WORKER * (os.cpu_count() or 1)
+            tasks = ((item, scale, quality) for item in items)
+            try:
+                for frame, width, height in orderedMap(pool, encodeTask, tasks, window):
+                    if not writer.entries:
+                        writer.width, writer.height = width, height
+                    writer.write(frame)
+            finally:
+                if executor is None:
+                    pool.shutdown()
+        count = len(writer.entries)
+
+    # A container needs no separate index, and one left from the old file is stale
+    if os.path.exists(FrameIndex.index_path(dest)):
+        os.remove(FrameIndex.index_path(dest))
+    return count
+
+
+def destination(source, output, many):
+    if not many:
+        return output
+    stem = os.path.splitext(os.path.basename(os.path.normpath(source)))[0]
+    return os.path.join(output, stem + ".Mjpeg")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Package image sequences or .Mjpeg videos into the binary container"
+    )
+    parser.add_argument("sources", nargs="+", help="videos, image directories or globs")
+    parser.add_argument(
+        "-o", "--output", required=True, help="output file, or directory for several sources"
+    )
+    parser.add_argument("--fps", type=Fraction, help="frame rate, such as 25 or 30000/1001")
+    parser.add_argument("-q", "--quality", type=int, help="re-encode at this JPEG quality")
+    parser.add_argument("-s", "--scale", type=float, default=1.0, help="re-encode at this scale")
+    parser.add_argument(
+        "-j", "--workers", type=int, default=os.cpu_count(), help="encoding processes"
+    )
+    args = parser.parse_args()
+
+    many = len(args.sources) > 1 or os.path.isdir(args.output)
+    if many:
+        os.makedirs(args.output, exist_ok=True)
+
+    with ProcessPoolExecutor(args.workers) as executor:
+        for source in args.sources:
+            dest = destination(source, args.output, many)
+            count = package(source, dest, args.fps, args.quality, args.scale, executor)
+            print(f"{dest}: {count} frames, {os.path.getsize(dest):,} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+import logging
+import os
+import signal
+import socket
+import threading
+from random import randint
+
+from Broadcast import LiveChannels
+from FrameCache import FrameCache
+from Interleaved import InterleavedFrame
+from Metrics import MetricsServer
+from Profiler import PROFILE_SIGNAL, Profiler
+from RtspPacket import RtspMethod, RtspRequest, parseSession
+from RtspParser import RtspParser
+from ServerWorker import ServerWorker, RTSP_RECV_SIZE
+from SessionRegistry import SessionRegistry
+
+# Largest hand-off message: what was read of a connection before its first
+# request was complete
+MAX_HANDOFF_SIZE = 2 * 65536
+
+# Pending connections per worker's listening socket
+LISTEN_BACKLOG = 128
+
+log = logging.getLogger(__name__)
+
+
+class SessionRouter:
+    """Routes RTSP connections to the worker process owning their session.
+
+    Session IDs are chosen so that `id % workers` is the index of the process
+    that created them. A connection opened for an existing session, say after
+    the client reconnected and the kernel balanced it onto another process,
+    is passed with what was already read from it to the owner over a Unix
+    datagram socket with `socket.send_fds`. The owner attaches it to the
+    session's worker.
+    """
+
+    def __init__(self, index, channels, workerFactory):
+        self.index = index
+        self.workers = len(channels)
+        self.inbox = channels[index][0]
+        self.outboxes = [channel[1] for channel in channels]
+        self.workerFactory = workerFactory
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def newSessionId(self):
+        """Return a random session ID owned by this process."""
+        low = 100000 // self.workers + 1
+        high = 999999 // self.workers
+        return randint(low, high) * self.workers + self.index
+
+    def owner(self, sessionId):
+        return sessionId % self.workers
+
+    def register(self, sessionId, worker):
+        with self.lock:
+            self.sessions[sessionId] = worker
+
+    def unregister(self, sessionId):
+        with self.lock:
+            self.sessions.pop(sessionId, None)
+
+    def route(self, sessionId, rtspSocket, data):
+        """Give a connection and the bytes read from it to the session's owner."""
+        owner = self.owner(sessionId)
+        if owner == self.index:
+            self.adopt(rtspSocket, sessionId, data)
+            return
+
+        connSocket = rtspSocket[0]
+        try:
+            socket.send_fds(self.outboxes[owner], [data], [connSocket.fileno()])
+        finally:
+            # The owner has its own copy of the descriptor now, or the
+            # hand-off failed and the client has to connect again
+            connSocket.close()
+
+    def adopt(self, rtspSocket, sessionId, data):
+        """Attach a connection to the local worker of its session."""
+        with self.lock:
+            worker = self.sessions.get(sessionId)
+        if worker is None:
+            # Gone or never existed: a new worker answers it like any other
+            worker = self.workerFactory({"rtspSocket": rtspSocket})
+            worker.routed = True
+            worker.run()
+            worker.feedRtsp(data)
+        else:
+            worker.attach(rtspSocket, data)
+
+    def receive(self):
+        """Adopt one connection handed over by another process."""
+        data, fds, _, _ = socket.recv_fds(self.inbox, MAX_HANDOFF_SIZE, 1)
+        if not fds:
+            return
+        connSocket = socket.socket(fileno=fds[0])
+        try:
+            peer = connSocket.getpeername()
+        except OSError:
+            connSocket.close()
+            return
+
+        request = RtspParser(RtspRequest).feed(data)[0]
+        sessionId = parseSession(request.get_header("Session"))[0]
+        self.adopt((connSocket, peer), int(sessionId), data)
+
+    def run(self):
+        while True:
+            try:
+                self.receive()
+            except (OSError, ValueError, IndexError) as e:
+                log.warning("failed to adopt connection: %s", e)
+
+
+class PreforkWorker(ServerWorker):
+    """A ServerWorker in one process of a PreforkServer.
+
+    The first request on a connection decides where it goes: anything but
+    SETUP naming a session is routed to the worker that owns that session,
+    which may live in another process.
+    """
+
+    # The router hands a reconnecting client's connection to its session
+    REATTACHABLE = True
+
+    def __init__(self, clientInfo, router, **kwargs):
+        super().__init__(clientInfo, **kwargs)
+        self.router = router
+        self.received = bytearray()
+        self.routed = False
+        self.handedOff = False
+
+    def recvRtspRequest(self):
+        connSocket = self.clientInfo["rtspSocket"][0]
+        while not self.handedOff:
+            try:
+                data = connSocket.recv(RTSP_RECV_SIZE)
+            except OSError:
+                break
+            if not data:
+                break
+            try:
+                self.feedRtsp(data)
+            except Exception as e:
+                log.warning("failed to process RTSP request: %s", e)
+
+        if self.handedOff:
+            # The connection belongs to the session's worker now
+            self.registry.discard(self)
+        else:
+            self.disconnect(connSocket)
+
+    def feedRtsp(self, data):
+        if self.routed:
+            super().feedRtsp(data)
+            return
+
+        self.received += data
+        requests = self.parser.feed(data)
+        if not requests:
+            return
+        self.routed = True
+
+        first = requests[0]
+        session = None if isinstance(first, InterleavedFrame) else first.get_header("Session")
+        if session is not None:
+            session = parseSession(session)[0]
+        if (
+            session is not None
+            and first.method() != RtspMethod.SETUP
+            and session.isdigit()
+            and len(self.received) <= MAX_HANDOFF_SIZE
+        ):
+            self.handedOff = True
+            self.router.route(int(session), self.clientInfo["rtspSocket"], bytes(self.received))
+            return
+
+        self.received = None
+        for message in requests:
+            self.processMessage(message)
+
+    def attach(self, rtspSocket, data):
+        """Carry on the session over a new RTSP connection."""
+        self.clientInfo["rtspSocket"] = rtspSocket
+        if "interleaved" in self.clientInfo:
+            # Interleaved RTP moves to the new connection too
+            self.clientInfo.pop("rtpSender", None)
+            self.openRtp()
+        self.parser = RtspParser(RtspRequest)
+        self.run()
+        super().feedRtsp(data)
+
+    def processRtspRequest(self, request):
+        super().processRtspRequest(request)
+        if request.method() == RtspMethod.SETUP and "session" in self.clientInfo:
+            self.router.register(self.clientInfo["session"], self)
+
+    def newSessionId(self):
+        return self.router.newSessionId()
+
+    def closeRtp(self):
+        super().closeRtp()
+        if "session" in self.clientInfo:
+            self.router.unregister(self.clientInfo["session"])
+
+
+class PreforkServer:
+    """RTSP/RTP server spread over several processes.
+
+    Each worker process accepts RTSP connections on its own SO_REUSEPORT
+    socket, so the kernel balances new connections between them, and streams
+    its sessions with its own scheduler thread, free of the other processes'
+    GIL. Videos and their saved frame indexes are memory mapped, so every
+    process shares the same pages, and the frame caches keep views into
+    those maps instead of copies.
+    """
+
+    def __init__(self, port, workers, live=False, metricsPort=None):
+        self.port = port
+        self.workers = workers
+        self.live = live
+        self.metricsPort = metricsPort
+
+    def main(self):
+        channels = [
+            socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(self.workers)
+        ]
+
+        # Fork before any threads are started
+        pids = []
+        for index in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.serve(index, channels)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        # Take the workers down with the server, and pass profiling toggles on
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(PROFILE_SIGNAL, lambda signum, frame: self.forward(pids, signum))
+        try:
+            for pid in pids:
+                os.waitpid(pid, 0)
+        except KeyboardInterrupt:
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in pids:
+                os.waitpid(pid, 0)
+
+    def stop(self, signum, frame):
+        raise KeyboardInterrupt
+
+    def forward(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def serve(self, index, channels):
+        """Accept and serve RTSP connections in worker process `index`."""
+        cache = FrameCache.shared()
+        cache.copy = False
+
+        liveChannels = LiveChannels() if self.live else None
+        router = SessionRouter(
+            index,
+            channels,
+            lambda clientInfo: PreforkWorker(
+                clientInfo, router, liveChannels=liveChannels, cache=cache
+            ),
+        )
+        Profiler.shared().installSignal()
+        SessionRegistry.shared().start()
+        threading.Thread(target=router.run, daemon=True).start()
+        if self.metricsPort is not None:
+            MetricsServer(self.metricsPort + index).start()
+
+        rtspSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        rtspSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        rtspSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        rtspSocket.bind(("", self.port))
+        rtspSocket.listen(LISTEN_BACKLOG)
+
+        log.info("worker %d (pid %d) serving on port %d", index, os.getpid(), self.port)
+        while True:
+            clientInfo = {}
+            clientInfo["rtspSocket"] = rtspSocket.accept()
+            router.workerFactory(clientInfo).run()
@@ -0,0 +1,213 @@
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from time import perf_counter
+
+import JpegPayload
+from Interleaved import InterleavedSender
+from Metrics import Registry
+from RtpPacket import RtpEncoder, RtpPacket
+from RtspParser import RtspParser
+from UdpSender import BatchSender
+from VideoStream import VideoStream
+
+# Stack samples per second while sampling
+SAMPLE_RATE = 100
+
+# Signal that starts and stops profiling
+PROFILE_SIGNAL = getattr(signal, "SIGUSR1", None)
+
+log = logging.getLogger(__name__)
+
+SPAN_SECONDS = Registry.shared().histogram(
+    "profile_span_seconds", "Time spent in hot path functions while profiling", ("span",)
+)
+
+# (owner, attribute, span) of every function timed while profiling. The
+# owner is a class or module whose attribute is looked up on each call.
+spanTargets = [
+    (VideoStream, "nextFrame", "nextFrame"),
+    (JpegPayload, "fragment", "fragment"),
+    (RtpEncoder, "encodeFrame", "encode"),
+    (RtpPacket, "encode", "encode"),
+    (BatchSender, "send", "sendto"),
+    (InterleavedSender, "send", "sendto"),
+    (RtspParser, "feed", "parse"),
+]
+
+
+def spanTarget(owner, name, span):
+    """Time `owner.name` under `span` while profiling."""
+    spanTargets.append((owner, name, span))
+
+
+def timed(function, span):
+    """Wrap a function to record its running time under `span`."""
+    labels = (span,)
+    observe = SPAN_SECONDS.observe
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            observe(perf_counter() - start, labels)
+
+    return wrapper
+
+
+class StackSampler:
+    """Records the stack of every thread at a fixed rate.
+
+    The stacks are counted in collapsed form, root first with frames joined
+    by semicolons, which is what flamegraph.pl, speedscope and inferno read.
+    """
+
+    def __init__(self, rate=SAMPLE_RATE):
+        self.interval = 1 / rate
+        self.stacks = Counter()
+        self.labels = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        deadline = perf_counter()
+        while not self.stopped.is_set():
+            self.sample()
+            # Keep to the rate whatever each sample took
+            deadline += self.interval
+            delay = deadline - perf_counter()
+            if delay < 0:
+                deadline = perf_counter()
+                delay = 0
+            self.stopped.wait(delay)
+
+    def sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread"))
+            stack.reverse()
+            self.stacks[";".join(stack)] += 1
+        self.samples += 1
+
+    def label(self, code) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            filename = os.path.basename(code.co_filename)
+            label = self.labels[code] = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+        return label
+
+    def write(self, path):
+        """Write the collapsed stacks, one `stack count` line each."""
+        with open(path, "w") as file:
+            for stack, count in sorted(self.stacks.items()):
+                file.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """Opt-in profiling of a running server.
+
+    Nothing is instrumented until `start`. It swaps timing wrappers in for
+    the functions in `spanTargets`, which feed the `profile_span_seconds`
+    histogram, and starts a StackSampler. `stop` puts the original functions
+    back, so a server that isn't being profiled runs exactly the code it
+    would without this module, and writes the sampled stacks to
+    `profile-<pid>-<time>.folded` in `directory`.
+    """
+
+    _shared = None
+    _sharedLock = threading.Lock()
+
+    def __init__(self, directory=".", rate=SAMPLE_RATE, sampling=True):
+        self.directory = directory
+        self.rate = rate
+        self.sampling = sampling
+        self.originals = []
+        self.sampler = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls) -> "Profiler":
+        """Return the process-wide profiler."""
+        with cls._sharedLock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def enabled(self) -> bool:
+        return bool(self.originals)
+
+    def start(self):
+        with self.lock:
+            if self.originals:
+                return
+            for owner, name, span in spanTargets:
+                original = vars(owner)[name]
+                self.originals.append((owner, name, original))
+                setattr(owner, name, timed(original, span))
+
+            if self.sampling:
+                self.sampler = StackSampler(self.rate)
+                self.sampler.start()
+        log.warning("profiling started")
+
+    def stop(self):
+        """Stop profiling. Return the path of the collapsed stacks, if sampled."""
+        with self.lock:
+            if not self.originals:
+                return None
+            for owner, name, original in reversed(self.originals):
+                setattr(owner, name, original)
+            self.originals = []
+
+            sampler, self.sampler = self.sampler, None
+
+        path = None
+        if sampler is not None:
+            sampler.stop()
+            path = os.path.join(
+                self.directory, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+            )
+            sampler.write(path)
+        log.warning("profiling stopped%s", f", stacks in {path}" if path else "")
+        return path
+
+    def toggle(self):
+        if self.enabled():
+            self.stop()
+        else:
+            self.start()
+
+    def onSignal(self, signum, frame):
+        # Stopping joins the sampler and writes a file, so not in the handler
+        threading.Thread(target=self.toggle).start()
+
+    def installSignal(self):
+        """Toggle profiling on PROFILE_SIGNAL, from the main thread."""
+        if PROFILE_SIGNAL is not None:
+            signal.signal(PROFILE_SIGNAL, self.onSignal)
@@ -0,0 +1,128 @@
+import os
+from time import monotonic
+from typing import List
+
+from VideoStream import VideoStream
+
+# Tiers sit next to the original, worst last: movie.Mjpeg, movie.q1.Mjpeg, ...
+TIER_MARK = ".q"
+MAX_TIERS = 8
+
+# Step down when a receiver report shows more loss than this
+DOWNGRADE_LOSS = 0.05
+
+# Step up after this many reports in a row with no more loss than this
+UPGRADE_LOSS = 0.01
+UPGRADE_REPORTS = 3
+
+# A tier is only chosen if its bitrate fits this share of the estimated capacity
+HEADROOM = 0.8
+
+# The capacity estimate grows by this factor with every clean report
+CAPACITY_GROWTH = 1.1
+
+
+def tierPath(filename, level):
+    """Return the file holding quality tier `level` of a video, 0 being the original."""
+    if level == 0:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return f"{root}{TIER_MARK}{level}{ext}"
+
+
+def tierPaths(filename) -> List[str]:
+    """Return the original and every quality tier generated for it, best first."""
+    paths = [filename]
+    for level in range(1, MAX_TIERS + 1):
+        path = tierPath(filename, level)
+        if not os.path.exists(path):
+            break
+        paths.append(path)
+    return paths
+
+
+class QualityLadder:
+    """The quality tiers of one session's video and the one it should play.
+
+    Every tier is open at once on the shared frame stores, so switching costs
+    nothing but a seek to the same frame number. Receiver reports move the
+    target tier: heavy loss drops to the best tier whose bitrate fits the
+    throughput that got through, and a run of clean reports climbs back one
+    tier at a time while its bitrate fits the capacity estimate. `switch` is
+    only called between frames, so a frame always comes whole from one tier.
+    """
+
+    streams: List[VideoStream]
+
+    def __init__(self, filename, clock=monotonic):
+        self.clock = clock
+        self.streams = [VideoStream(filename)]
+        for path in tierPaths(filename)[1:]:
+            try:
+                stream = VideoStream(path)
+            except IOError:
+                break
+            # A tier that doesn't line up frame for frame can't be switched to
+            if stream.frameCount() != self.streams[0].frameCount():
+                stream.close()
+                break
+            self.streams.append(stream)
+
+        self.bitrates = [
+            os.path.getsize(stream.filename) * 8 / max(stream.duration(), 1 / stream.fps)
+            for stream in self.streams
+        ]
+        self.level = 0
+        self.target = 0
+        self.capacity = None
+        self.cleanReports = 0
+        self.lastOctets = 0
+        self.lastTime = None
+
+    def stream(self) -> VideoStream:
+        return self.streams[self.level]
+
+    def onReport(self, quality, octets):
+        """Update the target tier from a SessionQuality and the octets sent so far."""
+        now = self.clock()
+        delivered = None
+        if self.lastTime is not None and now > self.lastTime:
+            sent = (octets - self.lastOctets) * 8 / (now - self.lastTime)
+            delivered = sent * (1 - quality.fractionLost)
+        self.lastOctets = octets
+        self.lastTime = now
+
+        if quality.fractionLost > DOWNGRADE_LOSS:
+            self.cleanReports = 0
+            if delivered is not None:
+                self.capacity = delivered
+            target = self.target + 1
+            while target < len(self.streams) - 1 and not self.fits(target):
+                target += 1
+            self.target = min(target, len(self.streams) - 1)
+        elif quality.fractionLost <= UPGRADE_LOSS:
+            self.cleanReports += 1
+            if self.capacity is not None:
+                self.capacity *= CAPACITY_GROWTH
+            if self.cleanReports >= UPGRADE_REPORTS and self.target > 0:
+                if self.fits(self.target - 1):
+                    self.target -= 1
+                    self.cleanReports = 0
+        else:
+            self.cleanReports = 0
+
+    def fits(self, level) -> bool:
+        return self.capacity is None or self.bitrates[level] <= self.capacity * HEADROOM
+
+    def switch(self) -> bool:
+        """Move to the target tier at the current frame. Return True if it changed."""
+        target = self.target
+        if target == self.level:
+            return False
+        self.streams[target].seek(self.stream().frameNbr())
+        self.level = target
+        return True
+
+    def close(self):
+        for stream in self.streams:
+            stream.close()
@@ -0,0 +1,151 @@
+import struct
+from time import time
+from typing import List, NamedTuple, Optional
+
+RTCP_VERSION = 2
+
+SR = 200
+RR = 201
+
+# V/P/RC, PT, length in 32-bit words minus one
+RTCP_HEADER = struct.Struct("!BBH")
+SSRC = struct.Struct("!I")
+# NTP timestamp (seconds, fraction), RTP timestamp, packet count, octet count
+SENDER_INFO = struct.Struct("!IIIII")
+# SSRC, fraction lost + cumulative lost, highest sequence, jitter, LSR, DLSR
+REPORT_BLOCK = struct.Struct("!IIIIII")
+
+# Seconds between the NTP (1900) and Unix (1970) epochs
+NTP_EPOCH_OFFSET = 2208988800
+
+
+def ntpTime(now=None) -> int:
+    """Return the 64-bit NTP timestamp for a Unix time."""
+    if now is None:
+        now = time()
+    return int((now + NTP_EPOCH_OFFSET) * (1 << 32)) & 0xFFFFFFFFFFFFFFFF
+
+
+def ntpMiddle(ntp: int) -> int:
+    """Return the middle 32 bits of an NTP timestamp, as used by LSR/DLSR."""
+    return (ntp >> 16) & 0xFFFFFFFF
+
+
+class ReportBlock(NamedTuple):
+    ssrc: int
+    fractionLost: int
+    cumulativeLost: int
+    highestSeq: int
+    jitter: int
+    lsr: int
+    dlsr: int
+
+    def encode(self) -> bytes:
+        lost = max(-0x800000, min(0x7FFFFF, self.cumulativeLost)) & 0xFFFFFF
+        return REPORT_BLOCK.pack(
+            self.ssrc,
+            (self.fractionLost & 0xFF) << 24 | lost,
+            self.highestSeq & 0xFFFFFFFF,
+            self.jitter & 0xFFFFFFFF,
+            self.lsr & 0xFFFFFFFF,
+            self.dlsr & 0xFFFFFFFF,
+        )
+
+    @staticmethod
+    def decode(data, offset=0):
+        ssrc, lost, highestSeq, jitter, lsr, dlsr = REPORT_BLOCK.unpack_from(data, offset)
+        cumulativeLost = lost & 0xFFFFFF
+        if cumulativeLost & 0x800000:
+            cumulativeLost -= 0x1000000
+        return ReportBlock(ssrc, lost >> 24, cumulativeLost, highestSeq, jitter, lsr, dlsr)
+
+
+class RtcpPacket:
+    """An RTCP sender (SR) or receiver (RR) report, RFC 3550 section 6.4."""
+
+    packetType: int
+    ssrc: int
+    blocks: List[ReportBlock]
+
+    def __init__(self, packetType, ssrc, blocks=None):
+        self.packetType = packetType
+        self.ssrc = ssrc
+        self.blocks = blocks or []
+        self.ntp = 0
+        self.rtpTimestamp = 0
+        self.packetCount = 0
+        self.octetCount = 0
+
+    @staticmethod
+    def senderReport(ssrc, ntp, rtpTimestamp, packetCount, octetCount, blocks=None):
+        packet = RtcpPacket(SR, ssrc, blocks)
+        packet.ntp = ntp
+        packet.rtpTimestamp = rtpTimestamp
+        packet.packetCount = packetCount
+        packet.octetCount = octetCount
+        return packet
+
+    @staticmethod
+    def receiverReport(ssrc, blocks):
+        return RtcpPacket(RR, ssrc, blocks)
+
+    def encode(self) -> bytes:
+        if len(self.blocks) > 31:
+            raise ValueError("At most 31 report blocks fit one RTCP packet.")
+
+        body = SSRC.pack(self.ssrc)
+        if self.packetType == SR:
+            body += SENDER_INFO.pack(
+                self.ntp >> 32,
+                self.ntp & 0xFFFFFFFF,
+                self.rtpTimestamp & 0xFFFFFFFF,
+                self.packetCount & 0xFFFFFFFF,
+                self.octetCount & 0xFFFFFFFF,
+            )
+        body += b"".join(block.encode() for block in self.blocks)
+
+        header = RTCP_HEADER.pack(
+            RTCP_VERSION << 6 | len(self.blocks), self.packetType, len(body) // 4
+        )
+        return header + body
+
+    @staticmethod
+    def decode(data, offset=0) -> Optional["RtcpPacket"]:
+        """Decode one SR or RR at `offset`. Return None for other packet types."""
+        first, packetType, _ = RTCP_HEADER.unpack_from(data, offset)
+        if first >> 6 != RTCP_VERSION:
+            raise ValueError("Unsupported RTCP version.")
+        if packetType not in (SR, RR):
+            return None
+
+        pos = offset + RTCP_HEADER.size
+        (ssrc,) = SSRC.unpack_from(data, pos)
+        pos += SSRC.size
+
+        packet = RtcpPacket(packetType, ssrc)
+        if packetType == SR:
+            ntpHigh, ntpLow, rtpTs, packets, octets = SENDER_INFO.unpack_from(data, pos)
+            packet.ntp = ntpHigh << 32 | ntpLow
+            packet.rtpTimestamp = rtpTs
+            packet.packetCount = packets
+            packet.octetCount = octets
+            pos += SENDER_INFO.size
+
+        for _ in range(first & 0x1F):
+            packet.blocks.append(ReportBlock.decode(data, pos))
+            pos += REPORT_BLOCK.size
+
+        return packet
+
+    @staticmethod
+    def decodeCompound(data) -> List["RtcpPacket"]:
+        """Decode every SR and RR in a compound RTCP datagram."""
+        packets = []
+        offset = 0
+        while offset + RTCP_HEADER.size <= len(data):
+            _, _, length = RTCP_HEADER.unpack_from(data, offset)
+            packet = RtcpPacket.decode(data, offset)
+            if packet is not None:
+                packets.append(packet)
+            offset += (length + 1) * 4
+        return packets
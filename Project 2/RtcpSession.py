@@ -0,0 +1,226 @@
+import struct
+import threading
+from socket import socket, AF_INET, SOCK_DGRAM
+from time import monotonic, time
+from typing import Dict, Optional
+
+from JitterBuffer import extend
+from RtcpPacket import RtcpPacket, ReportBlock, ntpMiddle, ntpTime
+from RtpPacket import RTP_CLOCK_RATE
+
+# Seconds between reports. RFC 3550 suggests 5 s, but quality adaptation needs
+# fresher loss and throughput figures than that, and there is one sender.
+RTCP_INTERVAL = 1.0
+
+RTCP_BUFFER_SIZE = 2048
+
+
+class ReceptionStats:
+    """What a receiver knows about one RTP source, for its receiver reports.
+
+    Follows RFC 3550 appendix A: sequence numbers are extended past 16-bit
+    wraparound, the fraction lost covers the packets expected since the last
+    report, and the interarrival jitter is kept in RTP timestamp units.
+    """
+
+    def __init__(self, clockRate=RTP_CLOCK_RATE, clock=monotonic):
+        self.clockRate = clockRate
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.reset(None)
+
+    def reset(self, ssrc):
+        self.sourceSsrc = ssrc
+        self.received = 0
+        self.baseSeq = None
+        self.highestSeq = None
+        self.highestTs = None
+        self.expectedPrior = 0
+        self.receivedPrior = 0
+        self.jitter = 0.0
+        self.lastTransit = None
+        self.lastSr = 0
+        self.lastSrTime = None
+
+    def onPacket(self, seqNum, timestamp, ssrc):
+        """Count a received RTP packet."""
+        now = self.clock()
+        with self.lock:
+            if ssrc != self.sourceSsrc:
+                self.reset(ssrc)
+
+            self.received += 1
+            if self.highestSeq is None:
+                self.baseSeq = self.highestSeq = seqNum
+                self.highestTs = timestamp
+            else:
+                self.highestSeq = max(self.highestSeq, extend(seqNum, self.highestSeq, 16))
+                timestamp = extend(timestamp, self.highestTs, 32)
+                self.highestTs = max(self.highestTs, timestamp)
+
+            transit = now * self.clockRate - timestamp
+            if self.lastTransit is not None:
+                self.jitter += (abs(transit - self.lastTransit) - self.jitter) / 16
+            self.lastTransit = transit
+
+    def onSenderReport(self, ntp):
+        """Remember the last sender report for the LSR and DLSR fields."""
+        with self.lock:
+            self.lastSr = ntpMiddle(ntp)
+            self.lastSrTime = self.clock()
+
+    def packetsExpected(self) -> int:
+        if self.baseSeq is None:
+            return 0
+        return self.highestSeq - self.baseSeq + 1
+
+    def reportBlock(self) -> Optional[ReportBlock]:
+        """Build the report block for the source, or None before any packet."""
+        with self.lock:
+            if self.sourceSsrc is None:
+                return None
+
+            expected = self.packetsExpected()
+            expectedInterval = expected - self.expectedPrior
+            receivedInterval = self.received - self.receivedPrior
+            self.expectedPrior = expected
+            self.receivedPrior = self.received
+
+            lostInterval = expectedInterval - receivedInterval
+            if expectedInterval <= 0 or lostInterval <= 0:
+                fraction = 0
+            else:
+                fraction = (lostInterval << 8) // expectedInterval
+
+            dlsr = 0
+            if self.lastSrTime is not None:
+                dlsr = int((self.clock() - self.lastSrTime) * 65536)
+
+            return ReportBlock(
+                self.sourceSsrc,
+                fraction,
+                expected - self.received,
+                self.highestSeq,
+                int(self.jitter),
+                self.lastSr,
+                dlsr,
+            )
+
+
+class SessionQuality:
+    """The latest reception quality a client reported for its session."""
+
+    def __init__(self, clockRate=RTP_CLOCK_RATE):
+        self.clockRate = clockRate
+        self.fractionLost = 0.0
+        self.cumulativeLost = 0
+        self.highestSeq = 0
+        self.jitter = 0.0
+        self.rtt = None
+        self.reports = 0
+        self.updated = None
+
+    def update(self, block: ReportBlock, now=None):
+        """Take in a report block, `now` being its Unix arrival time."""
+        if now is None:
+            now = time()
+        self.fractionLost = block.fractionLost / 256
+        self.cumulativeLost = block.cumulativeLost
+        self.highestSeq = block.highestSeq
+        self.jitter = block.jitter / self.clockRate
+        if block.lsr:
+            # Round trip from our sender report to this reply, less the time
+            # the receiver held on to it
+            delay = (ntpMiddle(ntpTime(now)) - block.lsr - block.dlsr) & 0xFFFFFFFF
+            self.rtt = delay / 65536
+        self.reports += 1
+        self.updated = monotonic()
+
+    def __str__(self):
+        rtt = "-" if self.rtt is None else f"{self.rtt * 1000:.1f}ms"
+        return (
+            f"lost={self.fractionLost:.1%} cumulative={self.cumulativeLost} "
+            f"jitter={self.jitter * 1000:.1f}ms rtt={rtt}"
+        )
+
+
+class RtcpChannel:
+    """RTCP for every session of a server, sharing one port.
+
+    Reports are routed to the session whose SSRC their report blocks
+    describe, through its `onReceiverReport(block)` method. Subclasses provide
+    the transport with `sendto` and `port`.
+    """
+
+    sessions: Dict[int, object]
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.errors = 0
+
+    def register(self, ssrc, session):
+        with self.lock:
+            self.sessions[ssrc] = session
+
+    def unregister(self, ssrc):
+        with self.lock:
+            self.sessions.pop(ssrc, None)
+
+    def receive(self, data, address):
+        """Dispatch the report blocks of a received RTCP datagram."""
+        try:
+            packets = RtcpPacket.decodeCompound(data)
+        except (ValueError, struct.error):
+            self.errors += 1
+            return
+
+        for packet in packets:
+            for block in packet.blocks:
+                session = self.sessions.get(block.ssrc)
+                if session is not None:
+                    session.onReceiverReport(block)
+
+    def sendto(self, data, address):
+        raise NotImplementedError
+
+    def port(self) -> int:
+        raise NotImplementedError
+
+
+class SocketRtcpChannel(RtcpChannel):
+    """An RtcpChannel on a UDP socket, received from a thread of its own."""
+
+    _shared = None
+    _sharedLock = threading.Lock()
+
+    def __init__(self, port=0):
+        super().__init__()
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.socket.bind(("", port))
+
+    @classmethod
+    def shared(cls) -> "SocketRtcpChannel":
+        """Return the process-wide channel, starting its thread on first use."""
+        with cls._sharedLock:
+            if cls._shared is None:
+                cls._shared = cls()
+                threading.Thread(target=cls._shared.run, daemon=True).start()
+            return cls._shared
+
+    def run(self):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(RTCP_BUFFER_SIZE)
+            except ConnectionResetError:
+                # An ICMP error for an earlier report, keep listening
+                continue
+            except OSError:
+                break
+            self.receive(data, address)
+
+    def sendto(self, data, address):
+        self.socket.sendto(data, address)
+
+    def port(self) -> int:
+        return self.socket.getsockname()[1]
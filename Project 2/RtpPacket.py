@@ -1,36 +1,140 @@
+import struct
 import sys
 from time import time
 
 HEADER_SIZE = 12
 
+# RTP clock rate of JPEG video, RFC 2435
+RTP_CLOCK_RATE = 90000
+
+
+# V/P/X/CC, M/PT, sequence number, timestamp, SSRC
+RTP_HEADER = struct.Struct("!BBHII")
+
+# The per-session fields, at offsets 2 and 8
+RTP_SEQ = struct.Struct("!H")
+RTP_SSRC = struct.Struct("!I")
+
+
+def validateFields(version, padding, extension, cc, pt, ssrc):
+    """Check the per-session RTP header fields fit their bit widths."""
+    if version < 0 or version > 3:
+        raise ValueError("Version must be a 2-bit field (0-3).")
+
+    if padding < 0 or padding > 1:
+        raise ValueError("Padding must be a 1-bit field (0-1).")
+
+    if extension < 0 or extension > 1:
+        raise ValueError("Extension must be a 1-bit field (0-1).")
+
+    if cc < 0 or cc > 15:
+        raise ValueError("CC must be a 4-bit field (0-15).")
+
+    if pt < 0 or pt > 127:
+        raise ValueError("Payload type must be a 7-bit field (0-127).")
+
+    if ssrc < 0 or ssrc > 4294967295:
+        raise ValueError("SSRC must be a 32-bit field (0-4294967295).")
+
+
+def restamp(packet, seqnum, ssrc):
+    """Rewrite the sequence number and SSRC of an encoded packet in place."""
+    RTP_SEQ.pack_into(packet, 2, seqnum & 0xFFFF)
+    RTP_SSRC.pack_into(packet, 8, ssrc)
+
+
+class RtpEncoder:
+    """Fast RTP header encoder for one session.
+
+    The fields that stay fixed for a session are validated once here. Headers
+    for all packets of a frame are then stamped into one reusable buffer with
+    a precompiled struct, so each packet costs a single `pack_into`.
+    """
+
+    __slots__ = ("firstByte", "pt", "ssrc", "buffer", "view")
+
+    def __init__(self, version, padding, extension, cc, pt, ssrc):
+        validateFields(version, padding, extension, cc, pt, ssrc)
+        self.firstByte = version << 6 | padding << 5 | extension << 4 | cc
+        self.pt = pt
+        self.ssrc = ssrc
+        self.buffer = bytearray()
+        self.view = memoryview(self.buffer)
+
+    def packInto(self, buffer, offset, seqnum, marker, timestamp):
+        """Write one header into `buffer` at `offset`."""
+        RTP_HEADER.pack_into(
+            buffer,
+            offset,
+            self.firstByte,
+            marker << 7 | self.pt,
+            seqnum & 0xFFFF,
+            timestamp & 0xFFFFFFFF,
+            self.ssrc,
+        )
+
+    def encodeFrame(self, count, seqnum, timestamp):
+        """Stamp headers for the `count` packets of one frame.
+
+        Packets get consecutive sequence numbers from `seqnum`, share
+        `timestamp`, and the last one has the marker bit set. The returned
+        views point into a buffer that is overwritten by the next call, so
+        send them (or copy them) before encoding another frame.
+        """
+        size = count * HEADER_SIZE
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+            self.view = memoryview(self.buffer)
+
+        firstByte = self.firstByte
+        pt = self.pt
+        ssrc = self.ssrc
+        timestamp &= 0xFFFFFFFF
+        pack_into = RTP_HEADER.pack_into
+        buffer = self.buffer
+        for i in range(count):
+            marker = 0x80 if i == count - 1 else 0
+            pack_into(
+                buffer,
+                i * HEADER_SIZE,
+                firstByte,
+                marker | pt,
+                (seqnum + i) & 0xFFFF,
+                timestamp,
+                ssrc,
+            )
+
+        view = self.view
+        return [view[i : i + HEADER_SIZE] for i in range(0, size, HEADER_SIZE)]
+
 
 class RtpPacket:
-    header = bytearray(HEADER_SIZE)
+    __slots__ = ("header", "payload")
 
     def __init__(self):
-        pass
+        self.header = bytearray(HEADER_SIZE)
+        self.payload = b""
 
     def encode(
-        self, version, padding, extension, cc, seqnum, marker, pt, ssrc, payload
+        self,
+        version,
+        padding,
+        extension,
+        cc,
+        seqnum,
+        marker,
+        pt,
+        ssrc,
+        payload,
+        timestamp=None,
     ):
         """Encode the RTP packet with header fields and payload."""
-        timestamp = int(time())
-        header = bytearray(HEADER_SIZE)
+        if timestamp is None:
+            timestamp = int(time())
 
         # Fill in Start
         # Fill the header bytearray with RTP header fields
-
-        if version < 0 or version > 3:
-            raise ValueError("Version must be a 2-bit field (0-3).")
-
-        if padding < 0 or padding > 1:
-            raise ValueError("Padding must be a 1-bit field (0-1).")
-
-        if extension < 0 or extension > 1:
-            raise ValueError("Extension must be a 1-bit field (0-1).")
-
-        if cc < 0 or cc > 15:
-            raise ValueError("CC must be a 4-bit field (0-15).")
+        validateFields(version, padding, extension, cc, pt, ssrc)
 
         if seqnum < 0 or seqnum > 65535:
             raise ValueError("Sequence number must be a 16-bit field (0-65535).")
@@ -38,24 +142,19 @@ class RtpPacket:
         if marker < 0 or marker > 1:
             raise ValueError("Marker must be a 1-bit field (0-1).")
 
-        if pt < 0 or pt > 127:
-            raise ValueError("Payload type must be a 7-bit field (0-127).")
-
-        if ssrc < 0 or ssrc > 4294967295:
-            raise ValueError("SSRC must be a 32-bit field (0-4294967295).")
-
-        header[0] = version << 6 | padding << 5 | extension << 4 | cc
-        header[1] = marker << 7 | pt
-        header[2] = (seqnum >> 8) & 0xFF
-        header[3] = seqnum & 0xFF
-        header[4] = timestamp >> 24 & 0xFF
-        header[5] = timestamp >> 16 & 0xFF
-        header[6] = timestamp >> 8 & 0xFF
-        header[7] = timestamp & 0xFF
-        header[8] = ssrc >> 24 & 0xFF
-        header[9] = ssrc >> 16 & 0xFF
-        header[10] = ssrc >> 8 & 0xFF
-        header[11] = ssrc & 0xFF
+        if timestamp < 0 or timestamp > 4294967295:
+            raise ValueError("Timestamp must be a 32-bit field (0-4294967295).")
+
+        header = bytearray(HEADER_SIZE)
+        RTP_HEADER.pack_into(
+            header,
+            0,
+            version << 6 | padding << 5 | extension << 4 | cc,
+            marker << 7 | pt,
+            seqnum,
+            timestamp,
+            ssrc,
+        )
 
         self.header = header
 
@@ -91,6 +190,14 @@ class RtpPacket:
         # Fill in End
         return int(timestamp)
 
+    def ssrc(self):
+        """Return the synchronization source identifier."""
+        return int.from_bytes(self.header[8:12], "big")
+
+    def marker(self):
+        """Return marker bit."""
+        return int(self.header[1] >> 7)
+
     def payloadType(self):
         """Return payload type."""
         # Fill in Start
@@ -105,3 +212,7 @@ class RtpPacket:
     def getPacket(self):
         """Return RTP packet."""
         return self.header + self.payload
+
+    def getBuffers(self):
+        """Return header and payload as separate buffers for a vectored send."""
+        return [self.header, self.payload]
@@ -0,0 +1,479 @@
+import logging
+import struct
+import threading
+from random import randint
+from socket import socket, AF_INET, SOCK_DGRAM, SHUT_RDWR, SOCK_STREAM
+from time import monotonic, sleep
+
+from RtspPacket import RtspMethod, RtspResponse, RtspRequest, RtspStatus, parseSession
+from RtpPacket import RtpPacket
+from RtspParser import RtspParser
+from JpegPayload import FrameReassembler
+from RtcpPacket import RtcpPacket, SR
+from RtcpSession import RTCP_BUFFER_SIZE, RTCP_INTERVAL, ReceptionStats
+from Interleaved import InterleavedFrame
+import Interleaved
+
+RTP_BUFFER_SIZE = 65536
+RTSP_RECV_SIZE = 4096
+
+# Reads of an interleaved connection carry whole frames of RTP
+INTERLEAVED_RECV_SIZE = 65536
+
+log = logging.getLogger(__name__)
+
+
+class RtspClient:
+    """The RTSP/RTP side of a viewer, without any GUI.
+
+    It sequences SETUP/PLAY/PAUSE/TEARDOWN requests, tracks the session state
+    from the server's replies and reassembles RTP packets into frames.
+    Subclasses decide what to do with them through the `onPacket`, `onFrame`
+    and `onReply` hooks. Reception statistics go back to the server in RTCP
+    receiver reports from the port above the RTP port.
+
+    With `interleaved` set, RTP and RTCP come over the RTSP connection instead
+    (RTP/AVP/TCP), for networks that block UDP.
+    """
+
+    INIT = 0
+    READY = 1
+    PLAYING = 2
+    state = INIT
+
+    SETUP = 0
+    PLAY = 1
+    PAUSE = 2
+    TEARDOWN = 3
+    KEEPALIVE = 4
+
+    def __init__(self, serveraddr, serverport, rtpport, filename, interleaved=False):
+        self.serverAddr = serveraddr
+        self.serverPort = int(serverport)
+        self.rtpPort = int(rtpport)
+        self.fileName = filename
+        self.rtspSeq = 0
+        self.sessionId = 0
+        self.requestSent = -1
+        self.requestTime = 0.0
+        self.awaitingReply = False
+        # Seconds the server keeps an idle session, from the SETUP reply
+        self.sessionTimeout = None
+        self.teardownAcked = 0
+        self.playEvent = threading.Event()
+        self.reassembler = FrameReassembler()
+        self.ssrc = randint(0, 0xFFFFFFFF)
+        self.reception = ReceptionStats()
+        self.serverRtcpPort = None
+        self.interleaved = interleaved
+        self.channels = (Interleaved.RTP_CHANNEL, Interleaved.RTCP_CHANNEL)
+        # Receiver reports and requests share the RTSP connection
+        self.sendLock = threading.Lock()
+        self.requestLock = threading.Lock()
+        self.connectToServer()
+
+    def setupMovie(self):
+        """Setup button handler."""
+        if self.state == self.INIT:
+            self.sendRtspRequest(self.SETUP)
+
+    def pauseMovie(self):
+        """Pause button handler."""
+        if self.state == self.PLAYING:
+            self.sendRtspRequest(self.PAUSE)
+
+    def playMovie(self):
+        """Play button handler."""
+        if self.state == self.READY:
+            self.playEvent = threading.Event()
+            self.playEvent.clear()
+            # Create a new thread to listen for RTP packets
+            if not self.interleaved:
+                threading.Thread(target=self.listenRtp).start()
+            self.sendRtspRequest(self.PLAY)
+
+    def teardownMovie(self):
+        """Teardown button handler."""
+        self.sendRtspRequest(self.TEARDOWN)
+
+    def listenRtp(self):
+        """Listen for RTP packets."""
+        while True:
+            try:
+                data = self.rtpSocket.recv(RTP_BUFFER_SIZE)
+                if data:
+                    self.handleRtp(data)
+            except OSError as e:
+                # Stop listening upon requesting PAUSE or TEARDOWN
+                if self.playEvent.isSet():
+                    break
+
+                # Upon receiving ACK for TEARDOWN request,
+                # close the RTP socket
+                if self.teardownAcked == 1:
+                    try:
+                        self.rtpSocket.shutdown(SHUT_RDWR)
+                    except OSError:
+                        pass
+                    self.rtpSocket.close()
+                    break
+
+                if isinstance(e, TimeoutError):
+                    # Keep waiting out stalls in the stream
+                    continue
+
+                if e.errno == 57:
+                    log.warning("Socket is not connected")
+                break
+
+    def keepAlive(self):
+        """Send a keepalive whenever half the session timeout passes without a request."""
+        while not self.teardownAcked:
+            idle = monotonic() - self.requestTime
+            if idle < self.sessionTimeout / 2:
+                sleep(self.sessionTimeout / 2 - idle)
+                continue
+            try:
+                self.sendRtspRequest(self.KEEPALIVE)
+            except OSError:
+                break
+            # Not sent while waiting for another reply; check again shortly
+            sleep(1)
+
+    def handleRtp(self, data):
+        """Take in one RTP packet from the server."""
+        rtpPacket = RtpPacket()
+        rtpPacket.decode(data)
+        self.reception.onPacket(rtpPacket.seqNum(), rtpPacket.timestamp(), rtpPacket.ssrc())
+        self.onPacket(rtpPacket, len(data))
+
+        # Frames span several packets, rebuild them by timestamp
+        frame = self.reassembler.add(rtpPacket)
+        if frame:
+            self.onFrame(frame, rtpPacket.timestamp())
+
+    def handleRtcp(self, data):
+        """Take in the sender reports of an RTCP packet from the server."""
+        try:
+            for packet in RtcpPacket.decodeCompound(data):
+                if packet.packetType == SR:
+                    self.reception.onSenderReport(packet.ntp)
+        except (ValueError, struct.error):
+            # Not RTCP we understand
+            pass
+
+    def listenRtcp(self):
+        """Take in sender reports and send a receiver report every interval."""
+        nextReport = monotonic() + RTCP_INTERVAL
+        while not self.teardownAcked:
+            try:
+                self.rtcpSocket.settimeout(max(0.01, nextReport - monotonic()))
+                self.handleRtcp(self.rtcpSocket.recv(RTCP_BUFFER_SIZE))
+            except TimeoutError:
+                pass
+            except OSError:
+                break
+
+            if monotonic() >= nextReport:
+                nextReport = monotonic() + RTCP_INTERVAL
+                self.sendReceiverReport()
+
+        self.rtcpSocket.close()
+
+    def reportInterleaved(self):
+        """Send a receiver report on the RTSP connection every interval."""
+        while not self.teardownAcked:
+            sleep(RTCP_INTERVAL)
+            if self.teardownAcked:
+                break
+            self.sendReceiverReport()
+
+    def sendReceiverReport(self):
+        """Report reception quality to the server."""
+        block = self.reception.reportBlock()
+        if block is None:
+            return
+        report = RtcpPacket.receiverReport(self.ssrc, [block])
+        if self.interleaved:
+            try:
+                with self.sendLock:
+                    self.rtspSocket.sendall(Interleaved.frame(self.channels[1], report.encode()))
+            except OSError as e:
+                log.warning("failed to send receiver report: %s", e)
+            return
+
+        if self.serverRtcpPort is None:
+            return
+        try:
+            self.rtcpSocket.sendto(report.encode(), (self.serverAddr, self.serverRtcpPort))
+        except OSError as e:
+            log.warning("failed to send receiver report: %s", e)
+
+    def onPacket(self, rtpPacket, size):
+        """Called for every RTP packet received."""
+
+    def onFrame(self, frame, timestamp):
+        """Called with every frame reassembled from RTP packets."""
+
+    def onReply(self, reply, latency):
+        """Called with every RTSP reply and the seconds since its request."""
+
+    def showWarning(self, title, message):
+        """Report a connection problem to the user."""
+        log.warning("%s: %s", title, message)
+
+    def connectToServer(self):
+        """Connect to the Server. Start a new RTSP/TCP session."""
+        self.rtspSocket = socket(AF_INET, SOCK_STREAM)
+        try:
+            self.rtspSocket.connect((self.serverAddr, self.serverPort))
+        except:
+            self.showWarning(
+                "Connection Failed", "Connection to '%s' failed." % self.serverAddr
+            )
+
+    def sendRtspRequest(self, requestCode):
+        """Send RTSP request to the server."""
+        # The keepalive thread sends requests too, so the sequence number,
+        # the request awaiting its reply and the send go together
+        with self.requestLock:
+            # Setup request
+            if requestCode == self.SETUP and self.state == self.INIT:
+                threading.Thread(target=self.recvRtspReply).start()
+                # Fill in Start
+                # Update RTSP sequence number.
+                self.rtspSeq += 1
+                # Write the RTSP request to be sent.
+
+                request = RtspRequest(method=RtspMethod.SETUP, filename=self.fileName)
+                request.set_header("CSeq", self.rtspSeq)
+                if self.interleaved:
+                    request.set_header(
+                        "Transport",
+                        f"RTP/AVP/TCP;unicast;interleaved={self.channels[0]}-{self.channels[1]}",
+                    )
+                else:
+                    request.set_header(
+                        "Transport", f"RTP/UDP; client_port= {self.rtpPort}-{self.rtpPort + 1}"
+                    )
+                # Keep track of the sent request.
+                self.requestSent = self.SETUP
+                # Fill in End
+
+            # Play request
+            elif requestCode == self.PLAY and self.state == self.READY:
+                # Fill in Start
+                # Update RTSP sequence number.
+                self.rtspSeq += 1
+                # Write the RTSP request to be sent.
+                request = RtspRequest(method=RtspMethod.PLAY, filename=self.fileName)
+                request.set_header("CSeq", self.rtspSeq)
+                request.set_header("Session", self.sessionId)
+                # Keep track of the sent request.
+                self.requestSent = self.PLAY
+                # Fill in End
+
+                # Pause request
+            elif requestCode == self.PAUSE and self.state == self.PLAYING:
+                # Fill in Start
+                # Update RTSP sequence number.
+                # self.rtspSeq ...
+                self.rtspSeq += 1
+                # Write the RTSP request to be sent.
+                request = RtspRequest(method=RtspMethod.PAUSE, filename=self.fileName)
+                request.set_header("CSeq", self.rtspSeq)
+                request.set_header("Session", self.sessionId)
+                # Keep track of the sent request.
+                self.requestSent = self.PAUSE
+                # Fill in End
+
+            # Teardown request
+            elif requestCode == self.TEARDOWN and not self.state == self.INIT:
+                # Fill in Start
+                # Update RTSP sequence number.
+                self.rtspSeq += 1
+                # Write the RTSP request to be sent.
+                request = RtspRequest(method=RtspMethod.TEARDOWN, filename=self.fileName)
+                request.set_header("CSeq", self.rtspSeq)
+                request.set_header("Session", self.sessionId)
+                # Keep track of the sent request.
+                self.requestSent = self.TEARDOWN
+
+            # Keepalive request, only between replies so it can't hide the reply to another
+            elif (
+                requestCode == self.KEEPALIVE
+                and self.state in (self.READY, self.PLAYING)
+                and not self.awaitingReply
+            ):
+                self.rtspSeq += 1
+                request = RtspRequest(method=RtspMethod.GET_PARAMETER, filename=self.fileName)
+                request.set_header("CSeq", self.rtspSeq)
+                request.set_header("Session", self.sessionId)
+                self.requestSent = self.KEEPALIVE
+            else:
+                return
+
+            # Send the RTSP request using rtspSocket.
+            # Fill in Start
+            # Fill in End
+            payload = request.encode()
+
+            self.requestTime = monotonic()
+            self.awaitingReply = True
+            with self.sendLock:
+                self.rtspSocket.sendall(payload.encode())
+
+            log.debug("Data sent: %s", payload)
+
+    def recvRtspReply(self):
+        """Receive RTSP reply from the server."""
+        parser = RtspParser(RtspResponse)
+        recvSize = INTERLEAVED_RECV_SIZE if self.interleaved else RTSP_RECV_SIZE
+        while True:
+            try:
+                data = self.rtspSocket.recv(recvSize)
+            except OSError:
+                break
+            if not data:
+                break
+
+            replied = False
+            for message in parser.feed(data):
+                if isinstance(message, InterleavedFrame):
+                    if message.channel == self.channels[0]:
+                        self.handleRtp(message.payload)
+                    elif message.channel == self.channels[1]:
+                        self.handleRtcp(message.payload)
+                    continue
+                log.debug("Data received: %s", message)
+                self.processRtspReply(message)
+                replied = True
+
+            # Close the RTSP socket upon the reply to Teardown
+            if self.requestSent == self.TEARDOWN and replied:
+                try:
+                    if (
+                        self.rtspSocket.fileno() != -1
+                    ):  # Check if the socket is connected
+                        self.rtspSocket.shutdown(SHUT_RDWR)
+                        self.rtspSocket.close()
+                except OSError as e:
+                    log.warning("Error: %s", e)
+                # self.rtspSocket.shutdown(socket.SHUT_RDWR)
+                # self.rtspSocket.close()
+                break
+
+    def processRtspReply(self, response):
+        """Handle one RTSP reply from the server."""
+        self.onReply(response, monotonic() - self.requestTime)
+
+        if response.status() == RtspStatus.NOT_FOUND:
+            log.warning("the file does not exist on server")
+        elif response.status() == RtspStatus.CONNECTION_ERROR:
+            log.warning("there is a connection problem")
+        else:
+            self.parseRtspReply(response)
+
+    def parseRtspReply(self, reply):
+        """Parse the RTSP reply from the server."""
+        seqNumStr = reply.get_header("CSeq")
+
+        if seqNumStr is None:
+            raise ValueError("CSeq header missing in RTSP response")
+
+        seqNum = int(seqNumStr)
+
+        sessionStr = reply.get_header("Session")
+
+        if sessionStr is None:
+            raise ValueError("Session header missing in RTSP response")
+
+        session, timeout = parseSession(sessionStr)
+        session = int(session)
+
+        # Process only if the server reply's sequence number is the same as the request's
+        with self.requestLock:
+            current = seqNum == self.rtspSeq
+            if current:
+                self.awaitingReply = False
+        if current:
+            # New RTSP session ID
+            if self.sessionId == 0:
+                self.sessionId = session
+
+            # Process only if the session ID is the same
+            if self.sessionId == session:
+                if reply.status() == RtspStatus.OK:
+                    if self.requestSent == self.SETUP:
+                        # Fill in Start
+                        # Open RTP port.
+                        if self.interleaved:
+                            self.useChannels(reply.get_header("Transport"))
+                        else:
+                            self.openRtpPort()
+                            self.openRtcpPort(reply.get_header("Transport"))
+                        # Update RTSP state once the port is ready for PLAY.
+                        self.state = self.READY
+                        # Keep the session from timing out while paused
+                        if timeout and self.sessionTimeout is None:
+                            self.sessionTimeout = timeout
+                            threading.Thread(target=self.keepAlive, daemon=True).start()
+                    elif self.requestSent == self.PLAY:
+                        self.state = self.PLAYING
+                    elif self.requestSent == self.PAUSE:
+                        self.state = self.READY
+                        # The play thread exits. A new thread is created on resume.
+                        self.playEvent.set()
+                    elif self.requestSent == self.TEARDOWN:
+                        self.state = self.TEARDOWN
+                        # Fill in End
+                        # Flag the teardownAcked to close the socket.
+                        self.teardownAcked = 1
+
+    def openRtpPort(self):
+        """Open RTP socket binded to a specified port."""
+        # Fill in Start
+        # Create a new datagram socket to receive RTP packets from the server
+        self.rtpSocket = socket(AF_INET, SOCK_DGRAM)
+        # Set the timeout value of the socket to 0.5sec
+        self.rtpSocket.settimeout(0.5)
+        try:
+            # Bind the socket to the address using the RTP port given by the client user
+            self.rtpSocket.bind(("0.0.0.0", self.rtpPort))
+        # Fill in End
+        except Exception as e:
+            self.showWarning("Unable to Bind", f"Unable to bind PORT={self.rtpPort}\n" + str(e))
+
+    def openRtcpPort(self, transport):
+        """Open the RTCP socket above the RTP port and start reporting."""
+        self.serverRtcpPort = self.parseServerRtcpPort(transport)
+        self.rtcpSocket = socket(AF_INET, SOCK_DGRAM)
+        try:
+            self.rtcpSocket.bind(("0.0.0.0", self.rtpPort + 1))
+        except OSError as e:
+            self.showWarning("Unable to Bind", f"Unable to bind PORT={self.rtpPort + 1}\n" + str(e))
+            self.rtcpSocket.close()
+            return
+        threading.Thread(target=self.listenRtcp, daemon=True).start()
+
+    def useChannels(self, transport):
+        """Take the channels the server chose and start reporting on them."""
+        if transport is not None:
+            channels = Interleaved.parseChannels(transport)
+            if channels is not None:
+                self.channels = channels
+        threading.Thread(target=self.reportInterleaved, daemon=True).start()
+
+    def parseServerRtcpPort(self, transport):
+        """Return the server's RTCP port from a SETUP reply Transport header."""
+        if transport is None:
+            return None
+        for field in transport.split(";"):
+            key, _, value = field.strip().partition("=")
+            if key == "server_port":
+                ports = value.split("-")
+                try:
+                    return int(ports[1]) if len(ports) > 1 else int(ports[0]) + 1
+                except ValueError:
+                    return None
+        return None
@@ -1,7 +1,7 @@
 from enum import Enum
 from os import stat
 import re
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 
 
 class RtspMethod(Enum):
@@ -9,21 +9,43 @@ class RtspMethod(Enum):
     PLAY = "PLAY"
     PAUSE = "PAUSE"
     TEARDOWN = "TEARDOWN"
+    SET_PARAMETER = "SET_PARAMETER"
+    GET_PARAMETER = "GET_PARAMETER"
+    OPTIONS = "OPTIONS"
 
 
 class RtspStatus(Enum):
     OK = "200 OK"
+    BAD_REQUEST = "400 BAD REQUEST"
+    FORBIDDEN = "403 FORBIDDEN"
     NOT_FOUND = "404 NOT FOUND"
+    PARAMETER_NOT_UNDERSTOOD = "451 PARAMETER NOT UNDERSTOOD"
+    UNSUPPORTED_TRANSPORT = "461 UNSUPPORTED TRANSPORT"
     CONNECTION_ERROR = "500 CONNECTION ERROR"
 
 
 STATUS_TO_CODE = {
     "200": RtspStatus.OK,
+    "400": RtspStatus.BAD_REQUEST,
+    "403": RtspStatus.FORBIDDEN,
     "404": RtspStatus.NOT_FOUND,
+    "451": RtspStatus.PARAMETER_NOT_UNDERSTOOD,
+    "461": RtspStatus.UNSUPPORTED_TRANSPORT,
     "500": RtspStatus.CONNECTION_ERROR,
 }
 
 
+def parseSession(value: str) -> Tuple[str, Optional[int]]:
+    """Split a Session header into the session ID and its timeout in seconds, if given."""
+    session, _, params = value.partition(";")
+    timeout = None
+    for param in params.split(";"):
+        name, _, number = param.partition("=")
+        if name.strip().lower() == "timeout" and number.strip().isdigit():
+            timeout = int(number)
+    return session.strip(), timeout
+
+
 class RtspHeader:
     version: str = "RTSP/1.0"
 
@@ -82,6 +104,7 @@ class RtspPacket:
     def __init__(self, header: RtspHeader):
         self.header = header
         self.headers = {}
+        self.body = b""
 
     def set_header(self, key: str, value: object):
         self.headers[key] = str(value)
@@ -91,14 +114,17 @@ class RtspPacket:
 
 
     def _encode_headers(self) -> str:
-        header_str = ""
-        for header in self.headers:
-            header_str += f"{header}: {self.headers[header]}\n"
-
-        return header_str
+        return "".join(f"{key}: {value}\n" for key, value in self.headers.items())
 
     def encode(self) -> str:
-        return self.header.encode() + "\n" + self._encode_headers()
+        headers = self._encode_headers()
+        if self.body:
+            headers += f"Content-Length: {len(self.body)}\n"
+        # A blank line ends the headers
+        return self.header.encode() + "\n" + headers + "\n" + self.body.decode("latin-1")
+
+    def __str__(self) -> str:
+        return self.encode()
 
     @staticmethod
     def decode(data: str):
@@ -120,6 +146,9 @@ class RtspRequest(RtspPacket):
 
         # Parse headers
         for line in lines[1:]:
+            if not line.strip():
+                continue
+
             parts = line.split(":")
 
             key = parts[0].strip()
@@ -151,6 +180,9 @@ class RtspResponse(RtspPacket):
 
         # Parse headers
         for line in lines[1:]:
+            if not line.strip():
+                continue
+
             parts = line.split(":")
 
             key = parts[0].strip()
@@ -162,3 +194,54 @@ class RtspResponse(RtspPacket):
 
     def status(self) -> RtspStatus:
         return self.header.status
+
+
+class RtspResponseBuilder:
+    """Builds encoded RTSP responses from cached byte prefixes.
+
+    The status line and Session line of each status are encoded once per
+    session and kept as one bytes prefix, so a reply costs a single `%`
+    format of the prefix, the CSeq and any extra headers into new bytes.
+    """
+
+    STATUS_LINES: Dict[RtspStatus, bytes] = {
+        status: RtspResponseHeader(status).encode().encode() for status in RtspStatus
+    }
+
+    # Prefixes kept before the cache starts over, enough for every status of
+    # a few sessions
+    MAX_PREFIXES = 32
+
+    def __init__(self):
+        self.prefixes: Dict[Tuple[RtspStatus, Optional[object]], bytes] = {}
+
+    def prefix(self, status: RtspStatus, session: Optional[object]) -> bytes:
+        """Encode and cache the status and Session lines of a reply."""
+        if len(self.prefixes) >= self.MAX_PREFIXES:
+            self.prefixes = {}
+        prefix = self.STATUS_LINES[status]
+        if session is not None:
+            prefix += b"\nSession: %s" % str(session).encode()
+        self.prefixes[status, session] = prefix
+        return prefix
+
+    def build(
+        self,
+        status: RtspStatus,
+        cseq: Optional[str] = None,
+        session: Optional[object] = None,
+        headers: Optional[Dict[str, object]] = None,
+    ) -> bytes:
+        prefix = self.prefixes.get((status, session))
+        if prefix is None:
+            prefix = self.prefix(status, session)
+        extra = (
+            "".join(f"\n{key}: {value}" for key, value in headers.items()).encode()
+            if headers
+            else b""
+        )
+
+        # A blank line ends the message
+        if cseq is None:
+            return b"%s%s\n\n" % (prefix, extra)
+        return b"%s\nCSeq: %s%s\n\n" % (prefix, str(cseq).encode(), extra)
@@ -0,0 +1,156 @@
+from typing import List, Type, Union
+
+from Interleaved import INTERLEAVED_HEADER, INTERLEAVED_MAGIC, InterleavedFrame
+from RtspPacket import (
+    RtspMethod,
+    RtspPacket,
+    RtspRequest,
+    RtspRequestHeader,
+    RtspResponse,
+    RtspResponseHeader,
+    STATUS_TO_CODE,
+)
+
+# A message whose headers grow past this without ending is rejected
+MAX_HEADER_SIZE = 65536
+
+# Distinct start lines remembered per connection
+MAX_START_LINES = 64
+
+RTSP_VERSION = "RTSP/1.0"
+CRLF = b"\r\n"
+
+
+class RtspParser:
+    """Incremental parser for a stream of RTSP requests or responses.
+
+    Bytes are fed in as they arrive from the socket, in pieces of any size.
+    A message ends at the first blank line, CRLF or LF, plus `Content-Length`
+    bytes of body. `feed` returns every message completed so far, so
+    pipelined requests in one read all come back at once, and a message split
+    across reads waits in the buffer for the rest. Malformed messages are
+    skipped and counted in `errors`. Packets interleaved on the connection
+    with `$` framing come back in order with the messages, as
+    `InterleavedFrame`s.
+    """
+
+    def __init__(self, packetType: Type[RtspPacket]):
+        self.packetType = packetType
+        if packetType is RtspRequest:
+            self.headerType = lambda start: RtspRequestHeader(*start)
+        else:
+            self.headerType = RtspResponseHeader
+        self.buffer = bytearray()
+        self.errors = 0
+        self.startLines = {}
+
+    def feed(self, data) -> List[Union[RtspRequest, RtspResponse, InterleavedFrame]]:
+        """Add received bytes and return each message they complete."""
+        # Partial input is parsed where it waits in the buffer, so only
+        # what a message consumes is ever copied out
+        buffered = bool(self.buffer)
+        if buffered:
+            self.buffer += data
+            data = self.buffer
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+
+        messages = []
+        pos = 0
+        n = len(data)
+        with memoryview(data) as view:
+            while pos < n:
+                # Ignore blank lines between messages
+                if data[pos] in CRLF:
+                    pos += 1
+                    continue
+
+                # A packet on an interleaved channel
+                if data[pos] == INTERLEAVED_MAGIC:
+                    if n - pos < INTERLEAVED_HEADER.size:
+                        break
+                    _, channel, length = INTERLEAVED_HEADER.unpack_from(data, pos)
+                    start = pos + INTERLEAVED_HEADER.size
+                    if n - start < length:
+                        break
+                    messages.append(InterleavedFrame(channel, bytes(view[start : start + length])))
+                    pos = start + length
+                    continue
+
+                # Headers end at the first blank line, LF or CRLF terminated
+                end = data.find(b"\n\n", pos)
+                crlf = data.find(b"\r\n\r\n", pos, n if end < 0 else end)
+                if crlf >= 0:
+                    end, size = crlf, 4
+                elif end >= 0:
+                    size = 2
+                else:
+                    if n - pos > MAX_HEADER_SIZE:
+                        # Headers that never end, drop them
+                        self.errors += 1
+                        pos = n
+                    break
+
+                try:
+                    packet = self._parse(str(view[pos:end], "latin-1"))
+                    length = int(packet.headers.get("Content-Length", 0))
+                    if length < 0:
+                        raise ValueError("Negative Content-Length")
+                except (ValueError, KeyError):
+                    self.errors += 1
+                    pos = end + size
+                    continue
+
+                total = end + size + length
+                if total > n:
+                    break
+
+                if length:
+                    packet.body = bytes(view[end + size : total])
+                messages.append(packet)
+                pos = total
+
+        if buffered:
+            del self.buffer[:pos]
+        elif pos < n:
+            self.buffer += data[pos:]
+        return messages
+
+    def _parse(self, block: str) -> RtspPacket:
+        lines = block.split("\n")
+        first = lines[0]
+
+        # Start lines repeat for the whole session, so parse each one once
+        start = self.startLines.get(first)
+        if start is None:
+            start = self._parseStartLine(first.rstrip("\r"))
+            if len(self.startLines) < MAX_START_LINES:
+                self.startLines[first] = start
+
+        # Build the packet directly, skipping the constructor chain
+        packet = self.packetType.__new__(self.packetType)
+        packet.header = self.headerType(start)
+        packet.body = b""
+        packet.headers = headers = {}
+        for line in lines[1:]:
+            key, sep, value = line.partition(":")
+            if sep:
+                key = key.strip()
+                # Header names are case-insensitive, and the framing depends on this one
+                if key.lower() == "content-length":
+                    key = "Content-Length"
+                headers[key] = value.strip()
+
+        return packet
+
+    def _parseStartLine(self, line: str):
+        parts = line.split(" ", 2)
+
+        if self.packetType is RtspRequest:
+            if len(parts) < 3 or parts[2] != RTSP_VERSION:
+                raise ValueError("Invalid RTSP request line")
+            return RtspMethod[parts[0]], parts[1]
+
+        if len(parts) < 2 or parts[0] != RTSP_VERSION:
+            raise ValueError("Invalid RTSP response line")
+        return STATUS_TO_CODE[parts[1]]
@@ -1,6 +1,13 @@
-import sys, socket
+import sys, socket, logging
 
 from ServerWorker import ServerWorker
+from AsyncServer import AsyncServer
+from Broadcast import LiveChannels
+from FrameCache import FrameCache
+from PreforkServer import PreforkServer
+from Metrics import MetricsServer
+from Profiler import Profiler
+from SessionRegistry import SessionRegistry
 
 
 class Server:
@@ -9,7 +16,57 @@ class Server:
         try:
             SERVER_PORT = int(sys.argv[1])
         except:
-            print("[Usage: Server.py Server_port]\n")
+            print(
+                "[Usage: Server.py Server_port [--async | --workers=N] [--live] [--cache=MB]"
+                " [--metrics=PORT] [--log=LEVEL]]\n"
+            )
+
+        # Logging is off below warnings unless asked for, so the hot path
+        # doesn't format messages nobody reads
+        level = "WARNING"
+        metricsPort = None
+        for arg in sys.argv[2:]:
+            if arg.startswith("--log="):
+                level = arg[len("--log=") :].upper()
+            elif arg.startswith("--metrics="):
+                metricsPort = int(arg[len("--metrics=") :])
+        logging.basicConfig(
+            level=level, format="%(asctime)s %(process)d %(name)s %(levelname)s: %(message)s"
+        )
+
+        # Memory budget of the packetized frame cache shared by all sessions
+        for arg in sys.argv[2:]:
+            if arg.startswith("--cache="):
+                FrameCache.shared().resize(int(float(arg[len("--cache=") :]) * 1024 * 1024))
+
+        # Live mode broadcasts each video to all its viewers at once
+        live = "--live" in sys.argv[2:]
+
+        # Pre-forked worker processes, each with its own GIL, and its own
+        # metrics endpoint on the ports counting up from PORT
+        for arg in sys.argv[2:]:
+            if arg.startswith("--workers="):
+                PreforkServer(
+                    SERVER_PORT, int(arg[len("--workers=") :]), live, metricsPort
+                ).main()
+                return
+
+        # Prometheus text on localhost
+        if metricsPort is not None:
+            MetricsServer(metricsPort).start()
+
+        # SIGUSR1 starts and stops profiling
+        Profiler.shared().installSignal()
+
+        if "--async" in sys.argv[2:]:
+            AsyncServer(SERVER_PORT, live).main()
+            return
+
+        liveChannels = LiveChannels() if live else None
+
+        # Idle sessions and dead connections are timed out and torn down
+        SessionRegistry.shared().start()
+
         rtspSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         rtspSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         rtspSocket.bind(("", SERVER_PORT))
@@ -19,7 +76,7 @@ class Server:
         while True:
             clientInfo = {}
             clientInfo["rtspSocket"] = rtspSocket.accept()
-            ServerWorker(clientInfo).run()
+            ServerWorker(clientInfo, liveChannels=liveChannels).run()
 
 
 if __name__ == "__main__":
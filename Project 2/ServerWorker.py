@@ -1,9 +1,104 @@
+import os
+import ipaddress
+import logging
 from random import randint
-import sys, traceback, threading, socket
+from time import monotonic, perf_counter
+import sys, traceback, threading, socket, struct
 
 from VideoStream import VideoStream
-from RtspPacket import RtspMethod, RtspRequest, RtspResponse, RtspStatus
-from RtpPacket import RtpPacket
+from QualityLadder import QualityLadder
+from FrameCache import FrameCache
+from RtspPacket import RtspMethod, RtspRequest, RtspResponseBuilder, RtspStatus
+from SessionRegistry import SessionRegistry
+from RtpPacket import RtpEncoder, RTP_CLOCK_RATE, restamp
+from FrameScheduler import FrameScheduler
+from UdpSender import BatchSender
+from RtspParser import RtspParser
+from RtcpPacket import RtcpPacket, ntpTime
+from RtcpSession import RTCP_INTERVAL, SessionQuality, SocketRtcpChannel
+from Interleaved import InterleavedFrame, InterleavedSender
+from Metrics import Registry
+from Profiler import Profiler
+import Interleaved
+import JpegPayload
+
+RTSP_RECV_SIZE = 4096
+
+log = logging.getLogger(__name__)
+
+metrics = Registry.shared()
+FRAMES_SENT = metrics.counter("rtp_frames_sent_total", "Video frames sent to clients")
+PACKETS_SENT = metrics.counter("rtp_packets_sent_total", "RTP packets sent to clients")
+BYTES_SENT = metrics.counter("rtp_payload_bytes_sent_total", "RTP payload bytes sent to clients")
+SEND_ERRORS = metrics.counter("rtp_send_errors_total", "Frames that failed to send")
+SEND_SECONDS = metrics.histogram("rtp_send_seconds", "Time to send the packets of one frame")
+RTSP_SECONDS = metrics.histogram(
+    "rtsp_request_seconds", "Time to process an RTSP request", ("method",)
+)
+
+# Methods listed in the reply to OPTIONS
+PUBLIC_METHODS = ", ".join(method.value for method in RtspMethod)
+
+STATE_NAMES = ("init", "ready", "playing")
+
+
+def sessionStates():
+    counts = {(name,): 0 for name in STATE_NAMES}
+    for worker in SessionRegistry.shared().sessions():
+        counts[(STATE_NAMES[worker.state],)] += 1
+    return counts
+
+
+def sessionValues(read):
+    """Collect one value from every set up session, keyed by session ID.
+
+    Sessions `read` returns None for are left out.
+    """
+    values = {}
+    for worker in SessionRegistry.shared().sessions():
+        clientInfo = worker.clientInfo
+        if "session" in clientInfo:
+            value = read(clientInfo)
+            if value is not None:
+                values[(clientInfo["session"],)] = value
+    return values
+
+
+def qualityValue(name):
+    """Read a figure of a session's quality, or None before its first SETUP succeeds."""
+
+    def read(clientInfo):
+        quality = clientInfo.get("quality")
+        return None if quality is None else getattr(quality, name)
+
+    return read
+
+
+metrics.gauge("rtsp_sessions", "Connected sessions by state", sessionStates, ("state",))
+metrics.gauge(
+    "rtp_session_packets_sent",
+    "RTP packets sent in each session",
+    lambda: sessionValues(lambda info: info.get("rtpPackets", 0)),
+    ("session",),
+)
+metrics.gauge(
+    "rtp_session_payload_bytes_sent",
+    "RTP payload bytes sent in each session",
+    lambda: sessionValues(lambda info: info.get("rtpOctets", 0)),
+    ("session",),
+)
+metrics.gauge(
+    "rtp_session_fraction_lost",
+    "Fraction of packets lost in each session, from its last receiver report",
+    lambda: sessionValues(qualityValue("fractionLost")),
+    ("session",),
+)
+metrics.gauge(
+    "rtp_session_jitter_seconds",
+    "Interarrival jitter in each session, from its last receiver report",
+    lambda: sessionValues(qualityValue("jitter")),
+    ("session",),
+)
 
 
 class ServerWorker:
@@ -20,204 +115,624 @@ class ServerWorker:
     OK_200 = 0
     FILE_NOT_FOUND_404 = 1
     CON_ERR_500 = 2
+    FORBIDDEN_403 = 3
+    PARAM_NOT_UNDERSTOOD_451 = 4
+    BAD_REQUEST_400 = 5
+    UNSUPPORTED_TRANSPORT_461 = 6
+
+    CODE_TO_STATUS = {
+        OK_200: RtspStatus.OK,
+        FILE_NOT_FOUND_404: RtspStatus.NOT_FOUND,
+        CON_ERR_500: RtspStatus.CONNECTION_ERROR,
+        FORBIDDEN_403: RtspStatus.FORBIDDEN,
+        PARAM_NOT_UNDERSTOOD_451: RtspStatus.PARAMETER_NOT_UNDERSTOOD,
+        BAD_REQUEST_400: RtspStatus.BAD_REQUEST,
+        UNSUPPORTED_TRANSPORT_461: RtspStatus.UNSUPPORTED_TRANSPORT,
+    }
+
+    # Whether a new RTSP connection can carry on a session of this server
+    REATTACHABLE = False
 
     clientInfo = {}
 
-    def __init__(self, clientInfo):
+    def __init__(
+        self,
+        clientInfo,
+        scheduler=None,
+        rtcpChannel=None,
+        liveChannels=None,
+        cache=None,
+        registry=None,
+    ):
         self.clientInfo = clientInfo
+        self.scheduler = scheduler
+        self.rtcpChannel = rtcpChannel
+        self.cache = cache
+        # Sessions join a shared broadcast of their video instead of
+        # streaming it on their own
+        self.liveChannels = liveChannels
+        self.parser = RtspParser(RtspRequest)
+        self.replyBuilder = RtspResponseBuilder()
+        # RTSP replies and interleaved RTP share the connection
+        self.sendLock = threading.Lock()
+        # Starts or stops the profiler for the last SET_PARAMETER
+        self.profilerThread = None
+        # Idle sessions are timed out and reaped by the registry
+        self.registry = registry if registry is not None else SessionRegistry.shared()
+        self.touch()
+        self.registry.add(self)
 
     def run(self):
         threading.Thread(target=self.recvRtspRequest).start()
 
     def recvRtspRequest(self):
-        """Receive RTSP request from the client."""
+        """Receive RTSP requests from the client until the connection ends."""
         connSocket = self.clientInfo["rtspSocket"][0]
         while True:
             try:
-                data = connSocket.recv(256).decode()
-            except ConnectionResetError:
-                print("xy: Connection reset by peer")
-            if data:
-                print("Data received:\n" + data)
-                self.processRtspRequest(data)
-
-    def processRtspRequest(self, data):
-        """Process RTSP request sent from the client."""
-        # Get the request type
-        request = RtspRequest.decode(data)
-
-        print("xy request in ServerWorker: ", request)
-
+                data = connSocket.recv(RTSP_RECV_SIZE)
+            except OSError as e:  # Reset by the client, or closed on timeout
+                log.info("RTSP connection lost: %s", e)
+                break
+            if not data:
+                break
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Data received:\n%s", data.decode(errors="replace"))
+            try:
+                self.feedRtsp(data)
+            except Exception as e:
+                log.warning("failed to process RTSP request: %s", e)
+        self.disconnect(connSocket)
+
+    def touch(self):
+        """Note activity from the client, putting off the session timeout."""
+        self.lastActivity = self.registry.clock()
+
+    def disconnect(self, connSocket):
+        """Clean up after an RTSP connection closed or failed.
+
+        Where a new connection can take over a session (REATTACHABLE), one
+        streaming over UDP outlives its connection, as RTSP allows, until it
+        times out. Anything else ends with the connection.
+        """
+        self.closeConnection(connSocket)
+        if self.clientInfo.get("rtspSocket", (None,))[0] is not connSocket:
+            return  # The session moved to another connection
+        if (
+            self.REATTACHABLE
+            and self.state != self.INIT
+            and "interleaved" not in self.clientInfo
+        ):
+            log.info("session %s lost its connection", self.clientInfo.get("session"))
+            return
+        self.stopRtp()
+        self.closeRtp()
+        self.state = self.INIT
+        self.registry.discard(self)
+
+    def expire(self):
+        """End a session that timed out, with its connection."""
+        self.stopRtp()
+        self.closeRtp()
+        self.state = self.INIT
+        self.closeConnection(self.clientInfo.get("rtspSocket", (None,))[0])
+
+    def closeConnection(self, connSocket):
+        """Close an RTSP connection, waking the thread reading from it."""
+        if connSocket is None:
+            return
+        try:
+            connSocket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # Already gone
+        connSocket.close()
+
+    def feedRtsp(self, data):
+        """Process every complete RTSP request in a chunk of received bytes."""
+        for message in self.parser.feed(data):
+            self.processMessage(message)
+
+    def processMessage(self, message):
+        """Process an RTSP request or a packet interleaved on the connection."""
+        self.touch()
+        if isinstance(message, InterleavedFrame):
+            if message.channel == self.clientInfo.get("interleaved", (None, None))[1]:
+                self.receiveRtcp(message.payload)
+        else:
+            self.processRtspRequest(message)
+
+    def processRtspRequest(self, request):
+        """Process RTSP request sent from the client, timing it by method."""
+        start = perf_counter()
+        try:
+            self.handleRtspRequest(request)
+        finally:
+            RTSP_SECONDS.observe(perf_counter() - start, (request.method().value,))
+
+    def handleRtspRequest(self, request):
+        """Run an RTSP request through the session's state machine."""
+        log.debug("request: %s", request)
 
         seq = request.get_header("CSeq")
 
         if seq is None:
             raise ValueError("CSeq header is missing")
 
-        # Get the RTSP sequence number
-        print("xy seq in ServerWorker: ", seq)
-
         # Process SETUP request
         if request.method() == RtspMethod.SETUP:
             if self.state == self.INIT:
                 # Update state
-                print("processing SETUP\n")
+                log.debug("processing SETUP")
 
+                # Get the RTP/UDP ports or interleaved channels the client asked for
+                transport = request.get_header("Transport")
+                if transport is None:
+                    self.replyRtsp(self.BAD_REQUEST_400, seq)
+                    return
                 try:
-                    self.clientInfo["videoStream"] = VideoStream(request.filename())
-                    self.state = self.READY
-
-                    # Generate a randomized RTSP session ID
-                    self.clientInfo["session"] = randint(100000, 999999)
+                    channels, ports = self.parseTransport(transport)
+                except ValueError as e:
+                    log.info("unsupported transport %r: %s", transport, e)
+                    self.replyRtsp(self.UNSUPPORTED_TRANSPORT_461, seq)
+                    return
 
-                    # Send RTSP reply
-                    self.replyRtsp(self.OK_200, seq)
-
-                    # Get the RTP/UDP port used by client from the last line of client request
-                    #
-                    transport = request.get_header("Transport")
-
-                    if transport is None:
-                        raise ValueError("Transport header is missing")
-
-                    # Parse port from transport
-                    port_str = transport.split("client_port=")[1]
+                try:
+                    # Lower quality tiers of the video, if generated, are
+                    # switched between as the client's reports come in
+                    self.clientInfo["ladder"] = QualityLadder(request.filename())
+                    self.clientInfo["videoStream"] = self.clientInfo["ladder"].stream()
+                    self.clientInfo["videoKey"] = os.path.realpath(request.filename())
 
-                    print("xy: found port string", port_str)
+                    # Generate a randomized RTSP session ID
+                    session = self.newSessionId()
+
+                    # Validate the RTP header fields once for the whole session
+                    self.clientInfo["ssrc"] = randint(0, 0xFFFFFFFF)
+                    self.rtpEncoder()
+
+                    if channels is not None:
+                        self.clientInfo["interleaved"] = channels
+                    else:
+                        self.clientInfo["rtpPort"], self.clientInfo["rtcpPort"] = ports
+                    self.openRtp()
+
+                    # Only a session that is set up is counted, and its
+                    # client's receiver reports update its quality
+                    self.clientInfo["quality"] = SessionQuality()
+                    self.clientInfo["session"] = session
+                    self.state = self.READY
+                    if channels is None:
+                        self.rtcp().register(self.clientInfo["ssrc"], self)
 
-                    self.clientInfo['rtpPort'] = int(port_str)
-                    print("xy: self.clientInfo['rtpPort']", self.clientInfo["rtpPort"])
+                    # Send RTSP reply, with the timeout the client must keep within
+                    self.replyRtsp(
+                        self.OK_200, seq, {"Transport": self.transport()}, timeout=True
+                    )
 
                 except IOError:
+                    self.closeVideo()
                     self.replyRtsp(self.FILE_NOT_FOUND_404, seq)
 
         # Process PLAY request
         elif request.method() == RtspMethod.PLAY:
             if self.state == self.READY:
-                print("processing PLAY\n")
+                log.debug("processing PLAY")
                 self.state = self.PLAYING
 
-                # Fill in start
-                # Create a new socket for RTP based on UDP
-                self.clientInfo["rtpSocket"] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                # Fill in end
+                # Jump straight to the requested position using the frame index
+                start = self.parseRange(request.get_header("Range"))
+                if start is not None:
+                    self.clientInfo["videoStream"].seekTime(start)
 
                 self.replyRtsp(self.OK_200, seq)
-
-                # Create a new thread and start sending RTP packets
-                self.clientInfo["event"] = threading.Event()
-                self.clientInfo["worker"] = threading.Thread(target=self.sendRtp)
-                self.clientInfo["worker"].start()
+                self.startRtp()
 
         # Process PAUSE request
         elif request.method() == RtspMethod.PAUSE:
             if self.state == self.PLAYING:
-                print("processing PAUSE\n")
+                log.debug("processing PAUSE")
                 self.state = self.READY
-
-                # self.clientInfo['event'].set()
-                # Handle the error gracefully, such as logging the error or notifying the user
-                if "event" in self.clientInfo:
-                    self.clientInfo["event"].set()
-                else:
-                    print(
-                        "xy Error: 'event' key does not exist in clientInfo dictionary"
-                    )
+                self.stopRtp()
 
                 self.replyRtsp(self.OK_200, seq)
 
         # Process TEARDOWN request
         elif request.method() == RtspMethod.TEARDOWN:
-            print("processing TEARDOWN\n")
-
-            # Handle the error gracefully, such as logging the error or notifying the user
-            if "event" in self.clientInfo:
-                self.clientInfo["event"].set()
-            else:
-                print("xy Error: 'event' key does not exist in clientInfo dictionary")
+            log.debug("processing TEARDOWN")
+            self.stopRtp()
 
             self.replyRtsp(self.OK_200, seq)
+            self.closeRtp()
+            self.state = self.INIT
+
+        # Process SET_PARAMETER request, in any state
+        elif request.method() == RtspMethod.SET_PARAMETER:
+            self.replyRtsp(self.setParameters(request.body), seq)
 
-            # Close the RTP socket
-            # Handle the error gracefully, such as logging the error or notifying the user
-            if "rtpSocket" in self.clientInfo:
-                self.clientInfo["rtpSocket"].close()
+        # Process GET_PARAMETER request, a keepalive without a body
+        elif request.method() == RtspMethod.GET_PARAMETER:
+            if request.body.strip():
+                self.replyRtsp(self.PARAM_NOT_UNDERSTOOD_451, seq)
             else:
-                print(
-                    "xy Error: 'rtpSocket' key does not exist in clientInfo dictionary"
-                )
+                self.replyRtsp(self.OK_200, seq)
 
-    def sendRtp(self):
-        """Send RTP packets over UDP."""
-        while True:
-            self.clientInfo["event"].wait(0.05)
+        # Process OPTIONS request, also a keepalive
+        elif request.method() == RtspMethod.OPTIONS:
+            self.replyRtsp(self.OK_200, seq, {"Public": PUBLIC_METHODS})
+
+    def setParameters(self, body):
+        """Apply the `name: value` lines of a SET_PARAMETER body. Return the reply code.
+
+        The only parameter is `profiling: on|off`, which starts or stops the
+        server's profiler and is only taken from clients on this machine. An
+        empty body just keeps the session alive.
+        """
+        parameters = {}
+        for line in body.decode("latin-1").splitlines():
+            name, sep, value = line.partition(":")
+            if sep:
+                parameters[name.strip().lower()] = value.strip().lower()
+            elif line.strip():
+                return self.PARAM_NOT_UNDERSTOOD_451
+
+        unknown = set(parameters) - {"profiling"}
+        if unknown or parameters.get("profiling", "on") not in ("on", "off"):
+            return self.PARAM_NOT_UNDERSTOOD_451
+
+        if "profiling" in parameters:
+            if not self.isLocalClient():
+                return self.FORBIDDEN_403
+            profiler = Profiler.shared()
+            toggle = profiler.start if parameters["profiling"] == "on" else profiler.stop
+            # Stopping joins the sampler and writes a file, so not on the
+            # connection's thread or event loop
+            self.profilerThread = threading.Thread(target=toggle, name="profiler")
+            self.profilerThread.start()
+        return self.OK_200
+
+    def isLocalClient(self):
+        """Return True if the client connected from this machine."""
+        try:
+            return ipaddress.ip_address(self.clientInfo["rtspSocket"][1][0]).is_loopback
+        except (KeyError, IndexError, ValueError):
+            return False
+
+    def newSessionId(self):
+        """Return a randomized RTSP session ID."""
+        return randint(100000, 999999)
+
+    def openRtp(self):
+        """Open the session's RTP socket, so its port can go in the SETUP reply."""
+        if "interleaved" in self.clientInfo:
+            if "rtpSender" not in self.clientInfo:
+                self.clientInfo["rtpSender"] = InterleavedSender(
+                    self.clientInfo["rtspSocket"][0], self.sendLock
+                )
+            return
+
+        # Create a new socket for RTP based on UDP
+        if "rtpSocket" not in self.clientInfo:
+            self.clientInfo["rtpSocket"] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.clientInfo["rtpSocket"].bind(("", 0))
+            self.clientInfo["rtpSender"] = BatchSender(self.clientInfo["rtpSocket"])
+
+    def localRtpPort(self):
+        """Return the server port RTP is sent from."""
+        return self.clientInfo["rtpSocket"].getsockname()[1]
+
+    def transport(self):
+        """Return the Transport header of the SETUP reply."""
+        if "interleaved" in self.clientInfo:
+            rtp, rtcp = self.clientInfo["interleaved"]
+            return (
+                f"RTP/AVP/TCP;unicast;interleaved={rtp}-{rtcp};"
+                f"ssrc={self.clientInfo['ssrc']:08X}"
+            )
 
-            # Stop sending if request is PAUSE or TEARDOWN
-            if self.clientInfo["event"].isSet():
-                break
+        rtpPort = self.clientInfo["rtpPort"]
+        return (
+            f"RTP/UDP;client_port={rtpPort}-{self.clientInfo['rtcpPort']};"
+            f"server_port={self.localRtpPort()}-{self.rtcp().port()};"
+            f"ssrc={self.clientInfo['ssrc']:08X}"
+        )
 
-            data = self.clientInfo["videoStream"].nextFrame()
-            if data:
-                frameNumber = self.clientInfo["videoStream"].frameNbr()
-                try:
-                    address = self.clientInfo["rtspSocket"][1][0]
-                    port = int(self.clientInfo["rtpPort"])
-                    self.clientInfo["rtpSocket"].sendto(
-                        self.makeRtp(data, frameNumber), (address, port)
-                    )
-                except:
-                    print("Connection Error")
-                    # print '-'*60
-                    # traceback.print_exc(file=sys.stdout)
-                    # print '-'*60
+    def rtcp(self):
+        """Get the RTCP channel shared by the server's sessions."""
+        if self.rtcpChannel is None:
+            self.rtcpChannel = SocketRtcpChannel.shared()
+        return self.rtcpChannel
+
+    def startRtp(self):
+        """Start sending RTP packets to the client."""
+        self.openRtp()
+
+        if self.liveChannels is not None:
+            filename = self.clientInfo["videoStream"].filename
+            self.clientInfo["live"] = self.liveChannels.subscribe(filename, self)
+            return
+
+        # Frames are sent at the video frame rate by the shared scheduler
+        if self.scheduler is None:
+            self.scheduler = FrameScheduler.shared()
+        self.clientInfo["pacing"] = self.scheduler.add(self, 1 / self.frameRate())
+
+    def stopRtp(self):
+        """Stop sending RTP packets upon PAUSE or TEARDOWN."""
+        # Handle the error gracefully, such as logging the error or notifying the user
+        if "live" in self.clientInfo:
+            self.liveChannels.unsubscribe(self.clientInfo.pop("live"), self)
+        elif "pacing" in self.clientInfo:
+            self.scheduler.remove(self.clientInfo.pop("pacing"))
+        else:
+            log.debug("'pacing' key does not exist in clientInfo dictionary")
+
+    def closeRtp(self):
+        """Release the RTP socket and video of a torn down session."""
+        # Close the RTP socket
+        # Handle the error gracefully, such as logging the error or notifying the user
+        if "rtpSocket" in self.clientInfo:
+            self.clientInfo.pop("rtpSocket").close()
+            self.clientInfo.pop("rtpSender", None)
+        elif "interleaved" not in self.clientInfo:
+            log.debug("'rtpSocket' key does not exist in clientInfo dictionary")
+
+        self.closeVideo()
+        self.closeRtcp()
+
+    def closeVideo(self):
+        """Release this session's hold on the shared frame stores, once."""
+        ladder = self.clientInfo.pop("ladder", None)
+        stream = self.clientInfo.pop("videoStream", None)
+        if ladder is not None:
+            ladder.close()
+        elif stream is not None:
+            stream.close()
+
+    def closeRtcp(self):
+        """Stop routing the session's receiver reports to it."""
+        if "ssrc" in self.clientInfo and self.rtcpChannel is not None:
+            self.rtcpChannel.unregister(self.clientInfo["ssrc"])
+
+    def parseTransport(self, transport):
+        """Return the interleaved channels and client (RTP, RTCP) ports of a Transport header.
+
+        One of the two is None. Raise ValueError if the header names neither.
+        """
+        # RTP/AVP/TCP carries RTP and RTCP on the RTSP connection
+        channels = Interleaved.parseChannels(transport)
+        if channels is not None:
+            return channels, None
+        if "client_port=" not in transport:
+            raise ValueError("no client_port or interleaved channels")
+
+        # Parse ports from transport, RTCP defaults to the next one up
+        port_str = transport.split("client_port=")[1].split(";")[0]
+
+        log.debug("found port string %s", port_str)
+
+        ports = port_str.split("-")
+        rtpPort = int(ports[0])
+        return None, (rtpPort, int(ports[1]) if len(ports) > 1 else rtpPort + 1)
+
+    def parseRange(self, range):
+        """Return the start time in seconds of an npt Range header, if any."""
+        if range is None or not range.startswith("npt="):
+            return None
+
+        start = range[len("npt=") :].split("-")[0].strip()
+        if start in ("", "now"):
+            return None
+
+        try:
+            return float(start)
+        except ValueError:
+            return None
+
+    def sendFrame(self):
+        """Send the next video frame. Return False at the end of the video."""
+        # Change quality tier only between frames
+        ladder = self.clientInfo.get("ladder")
+        if ladder is not None and ladder.switch():
+            log.info(
+                "session %s switching to quality tier %d",
+                self.clientInfo.get("session"),
+                ladder.level,
+            )
+            self.clientInfo["videoStream"] = ladder.stream()
+
+        stream = self.clientInfo["videoStream"]
+        fragments = self.nextFragments(stream, ladder.level if ladder else 0)
+        if fragments is None:
+            return False
+
+        frameNumber = stream.frameNbr()
+        try:
+            self.timedSend(self.stampRtp(fragments, frameNumber))
+            self.sendReport()
+        except Exception as e:
+            SEND_ERRORS.inc()
+            log.debug("Connection Error: %s", e)
+        return True
+
+    def nextFragments(self, stream, tier):
+        """Get the next frame's fragments, or None at the end of the video."""
+        frameNumber = stream.frameNbr() + 1
+        if frameNumber > stream.frameCount():
+            return None
+
+        # Another session may already have read and fragmented this frame
+        cache = self.frameCache()
+        key = (self.clientInfo.get("videoKey", stream.filename), frameNumber, tier)
+        fragments = cache.get(key)
+        if fragments is not None:
+            stream.seek(frameNumber)
+            return fragments
+
+        data = stream.nextFrame()
+        if not data:
+            return None
+        return cache.put(key, JpegPayload.fragment(data))
+
+    def frameCache(self):
+        """Get the packetized frame cache shared by the server's sessions."""
+        if self.cache is None:
+            self.cache = FrameCache.shared()
+        return self.cache
+
+    def sendShared(self, packets, timestamp, octets):
+        """Send a broadcast frame, stamping this session's fields into its packets."""
+        seqnum = self.clientInfo.get("rtpSeq", 0)
+        ssrc = self.clientInfo["ssrc"]
+        for i, (packet,) in enumerate(packets):
+            restamp(packet, seqnum + i, ssrc)
+        self.clientInfo["rtpSeq"] = (seqnum + len(packets)) & 0xFFFF
+
+        self.countSent(timestamp, len(packets), octets)
+        self.timedSend(packets)
+        self.sendReport()
+
+    def countSent(self, timestamp, packets, octets):
+        """Update the sender report counters with a sent frame."""
+        self.clientInfo["rtpTimestamp"] = timestamp
+        self.clientInfo["rtpPackets"] = self.clientInfo.get("rtpPackets", 0) + packets
+        self.clientInfo["rtpOctets"] = self.clientInfo.get("rtpOctets", 0) + octets
+        FRAMES_SENT.inc()
+        PACKETS_SENT.inc(packets)
+        BYTES_SENT.inc(octets)
+
+    def timedSend(self, packets):
+        """Send a frame's packets, recording how long the send took."""
+        start = perf_counter()
+        self.sendPackets(packets)
+        SEND_SECONDS.observe(perf_counter() - start)
+
+    def sendPackets(self, packets):
+        """Send RTP packets, each given as a list of buffers, to the client."""
+        if "interleaved" in self.clientInfo:
+            self.clientInfo["rtpSender"].send(packets, self.clientInfo["interleaved"][0])
+            return
+
+        address = self.clientInfo["rtspSocket"][1][0]
+        port = int(self.clientInfo["rtpPort"])
+        # Packets go out in vectored sends, batched with UDP GSO where the
+        # kernel supports it, so the frame is never copied out of the shared
+        # memory map
+        self.clientInfo["rtpSender"].send(packets, (address, port))
+
+    def sendReport(self):
+        """Send an RTCP sender report if one is due."""
+        now = monotonic()
+        last = self.clientInfo.get("lastReport")
+        if last is not None and now - last < RTCP_INTERVAL:
+            return
+        self.clientInfo["lastReport"] = now
+
+        # The NTP time pairs with the RTP timestamp of the frame just sent
+        report = RtcpPacket.senderReport(
+            self.clientInfo["ssrc"],
+            ntpTime(),
+            self.clientInfo["rtpTimestamp"],
+            self.clientInfo["rtpPackets"],
+            self.clientInfo["rtpOctets"],
+        )
+        if "interleaved" in self.clientInfo:
+            # Sent like a frame, skipped rather than waited for if the
+            # connection is busy
+            channel = self.clientInfo["interleaved"][1]
+            self.clientInfo["rtpSender"].send([[report.encode()]], channel)
+            return
+
+        address = self.clientInfo["rtspSocket"][1][0]
+        self.rtcp().sendto(report.encode(), (address, self.clientInfo["rtcpPort"]))
+
+    def receiveRtcp(self, data):
+        """Take in the receiver reports of an RTCP packet sent on the connection."""
+        try:
+            packets = RtcpPacket.decodeCompound(data)
+        except (ValueError, struct.error):
+            return
+        for packet in packets:
+            for block in packet.blocks:
+                if block.ssrc == self.clientInfo.get("ssrc"):
+                    self.onReceiverReport(block)
+
+    def onReceiverReport(self, block):
+        """Update the session's quality record from a client receiver report."""
+        # Receiver reports show the client is still there, as RTSP allows
+        self.touch()
+        quality = self.clientInfo.get("quality")
+        if quality is None:  # SETUP has not succeeded
+            return
+        quality.update(block)
+        if "ladder" in self.clientInfo:
+            self.clientInfo["ladder"].onReport(quality, self.clientInfo.get("rtpOctets", 0))
 
     def makeRtp(self, payload, frameNbr):
-        """RTP-packetize the video data."""
-        version = 2
-        padding = 0
-        extension = 0
-        cc = 0
-        marker = 0
-        pt = 26  # MJPEG type
-        seqnum = frameNbr
-        ssrc = 0
-
-        rtpPacket = RtpPacket()
-
-        rtpPacket.encode(
-            version, padding, extension, cc, seqnum, marker, pt, ssrc, payload
+        """RTP-packetize the video data into MTU-sized packets."""
+        return self.stampRtp(JpegPayload.fragment(payload), frameNbr)
+
+    def stampRtp(self, fragments, frameNbr):
+        """Put this session's RTP headers on a frame's (JPEG header, data) fragments."""
+        # 90 kHz media clock, shared by every packet of the frame
+        timestamp = round(frameNbr * RTP_CLOCK_RATE / self.frameRate())
+
+        seqnum = self.clientInfo.get("rtpSeq", 0)
+        self.clientInfo["rtpSeq"] = (seqnum + len(fragments)) & 0xFFFF
+
+        self.countSent(
+            timestamp,
+            len(fragments),
+            sum(len(jpegHeader) + len(chunk) for jpegHeader, chunk in fragments),
         )
 
-        return rtpPacket.getPacket()
+        # The marker bit flags the last packet of the frame
+        headers = self.rtpEncoder().encodeFrame(len(fragments), seqnum, timestamp)
+
+        return [
+            [header, jpegHeader, chunk]
+            for header, (jpegHeader, chunk) in zip(headers, fragments)
+        ]
+
+    def frameRate(self):
+        """Get the frame rate of the session's video."""
+        stream = self.clientInfo.get("videoStream")
+        return stream.fps if stream is not None else VideoStream.FPS
+
+    def rtpEncoder(self):
+        """Get the session's RTP header encoder, creating it on first use."""
+        if "rtpEncoder" not in self.clientInfo:
+            version = 2
+            padding = 0
+            extension = 0
+            cc = 0
+            pt = 26  # MJPEG type
+            ssrc = self.clientInfo.get("ssrc", 0)
+            self.clientInfo["rtpEncoder"] = RtpEncoder(
+                version, padding, extension, cc, pt, ssrc
+            )
+        return self.clientInfo["rtpEncoder"]
 
-    def replyRtsp(self, code, seq):
-        """Send RTSP reply to the client."""
+    def replyRtsp(self, code, seq, headers=None, timeout=False):
+        """Send RTSP reply to the client, with the session timeout if asked."""
+        status = self.CODE_TO_STATUS[code]
         if code == self.OK_200:
-            # print "200 OK"
-            reply = (
-                "RTSP/1.0 200 OK\nCSeq: "
-                + seq
-                + "\nSession: "
-                + str(self.clientInfo["session"])
-            )
-            connSocket = self.clientInfo["rtspSocket"][0]
-            connSocket.send(reply.encode())
-
-        # Error messages
-        elif code == self.FILE_NOT_FOUND_404:
-            print("404 NOT FOUND")
-            # Fill in start
-            connSocket = self.clientInfo["rtspSocket"][0]
-            reply = RtspResponse(RtspStatus.NOT_FOUND)
-
-            connSocket.send(reply.encode().encode())
-            # Fill in end
-
-        elif code == self.CON_ERR_500:
-            print("500 CONNECTION ERROR")
-            # Fill in start
-            connSocket = self.clientInfo["rtspSocket"][0]
-            reply = RtspResponse(RtspStatus.CONNECTION_ERROR)
-
-            connSocket.send(reply.encode().encode())
-            # Fill in end
+            # Not set up yet for a SET_PARAMETER before SETUP
+            session = self.clientInfo.get("session")
+            if timeout and session is not None:
+                session = f"{session};timeout={self.registry.timeout}"
+        else:
+            # Error messages
+            log.info("replying %s", status.value)
+            session = None
+
+        self.sendRtsp(self.replyBuilder.build(status, seq, session, headers))
+
+    def sendRtsp(self, data):
+        """Write an encoded RTSP message to the client's connection."""
+        if "interleaved" in self.clientInfo and "rtpSender" in self.clientInfo:
+            # Never in the middle of a partly sent RTP frame
+            self.clientInfo["rtpSender"].sendMessage(data)
+            return
+        connSocket = self.clientInfo["rtspSocket"][0]
+        with self.sendLock:
+            connSocket.sendall(data)
@@ -0,0 +1,85 @@
+import logging
+import threading
+from time import monotonic, sleep
+
+# Seconds a session may go without a request or receiver report, the
+# RTSP default advertised in the Session header of the SETUP reply
+SESSION_TIMEOUT = 60
+
+# Seconds between checks for idle sessions
+REAP_INTERVAL = 5.0
+
+log = logging.getLogger(__name__)
+
+
+class SessionRegistry:
+    """Every connected RTSP session of a server process.
+
+    A worker joins when its connection is accepted and leaves once its
+    session is closed, whether by TEARDOWN, by its connection going away or
+    by `reap`. Workers note each request, keepalive and receiver report with
+    `touch`; `reap` expires those idle for longer than `timeout`, which
+    stops their stream and releases their sockets, video and thread.
+
+    `start` reaps from a thread of its own; an event loop can instead call
+    `reap` from a timer.
+    """
+
+    _shared = None
+    _sharedLock = threading.Lock()
+
+    def __init__(self, timeout=SESSION_TIMEOUT, clock=monotonic):
+        self.timeout = timeout
+        self.clock = clock
+        self.workers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @classmethod
+    def shared(cls) -> "SessionRegistry":
+        """Return the process-wide registry."""
+        with cls._sharedLock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def add(self, worker):
+        with self.lock:
+            self.workers.add(worker)
+
+    def discard(self, worker):
+        with self.lock:
+            self.workers.discard(worker)
+
+    def sessions(self):
+        """Return a snapshot of the registered workers."""
+        with self.lock:
+            return list(self.workers)
+
+    def reap(self):
+        """Expire every session idle for longer than the timeout. Return how many."""
+        deadline = self.clock() - self.timeout
+        with self.lock:
+            idle = [worker for worker in self.workers if worker.lastActivity < deadline]
+            self.workers.difference_update(idle)
+
+        for worker in idle:
+            log.info("session %s timed out", worker.clientInfo.get("session"))
+            try:
+                worker.expire()
+            except Exception as e:
+                log.warning("failed to close session: %s", e)
+        return len(idle)
+
+    def start(self):
+        """Reap idle sessions from a daemon thread, once."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name="reaper", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            sleep(REAP_INTERVAL)
+            self.reap()
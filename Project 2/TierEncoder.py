@@ -0,0 +1,49 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from Packager import package
+from QualityLadder import tierPath
+
+# (scale, JPEG quality) of each tier below the original, best first
+DEFAULT_TIERS = [(1.0, 50), (0.75, 40), (0.5, 30)]
+
+
+def writeTier(source, dest, scale, quality, executor=None):
+    """Write every frame of `source`, re-encoded, to `dest` as a binary container."""
+    package(source, dest, quality=quality, scale=scale, executor=executor)
+
+
+def parseTier(value):
+    scale, _, quality = value.partition(":")
+    return float(scale), int(quality)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate lower quality tiers of an .Mjpeg video for adaptive streaming"
+    )
+    parser.add_argument("video")
+    parser.add_argument(
+        "-t",
+        "--tier",
+        type=parseTier,
+        action="append",
+        metavar="SCALE:QUALITY",
+        help="a tier below the original, best first (default: 1.0:50 0.75:40 0.5:30)",
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=os.cpu_count(), help="encoding processes"
+    )
+    args = parser.parse_args()
+
+    # Frames of every tier are encoded across all cores
+    with ProcessPoolExecutor(args.workers) as executor:
+        for level, (scale, quality) in enumerate(args.tier or DEFAULT_TIERS, start=1):
+            dest = tierPath(args.video, level)
+            writeTier(args.video, dest, scale, quality, executor)
+            print(f"{dest}: scale {scale}, quality {quality}, {os.path.getsize(dest):,} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import errno
+import socket
+import struct
+
+# Linux UDP generic segmentation offload, see udp(7)
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+
+# The kernel accepts at most 64 segments and one UDP datagram worth of data
+# per GSO send
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65507
+
+SEGMENT_SIZE = struct.Struct("=H")
+
+
+def gsoSupported(sock) -> bool:
+    """Return True if the kernel supports UDP_SEGMENT on `sock`."""
+    if not hasattr(sock, "sendmsg"):
+        return False
+    try:
+        sock.setsockopt(SOL_UDP, UDP_SEGMENT, 0)
+    except OSError:
+        return False
+    return True
+
+
+class BatchSender:
+    """Send the RTP packets of a frame with as few syscalls as possible.
+
+    Packets are given as lists of buffers, as built by ServerWorker.makeRtp.
+    With UDP GSO every run of equal sized packets, plus a shorter trailing
+    one, goes to the kernel in a single scatter-gather `sendmsg` that the
+    kernel splits into datagrams. Without it each packet is one `sendmsg`.
+    """
+
+    def __init__(self, sock, gso=None):
+        self.sock = sock
+        self.gso = gsoSupported(sock) if gso is None else gso
+        self.calls = 0
+        # Packets of the frame being sent that have gone out
+        self.sentPackets = 0
+
+    def send(self, packets, address):
+        """Send every packet to `address`.
+
+        If a send fails, `sentPackets` is how many went out before it.
+        """
+        self.sentPackets = 0
+        if self.gso and len(packets) > 1:
+            try:
+                self._sendGso(packets, address)
+                return
+            except OSError as e:
+                # EIO means the device can't offload checksums for GSO
+                if e.errno not in (errno.EIO, errno.EINVAL, errno.ENOPROTOOPT):
+                    raise
+                self.gso = False
+
+        # Only the packets GSO didn't get out
+        self._sendEach(packets, address)
+
+    def _sendEach(self, packets, address):
+        for packet in packets[self.sentPackets :]:
+            self.sock.sendmsg(packet, (), 0, address)
+            self.calls += 1
+            self.sentPackets += 1
+
+    def _sendGso(self, packets, address):
+        sizes = [sum(len(buffer) for buffer in packet) for packet in packets]
+
+        start = 0
+        while start < len(packets):
+            segment = sizes[start]
+            end = start + 1
+            total = segment
+            # Extend the batch while packets match the first one's size. A
+            # single shorter packet may close the batch.
+            while (
+                end < len(packets)
+                and end - start < GSO_MAX_SEGMENTS
+                and total + sizes[end] <= GSO_MAX_BYTES
+                and sizes[end] <= segment
+            ):
+                total += sizes[end]
+                end += 1
+                if sizes[end - 1] < segment:
+                    break
+
+            if end - start == 1:
+                self.sock.sendmsg(packets[start], (), 0, address)
+            else:
+                buffers = [buffer for packet in packets[start:end] for buffer in packet]
+                self.sock.sendmsg(
+                    buffers,
+                    [(SOL_UDP, UDP_SEGMENT, SEGMENT_SIZE.pack(segment))],
+                    0,
+                    address,
+                )
+            self.calls += 1
+            self.sentPackets = end
+            start = end
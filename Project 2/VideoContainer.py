@@ -0,0 +1,140 @@
+import os
+import struct
+from fractions import Fraction
+from typing import NamedTuple
+
+from FrameIndex import INDEX_ENTRY, FrameEntry, FrameIndex, MappedEntries
+
+# Binary MJPEG container, all little-endian:
+#
+#   header    magic, version, flags, fps as a fraction, width, height,
+#             frame count, offset of the index (0 until the file is finished)
+#   frames    a 4-byte length and the JPEG data, for every frame
+#   index     offset of the data, length and number of every frame, in the
+#             same entry layout as the .idx files of .Mjpeg videos
+CONTAINER_MAGIC = b"MJVC"
+CONTAINER_VERSION = 1
+CONTAINER_HEADER = struct.Struct("<4sHHIIIIIQ")
+FRAME_LENGTH = struct.Struct("<I")
+
+# Frame lengths are 32-bit
+MAX_FRAME_SIZE = 2**32 - 1
+
+
+class ContainerHeader(NamedTuple):
+    fps: Fraction
+    width: int
+    height: int
+    frameCount: int
+    indexOffset: int
+
+
+def isContainer(data) -> bool:
+    """Return True if `data`, the start of a video, is a binary container."""
+    return bytes(data[: len(CONTAINER_MAGIC)]) == CONTAINER_MAGIC
+
+
+def readHeader(data) -> ContainerHeader:
+    if len(data) < CONTAINER_HEADER.size:
+        raise ValueError("Truncated container header")
+    magic, version, _, fpsNum, fpsDen, width, height, count, indexOffset = (
+        CONTAINER_HEADER.unpack_from(data)
+    )
+    if magic != CONTAINER_MAGIC or version != CONTAINER_VERSION:
+        raise ValueError("Not a version %d container" % CONTAINER_VERSION)
+    if not fpsNum or not fpsDen:
+        raise ValueError("Invalid frame rate")
+    return ContainerHeader(Fraction(fpsNum, fpsDen), width, height, count, indexOffset)
+
+
+def containerIndex(data, header: ContainerHeader) -> FrameIndex:
+    """Index a container from its trailing index, mapped in place.
+
+    A container whose writer never finished has no index yet, so its frames
+    are found by walking their lengths instead.
+    """
+    end = header.indexOffset + header.frameCount * INDEX_ENTRY.size
+    if header.indexOffset and end <= len(data):
+        return FrameIndex(MappedEntries(data, header.frameCount, header.indexOffset))
+
+    entries = []
+    offset = CONTAINER_HEADER.size
+    while offset + FRAME_LENGTH.size <= len(data):
+        (length,) = FRAME_LENGTH.unpack_from(data, offset)
+        offset += FRAME_LENGTH.size
+        if offset + length > len(data):
+            break  # Truncated last frame
+        entries.append(FrameEntry(offset, length, len(entries) + 1))
+        offset += length
+    return FrameIndex(entries)
+
+
+class ContainerWriter:
+    """Writes frames to a new binary container.
+
+    The video goes to a temp file next to `filename`, which replaces it on
+    `close`, once the index and the final header have been written. Width
+    and height can be set any time before then, say from the first frame.
+    """
+
+    def __init__(self, filename, fps, width=0, height=0):
+        self.filename = filename
+        self.fps = Fraction(fps).limit_denominator(1001)
+        self.width = width
+        self.height = height
+        self.entries = []
+        self.tmp = filename + ".tmp"
+        self.file = open(self.tmp, "wb")
+        # Without an index yet, so readers scan the frames written so far
+        self.file.write(self.header(0))
+        self.offset = CONTAINER_HEADER.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+
+    def header(self, indexOffset) -> bytes:
+        return CONTAINER_HEADER.pack(
+            CONTAINER_MAGIC,
+            CONTAINER_VERSION,
+            0,
+            self.fps.numerator,
+            self.fps.denominator,
+            self.width,
+            self.height,
+            len(self.entries),
+            indexOffset,
+        )
+
+    def write(self, frame):
+        if len(frame) > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame {len(self.entries) + 1} is larger than 4 GiB.")
+        self.file.write(FRAME_LENGTH.pack(len(frame)))
+        self.file.write(frame)
+        self.offset += FRAME_LENGTH.size
+        self.entries.append(FrameEntry(self.offset, len(frame), len(self.entries) + 1))
+        self.offset += len(frame)
+
+    def close(self):
+        """Finish the container and move it into place."""
+        index = bytearray(len(self.entries) * INDEX_ENTRY.size)
+        for i, entry in enumerate(self.entries):
+            INDEX_ENTRY.pack_into(index, i * INDEX_ENTRY.size, *entry)
+        self.file.write(index)
+
+        self.file.seek(0)
+        self.file.write(self.header(self.offset))
+        self.file.close()
+        os.replace(self.tmp, self.filename)
+
+    def abort(self):
+        """Drop the unfinished container."""
+        self.file.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
@@ -1,23 +1,129 @@
+import mmap
+import os
+import threading
+
+import VideoContainer
+from FrameIndex import FrameIndex
+
+
+class FrameStore:
+    """A read-only memory map of a video shared by every session playing it.
+
+    Stores are reference counted per filename. `acquire` maps the file the
+    first time it is requested and `release` unmaps it once the last session
+    has let go, so any number of viewers of one file share the same pages.
+
+    Both the binary container and the original 5-digit length-prefixed
+    .Mjpeg format are read; only a container carries its frame rate and
+    size, in `header`.
+    """
+
+    _stores = {}
+    _lock = threading.Lock()
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.refs = 0
+        self.header = None
+        with open(filename, "rb") as file:
+            try:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty files cannot be mapped
+                self.map = b""
+
+            if VideoContainer.isContainer(self.map):
+                try:
+                    self.header = VideoContainer.readHeader(self.map)
+                except ValueError as e:
+                    raise OSError(f"{filename}: {e}")
+                self.index = VideoContainer.containerIndex(self.map, self.header)
+            else:
+                self.index = FrameIndex.open(filename, file)
+        self.view = memoryview(self.map)
+
+    @classmethod
+    def acquire(cls, filename):
+        """Get the shared store for `filename`, mapping it if needed."""
+        key = os.path.realpath(filename)
+        with cls._lock:
+            store = cls._stores.get(key)
+            if store is None:
+                store = cls(key)
+                cls._stores[key] = store
+            store.refs += 1
+            return store
+
+    def release(self):
+        """Drop a reference, unmapping the file after the last one."""
+        with self._lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            del self._stores[self.filename]
+
+        self.view.release()
+        if isinstance(self.map, mmap.mmap):
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # Frames still being sent, the map is freed with them
+        self.index.close()
+
+    def frame(self, i):
+        """Return frame `i` (0-based) as a zero-copy memoryview."""
+        entry = self.index[i]
+        return self.view[entry.offset : entry.offset + entry.length]
+
+
 class VideoStream:
+    # Frame rate of videos that don't say
+    FPS = 20
+
     def __init__(self, filename):
         self.filename = filename
         try:
-            self.file = open(filename, "rb")
-        except:
+            self.store = FrameStore.acquire(filename)
+        except OSError:
             raise IOError
+        self.index = self.store.index
         self.frameNum = 0
 
+        header = self.store.header
+        self.fps = float(header.fps) if header else self.FPS
+        self.width = header.width if header else None
+        self.height = header.height if header else None
+
     def nextFrame(self):
         """Get next frame."""
-        data = self.file.read(5)  # Get the framelength from the first 5 bits
-        if data:
-            framelength = int(data)
+        if self.frameNum >= len(self.index):
+            return b""
 
-            # Read the current frame
-            data = self.file.read(framelength)
-            self.frameNum += 1
+        data = self.store.frame(self.frameNum)
+        self.frameNum += 1
         return data
 
     def frameNbr(self):
         """Get frame number."""
         return self.frameNum
+
+    def frameCount(self):
+        """Get the total number of frames in the video."""
+        return len(self.index)
+
+    def duration(self):
+        """Get the video duration in seconds."""
+        return self.frameCount() / self.fps
+
+    def seek(self, frameNbr):
+        """Move so the next call to nextFrame returns frame `frameNbr` + 1."""
+        self.frameNum = max(0, min(int(frameNbr), self.frameCount()))
+
+    def seekTime(self, seconds):
+        """Move to the frame playing at `seconds` into the video."""
+        self.seek(seconds * self.fps)
+
+    def close(self):
+        """Release the shared frame store."""
+        if self.store is not None:
+            self.store.release()
+            self.store = None
@@ -0,0 +1,465 @@
+import argparse
+import functools
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from Broadcast import BroadcastChannel
+from FrameCache import FrameCache
+from FrameIndex import FrameIndex, LENGTH_PREFIX_SIZE
+from LoadGenerator import LoadGenerator
+from RtpPacket import RtpEncoder, RtpPacket, restamp
+from RtspPacket import RtspRequest, RtspResponse, RtspResponseBuilder, RtspStatus
+from RtspParser import RtspParser
+from ServerWorker import ServerWorker
+from UdpSender import BatchSender, gsoSupported
+from VideoStream import VideoStream
+
+BENCHMARKS = {}
+
+# A metric regresses when it is this much worse than its baseline
+DEFAULT_THRESHOLD = 0.10
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Server.py")
+
+# First RTP port of the loopback benchmark's viewers
+LOOPBACK_BASE_PORT = 41000
+
+
+def benchmark(name):
+    """Register a benchmark. It returns a dict of metric name to value."""
+
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+
+    return register
+
+
+def cpuRate(fn, count, repeat=5):
+    """Run fn() `count` times per round and return the best calls per CPU second."""
+    best = 0.0
+    per_round = max(1, count // repeat)
+    for _ in range(repeat):
+        start = time.process_time()
+        for _ in range(per_round):
+            fn()
+        elapsed = time.process_time() - start
+        best = max(best, per_round / elapsed if elapsed > 0 else float("inf"))
+    return best
+
+
+@benchmark("udp_send")
+def benchUdpSend(frames=2000, frameSize=60000):
+    """Packets per CPU second sending fragmented frames over loopback UDP."""
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    address = sink.getsockname()
+
+    packets = ServerWorker({}).makeRtp(bytes(frameSize), 1)
+    results = {"packets_per_frame": len(packets)}
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    modes = [("sendmsg", False)]
+    if gsoSupported(sock):
+        modes.append(("gso", True))
+
+    for mode, gso in modes:
+        sender = BatchSender(sock, gso)
+        rate = cpuRate(lambda: sender.send(packets, address), frames)
+        results[f"{mode}_packets_per_cpu_sec"] = rate * len(packets)
+        results[f"{mode}_calls_per_frame"] = sender.calls / frames
+
+    sock.close()
+    sink.close()
+    return results
+
+
+@benchmark("rtp_encode")
+def benchRtpEncode(count=200000, packetsPerFrame=44):
+    """RTP headers encoded per second, per packet versus per frame."""
+    payload = bytes(1380)
+
+    def perPacket():
+        packet = RtpPacket()
+        packet.encode(2, 0, 0, 0, 1, 0, 26, 1234, payload, 4500)
+        packet.getPacket()
+
+    encoder = RtpEncoder(2, 0, 0, 0, 26, 1234)
+    frames = count // packetsPerFrame
+
+    return {
+        "packet_encode_per_sec": cpuRate(perPacket, count),
+        "frame_encode_packets_per_sec": cpuRate(
+            lambda: encoder.encodeFrame(packetsPerFrame, 1, 4500), frames
+        )
+        * packetsPerFrame,
+    }
+
+
+@benchmark("rtp_decode")
+def benchRtpDecode(count=200000):
+    """RTP packets decoded per second, with the fields a receiver reads."""
+    packet = RtpPacket()
+    packet.encode(2, 0, 0, 0, 1, 0, 26, 1234, bytes(1380), 4500)
+    data = bytes(packet.getPacket())
+
+    def decode():
+        received = RtpPacket()
+        received.decode(data)
+        received.seqNum()
+        received.timestamp()
+        received.ssrc()
+        received.marker()
+
+    return {"packet_decode_per_sec": cpuRate(decode, count)}
+
+
+@benchmark("rtsp_parse")
+def benchRtspParse(count=100000):
+    """RTSP messages parsed per second by the string decoders and RtspParser."""
+    request = (
+        "PLAY movie.Mjpeg RTSP/1.0\nCSeq: 2\nSession: 123456\nRange: npt=10-\n\n"
+    )
+    response = "RTSP/1.0 200 OK\nCSeq: 2\nSession: 123456\n\n"
+
+    requestParser = RtspParser(RtspRequest)
+    responseParser = RtspParser(RtspResponse)
+    requestBytes = request.encode()
+    responseBytes = response.encode()
+
+    return {
+        "request_decode_per_sec": cpuRate(lambda: RtspRequest.decode(request), count),
+        "request_parser_per_sec": cpuRate(
+            lambda: requestParser.feed(requestBytes), count
+        ),
+        "request_parser_pipelined_per_sec": cpuRate(
+            lambda: requestParser.feed(requestBytes * 10), count // 10
+        )
+        * 10,
+        "response_decode_per_sec": cpuRate(lambda: RtspResponse.decode(response), count),
+        "response_parser_per_sec": cpuRate(
+            lambda: responseParser.feed(responseBytes), count
+        ),
+    }
+
+
+@benchmark("rtsp_reply")
+def benchRtspReply(count=200000):
+    """RTSP replies encoded per second, string built versus templated."""
+
+    seq = "2"
+    session = 123456
+
+    def concatenated():
+        reply = "RTSP/1.0 200 OK\nCSeq: " + seq + "\nSession: " + str(session) + "\n\n"
+        reply.encode()
+
+    def packet():
+        reply = RtspResponse(RtspStatus.OK)
+        reply.set_header("CSeq", seq)
+        reply.set_header("Session", session)
+        reply.encode().encode()
+
+    builder = RtspResponseBuilder()
+    transport = {"Transport": "RTP/UDP;client_port=25000"}
+
+    worker = ServerWorker({"session": session})
+    worker.sendRtsp = lambda data: None
+
+    return {
+        "concat_replies_per_sec": cpuRate(concatenated, count),
+        "packet_replies_per_sec": cpuRate(packet, count),
+        # Called through partial, like the concatenation, without a lambda frame
+        "builder_replies_per_sec": cpuRate(
+            functools.partial(builder.build, RtspStatus.OK, seq, session), count
+        ),
+        "worker_replies_per_sec": cpuRate(
+            functools.partial(worker.replyRtsp, worker.OK_200, seq), count
+        ),
+        "builder_setup_replies_per_sec": cpuRate(
+            functools.partial(builder.build, RtspStatus.OK, seq, session, transport), count
+        ),
+    }
+
+
+@benchmark("broadcast")
+def benchBroadcast(frames=500, viewers=20, frameSize=60000):
+    """Viewer frames prepared per CPU second, packetized per viewer versus broadcast."""
+    fd, path = tempfile.mkstemp(suffix=".Mjpeg")
+    with os.fdopen(fd, "wb") as f:
+        f.write(str(frameSize).zfill(5).encode() + bytes(frameSize))
+    channel = BroadcastChannel(path)
+    frame = channel.stream.nextFrame()
+
+    workers = [ServerWorker({"ssrc": ssrc}) for ssrc in range(viewers)]
+
+    def perViewer():
+        for worker in workers:
+            worker.makeRtp(frame, 1)
+
+    def broadcast():
+        packets = channel.packetize(frame, 4500)
+        for ssrc in range(viewers):
+            for i, (packet,) in enumerate(packets):
+                restamp(packet, i, ssrc)
+
+    results = {
+        "per_viewer_frames_per_cpu_sec": cpuRate(perViewer, frames) * viewers,
+        "broadcast_frames_per_cpu_sec": cpuRate(broadcast, frames) * viewers,
+    }
+    channel.close()
+    for leftover in (path, FrameIndex.index_path(path)):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    return results
+
+
+@benchmark("frame_cache")
+def benchFrameCache(frames=20000, frameSize=60000):
+    """Frames read and fragmented per CPU second, uncached versus cache hits."""
+    fd, path = tempfile.mkstemp(suffix=".Mjpeg")
+    with os.fdopen(fd, "wb") as f:
+        f.write(str(frameSize).zfill(5).encode() + bytes(frameSize))
+    stream = VideoStream(path)
+
+    def nextFrame(cache):
+        worker = ServerWorker({}, cache=cache)
+
+        def read():
+            stream.seek(0)
+            worker.nextFragments(stream, 0)
+
+        return read
+
+    cache = FrameCache()
+    results = {
+        "uncached_frames_per_cpu_sec": cpuRate(nextFrame(FrameCache(budget=0)), frames),
+        "cached_frames_per_cpu_sec": cpuRate(nextFrame(cache), frames),
+        "cache_hit_rate": cache.stats.hitRate(),
+    }
+    stream.close()
+    for leftover in (path, FrameIndex.index_path(path)):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    return results
+
+
+def writeVideo(path, size, frameSize):
+    """Write about `size` bytes of frames of `frameSize` bytes. Return the frame count."""
+    frames = max(1, size // (LENGTH_PREFIX_SIZE + frameSize))
+    # Not all zeros, so nothing along the way can shortcut empty pages
+    frame = str(frameSize).zfill(LENGTH_PREFIX_SIZE).encode() + bytes(range(256)) * (
+        frameSize // 256
+    ) + bytes(frameSize % 256)
+    batch = frame * 64
+    with open(path, "wb") as f:
+        for _ in range(frames // 64):
+            f.write(batch)
+        f.write(frame * (frames % 64))
+    return frames
+
+
+@benchmark("video_read")
+def benchVideoRead(size=2 * 1024**3, frameSize=60000):
+    """Reading a multi-GB video: indexing, then frames per second through the map."""
+    fd, path = tempfile.mkstemp(suffix=".Mjpeg")
+    os.close(fd)
+    try:
+        frames = writeVideo(path, size, frameSize)
+
+        start = time.perf_counter()
+        VideoStream(path).close()
+        built = time.perf_counter() - start
+
+        # The saved index is mapped from now on
+        start = time.perf_counter()
+        stream = VideoStream(path)
+        loaded = time.perf_counter() - start
+
+        start = time.perf_counter()
+        while stream.nextFrame():
+            pass
+        views = time.perf_counter() - start
+
+        # Copying each frame out faults every page of the file in
+        stream.seek(0)
+        start = time.perf_counter()
+        while True:
+            data = stream.nextFrame()
+            if not data:
+                break
+            bytes(data)
+        copied = time.perf_counter() - start
+        stream.close()
+    finally:
+        for leftover in (path, FrameIndex.index_path(path)):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    return {
+        "frames": frames,
+        "index_build_sec": built,
+        "index_load_sec": loaded,
+        "next_frame_per_sec": frames / views,
+        "read_mb_per_sec": frames * frameSize / copied / 1e6,
+    }
+
+
+def freePort():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def waitForServer(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+@benchmark("loopback")
+def benchLoopback(sessions=10, duration=5.0, frames=400, frameSize=20000, serverArgs=()):
+    """Server.py streaming to headless viewers over loopback."""
+    fd, path = tempfile.mkstemp(suffix=".Mjpeg")
+    os.close(fd)
+    writeVideo(path, frames * (LENGTH_PREFIX_SIZE + frameSize), frameSize)
+
+    port = freePort()
+    server = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, str(port), *serverArgs],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        waitForServer(port)
+        results = LoadGenerator(
+            "127.0.0.1", port, path, sessions, 50.0, duration, LOOPBACK_BASE_PORT
+        ).run()
+        # Let the teardowns finish before the server goes
+        time.sleep(0.2)
+    finally:
+        server.terminate()
+        server.wait()
+        for leftover in (path, FrameIndex.index_path(path)):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return results
+
+
+def direction(metric) -> int:
+    """1 if a metric is better higher, -1 if better lower, 0 if it isn't a score."""
+    if metric.endswith(("_per_sec", "_mbps")):
+        return 1
+    if metric.endswith(("_sec", "_calls_per_frame")) or any(
+        word in metric for word in ("latency", "jitter", "loss")
+    ):
+        return -1
+    return 0
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Compare two results dicts. Return (metric, baseline, current, change, regressed) rows.
+
+    `change` is relative to the baseline, positive when the metric got
+    better. Metrics that aren't scores, or are missing from either side or
+    zero in the baseline, are left out.
+    """
+    rows = []
+    for name, metrics in baseline.items():
+        for metric, before in metrics.items():
+            after = current.get(name, {}).get(metric)
+            sign = direction(metric)
+            if after is None or not sign or not before:
+                continue
+            change = sign * (after - before) / abs(before)
+            rows.append((f"{name}.{metric}", before, after, change, change < -threshold))
+    return rows
+
+
+def runBenchmarks(names):
+    results = {}
+    for name in names:
+        results[name] = BENCHMARKS[name]()
+        for metric, value in results[name].items():
+            print(f"{name}.{metric}: {value:,.1f}")
+    return results
+
+
+def save(path, results):
+    document = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Streaming server benchmarks")
+    commands = parser.add_subparsers(dest="command")
+
+    run = commands.add_parser("run", help="run benchmarks")
+    run.add_argument("names", nargs="*", help=", ".join(BENCHMARKS))
+    run.add_argument("-o", "--output", help="save the results as a JSON baseline")
+
+    check = commands.add_parser(
+        "compare", help="fail if results regressed from a baseline"
+    )
+    check.add_argument("baseline")
+    check.add_argument(
+        "current", nargs="?", help="saved results, or run the baseline's benchmarks now"
+    )
+    check.add_argument("-t", "--threshold", type=float, default=DEFAULT_THRESHOLD)
+
+    # Plain benchmark names run them, as before
+    if not argv or argv[0] not in ("run", "compare", "-h", "--help"):
+        argv = ["run"] + argv
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        unknown = set(args.names) - set(BENCHMARKS)
+        if unknown:
+            parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+        results = runBenchmarks(args.names or list(BENCHMARKS))
+        if args.output:
+            save(args.output, results)
+        return 0
+
+    baseline = load(args.baseline)
+    if args.current:
+        current = load(args.current)
+    else:
+        current = runBenchmarks([name for name in baseline if name in BENCHMARKS])
+
+    regressions = 0
+    for metric, before, after, change, regressed in compare(baseline, current, args.threshold):
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{metric}: {before:,.1f} -> {after:,.1f} ({change:+.1%}){flag}")
+        regressions += regressed
+    if regressions:
+        print(f"{regressions} metric(s) regressed more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
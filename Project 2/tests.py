@@ -1,9 +1,53 @@
 import unittest
+import errno
 import time
 import textwrap
+import os
+import tempfile
+import asyncio
+import socket
+import threading
+import urllib.request
+import contextlib
+import io
+import queue
 
-from RtpPacket import RtpPacket
-from RtspPacket import RtspRequest, RtspMethod, RtspResponse, RtspStatus
+from RtpPacket import RtpPacket, RtpEncoder, RTP_HEADER
+from RtspPacket import RtspRequest, RtspMethod, RtspResponse, RtspStatus, RtspResponseBuilder, parseSession
+from RtspParser import RtspParser
+from FrameIndex import FrameIndex, MappedEntries
+from VideoStream import VideoStream, FrameStore
+from VideoContainer import ContainerWriter, CONTAINER_HEADER, readHeader
+from ServerWorker import ServerWorker
+from AsyncServer import AsyncServerWorker, RtspProtocol, LoopFrameScheduler, LoopRtcpChannel, LoopRtpSender, MAX_WRITE_BUFFER
+from FrameScheduler import FrameScheduler
+from UdpSender import BatchSender, gsoSupported, SEGMENT_SIZE
+from JitterBuffer import JitterBuffer, extend
+from LoadGenerator import percentile
+import benchmarks
+from JpegPayload import FrameReassembler, fragment, fragmentOffset, MAX_PACKET_SIZE
+from RtcpPacket import RtcpPacket, ReportBlock, SR, RR, ntpTime, ntpMiddle
+from RtcpSession import ReceptionStats, SessionQuality, RtcpChannel
+from QualityLadder import QualityLadder, tierPath, tierPaths
+from Broadcast import BroadcastChannel, LiveChannels
+from FrameCache import FrameCache, FRAGMENT_OVERHEAD
+from PreforkServer import PreforkWorker, SessionRouter
+from Metrics import Registry, MetricsServer
+from SessionRegistry import SessionRegistry
+from Profiler import Profiler, StackSampler, SPAN_SECONDS
+import ServerWorker as ServerWorkerModule
+from Interleaved import InterleavedFrame, InterleavedSender, parseChannels, frame as frame_bytes
+
+try:
+    import FrameDecoder
+    from PIL import Image
+except ImportError:  # Pillow is only needed by the client
+    FrameDecoder = None
+
+try:
+    import Client as ClientModule
+except ImportError:  # Pillow and Tk are only needed by the client
+    ClientModule = None
 
 
 def bitstring_to_bytes(s):
@@ -164,6 +208,43 @@ class TestRtpPacket(unittest.TestCase):
         )
 
 
+class TestRtpEncoder(unittest.TestCase):
+    def test_matches_packet_encode(self):
+        fields = dict(TestRtpPacket.TEST_PACKET_FIELDS_1)
+        payload = fields.pop("payload")
+        seqnum = fields.pop("seqnum")
+        marker = fields.pop("marker")
+
+        packet = RtpPacket()
+        packet.encode(**fields, seqnum=seqnum, marker=marker, payload=payload, timestamp=1234)
+
+        encoder = RtpEncoder(**fields)
+        buffer = bytearray(12)
+        encoder.packInto(buffer, 0, seqnum, marker, 1234)
+        self.assertEqual(buffer, packet.header)
+
+    def test_encode_frame(self):
+        encoder = RtpEncoder(2, 0, 0, 0, 26, 0xDEADBEEF)
+        headers = encoder.encodeFrame(4, 65534, 9000)
+
+        packets = []
+        for header in headers:
+            packet = RtpPacket()
+            packet.decode(bytes(header))
+            packets.append(packet)
+
+        self.assertEqual([p.seqNum() for p in packets], [65534, 65535, 0, 1])
+        self.assertEqual([p.marker() for p in packets], [0, 0, 0, 1])
+        self.assertEqual({p.timestamp() for p in packets}, {9000})
+        self.assertEqual({p.version() for p in packets}, {2})
+        self.assertEqual({p.payloadType() for p in packets}, {26})
+
+    def test_validated_once(self):
+        self.assertRaises(ValueError, RtpEncoder, 4, 0, 0, 0, 26, 0)
+        self.assertRaises(ValueError, RtpEncoder, 2, 0, 0, 0, 128, 0)
+        self.assertRaises(ValueError, RtpEncoder, 2, 0, 0, 0, 26, -1)
+
+
 class TestRtspPacket(unittest.TestCase):
     def test_rtsp_request_init(self):
         packet = RtspRequest(RtspMethod.PLAY, "movie.Mjpeg")
@@ -171,6 +252,11 @@ class TestRtspPacket(unittest.TestCase):
         self.assertEqual(packet.method(), RtspMethod.PLAY)
         self.assertEqual(packet.filename(), "movie.Mjpeg")
 
+    def test_parse_session(self):
+        self.assertEqual(parseSession("123456"), ("123456", None))
+        self.assertEqual(parseSession("123456;timeout=60"), ("123456", 60))
+        self.assertEqual(parseSession("123456; Timeout = 30"), ("123456", 30))
+
     def test_rtsp_packet_header_get_set(self):
         packet = RtspRequest(RtspMethod.PLAY, "movie.Mjpeg")
         packet.set_header("CSeq", "1")
@@ -256,6 +342,23 @@ Test: 200"""
         self.assertIn("CSeq: 1", part_str)
         self.assertIn("Test: 200", part_str)
 
+    def test_rtsp_response_builder(self):
+        builder = RtspResponseBuilder()
+
+        reply = builder.build(RtspStatus.OK, "3", 123456, {"Range": "npt=0-"})
+        self.assertEqual(reply, b"RTSP/1.0 200 OK\nSession: 123456\nCSeq: 3\nRange: npt=0-\n\n")
+
+        reply = builder.build(RtspStatus.NOT_FOUND, "4")
+        self.assertEqual(reply, b"RTSP/1.0 404 NOT FOUND\nCSeq: 4\n\n")
+
+        packet = RtspResponse.decode(reply.decode())
+        self.assertEqual(packet.status(), RtspStatus.NOT_FOUND)
+        self.assertEqual(packet.get_header("CSeq"), "4")
+
+        # A new session replaces the cached Session line
+        reply = builder.build(RtspStatus.OK, "5", 654321)
+        self.assertEqual(reply, b"RTSP/1.0 200 OK\nSession: 654321\nCSeq: 5\n\n")
+
     def test_rtsp_response_decode_with_headers(self):
         packet = RtspResponse.decode("RTSP/1.0 200 OK\nCSeq: 1\nTest: 200")
 
@@ -264,5 +367,1923 @@ Test: 200"""
         self.assertEqual(packet.get_header("Test"), "200")
 
 
+class TestRtspParser(unittest.TestCase):
+    def test_split_message(self):
+        parser = RtspParser(RtspRequest)
+
+        self.assertEqual(parser.feed(b"PLAY movie.Mjpeg RTSP/1.0\nCSe"), [])
+        self.assertEqual(parser.feed(b"q: 1\nSession: 123"), [])
+        (request,) = parser.feed(b"456\n\n")
+
+        self.assertEqual(request.method(), RtspMethod.PLAY)
+        self.assertEqual(request.filename(), "movie.Mjpeg")
+        self.assertEqual(request.get_header("CSeq"), "1")
+        self.assertEqual(request.get_header("Session"), "123456")
+        self.assertEqual(parser.buffer, b"")
+
+    def test_pipelined_crlf_and_lf(self):
+        parser = RtspParser(RtspRequest)
+        requests = parser.feed(
+            b"PLAY a RTSP/1.0\r\nCSeq: 2\r\n\r\n"
+            b"PAUSE a RTSP/1.0\nCSeq: 3\n\n"
+            b"TEARDOWN a RTSP/1.0\r\nCSeq: 4\r\n"
+        )
+
+        self.assertEqual([r.method() for r in requests], [RtspMethod.PLAY, RtspMethod.PAUSE])
+        self.assertEqual([r.get_header("CSeq") for r in requests], ["2", "3"])
+        (teardown,) = parser.feed(b"\r\n")
+        self.assertEqual(teardown.get_header("CSeq"), "4")
+
+    def test_content_length_body(self):
+        parser = RtspParser(RtspResponse)
+
+        self.assertEqual(
+            parser.feed(b"RTSP/1.0 200 OK\nCSeq: 1\nContent-Length: 11\n\nhello"), []
+        )
+        (response,) = parser.feed(b" worldRTSP/1.0 404 NOT FOUND\n")
+
+        self.assertEqual(response.status(), RtspStatus.OK)
+        self.assertEqual(response.body, b"hello world")
+        (missing,) = parser.feed(b"\n")
+        self.assertEqual(missing.status(), RtspStatus.NOT_FOUND)
+
+    def test_malformed_message_skipped(self):
+        parser = RtspParser(RtspRequest)
+
+        (request,) = parser.feed(b"DANCE a RTSP/1.0\nCSeq: 1\n\nPLAY a RTSP/1.0\nCSeq: 2\n\n")
+        self.assertEqual(request.get_header("CSeq"), "2")
+        self.assertEqual(parser.errors, 1)
+
+    def test_negative_content_length_skipped(self):
+        for length in (-60, -1000):
+            parser = RtspParser(RtspRequest)
+            data = f"PLAY a RTSP/1.0\nCSeq: 1\nContent-Length: {length}\n\n".encode()
+
+            self.assertEqual(parser.feed(data), [])
+            self.assertEqual(parser.errors, 1)
+            (request,) = parser.feed(b"PLAY a RTSP/1.0\nCSeq: 2\n\n")
+            self.assertEqual(request.get_header("CSeq"), "2")
+            self.assertEqual(parser.buffer, b"")
+
+    def test_content_length_any_case(self):
+        parser = RtspParser(RtspRequest)
+        data = b"SET_PARAMETER a RTSP/1.0\r\nCSeq: 1\r\ncontent-LENGTH: 5\r\n\r\nhello"
+
+        request, play = parser.feed(data + b"PLAY a RTSP/1.0\r\nCSeq: 2\r\n\r\n")
+        self.assertEqual(request.body, b"hello")
+        self.assertEqual(play.get_header("CSeq"), "2")
+        self.assertEqual(request.get_header("Content-Length"), "5")
+        self.assertEqual(parser.errors, 0)
+
+    def test_byte_at_a_time(self):
+        parser = RtspParser(RtspRequest)
+        data = (
+            b"SET_PARAMETER a RTSP/1.0\r\nCSeq: 1\r\nContent-Length: 3\r\n\r\nabc"
+            + b"$\x01\x00\x02xy"
+            + b"PLAY a RTSP/1.0\r\nCSeq: 2\r\n\r\n"
+        )
+
+        messages = []
+        for i in range(len(data)):
+            messages += parser.feed(data[i : i + 1])
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(messages[0].body, b"abc")
+        self.assertIsInstance(messages[0].body, bytes)
+        self.assertEqual((messages[1].channel, messages[1].payload), (1, b"xy"))
+        self.assertIsInstance(messages[1].payload, bytes)
+        self.assertEqual(messages[2].get_header("CSeq"), "2")
+        self.assertEqual(parser.buffer, b"")
+
+    def test_interleaved_frames(self):
+        parser = RtspParser(RtspRequest)
+        data = frame_bytes(1, b"report") + b"PLAY a RTSP/1.0\nCSeq: 2\n\n" + frame_bytes(0, b"x" * 300)
+
+        messages = parser.feed(data[:3]) + parser.feed(data[3:-100])
+        self.assertEqual(messages[0], InterleavedFrame(1, b"report"))
+        self.assertEqual(messages[1].get_header("CSeq"), "2")
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(parser.feed(data[-100:]), [InterleavedFrame(0, b"x" * 300)])
+        self.assertEqual(parser.buffer, b"")
+
+    def test_encode_round_trip(self):
+        packet = RtspRequest(RtspMethod.SETUP, "movie.Mjpeg")
+        packet.set_header("CSeq", 1)
+        packet.set_header("Transport", "RTP/UDP; client_port= 25000")
+
+        (request,) = RtspParser(RtspRequest).feed(packet.encode().encode())
+        self.assertEqual(request.headers, packet.headers)
+
+
+class TestJpegPayload(unittest.TestCase):
+    FRAME = bytes(range(256)) * 20
+
+    def make_packets(self, frame, timestamp):
+        worker = ServerWorker({})
+        packets = []
+        for buffers in worker.makeRtp(frame, timestamp // 4500):
+            packet = RtpPacket()
+            packet.decode(b"".join(buffers))
+            packets.append(packet)
+        return packets
+
+    def test_fragment_sizes(self):
+        fragments = fragment(self.FRAME)
+
+        self.assertGreater(len(fragments), 1)
+        for header, data in fragments:
+            self.assertLessEqual(12 + len(header) + len(data), MAX_PACKET_SIZE)
+        self.assertEqual(b"".join(data for _, data in fragments), self.FRAME)
+        self.assertEqual(fragmentOffset(fragments[1][0]), len(fragments[0][1]))
+
+    def test_make_rtp_marker_and_seq(self):
+        packets = self.make_packets(self.FRAME, 4500)
+
+        self.assertEqual([p.marker() for p in packets[:-1]], [0] * (len(packets) - 1))
+        self.assertEqual(packets[-1].marker(), 1)
+        self.assertEqual([p.seqNum() for p in packets], list(range(len(packets))))
+        self.assertEqual({p.timestamp() for p in packets}, {4500})
+
+    def test_reassemble_out_of_order(self):
+        packets = self.make_packets(self.FRAME, 4500)
+        reassembler = FrameReassembler()
+
+        for packet in reversed(packets[1:]):
+            self.assertIsNone(reassembler.add(packet))
+        self.assertEqual(reassembler.add(packets[0]), self.FRAME)
+        self.assertEqual(reassembler.pending, {})
+
+    def test_reassemble_interleaved_frames(self):
+        first = self.make_packets(self.FRAME, 4500)
+        second = self.make_packets(self.FRAME[::-1], 9000)
+        reassembler = FrameReassembler()
+
+        for packet in first[:-1] + second:
+            reassembler.add(packet)
+        self.assertEqual(reassembler.add(first[-1]), self.FRAME)
+        self.assertEqual(reassembler.dropped, 0)
+
+    def test_reassemble_drops_incomplete_frame(self):
+        first = self.make_packets(self.FRAME, 4500)
+        second = self.make_packets(self.FRAME[::-1], 9000)
+        reassembler = FrameReassembler(max_pending=1)
+
+        for packet in first[1:]:
+            reassembler.add(packet)
+        frames = [reassembler.add(packet) for packet in second]
+
+        self.assertEqual(frames[-1], self.FRAME[::-1])
+        self.assertEqual(reassembler.dropped, 1)
+        self.assertEqual(reassembler.pending, {})
+
+
+def write_test_video(frames):
+    """Write frames in the 5-digit length-prefixed .Mjpeg format to a temp file."""
+    fd, path = tempfile.mkstemp(suffix=".Mjpeg")
+    with os.fdopen(fd, "wb") as f:
+        for frame in frames:
+            f.write(str(len(frame)).zfill(5).encode() + frame)
+    return path
+
+
+class TestVideoStream(unittest.TestCase):
+    FRAMES = [bytes([i]) * (100 + i) for i in range(50)]
+
+    def setUp(self):
+        self.path = write_test_video(self.FRAMES)
+
+    def tearDown(self):
+        for path in (self.path, FrameIndex.index_path(self.path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_next_frame(self):
+        stream = VideoStream(self.path)
+
+        for i, frame in enumerate(self.FRAMES):
+            self.assertEqual(stream.nextFrame(), frame)
+            self.assertEqual(stream.frameNbr(), i + 1)
+
+        self.assertFalse(stream.nextFrame())
+        stream.close()
+
+    def test_index_saved_and_loaded(self):
+        stream = VideoStream(self.path)
+        self.assertTrue(os.path.exists(FrameIndex.index_path(self.path)))
+
+        index = FrameIndex.load(self.path)
+        self.assertIsNotNone(index)
+        self.assertEqual(list(index.entries), list(stream.index.entries))
+        self.assertEqual(index[0].offset, 5)
+        self.assertEqual(index[49].number, 50)
+        stream.close()
+
+    def test_concurrent_index_saves(self):
+        with open(self.path, "rb") as file:
+            index = FrameIndex.build(file)
+        errors = []
+
+        def save():
+            try:
+                for _ in range(20):
+                    index.save(self.path)
+            except OSError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=save) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(FrameIndex.load(self.path)), 50)
+        directory = os.path.dirname(self.path)
+        name = os.path.basename(FrameIndex.index_path(self.path))
+        self.assertEqual([f for f in os.listdir(directory) if f.startswith(name + ".")], [])
+
+    def test_index_unmapped_on_release(self):
+        VideoStream(self.path).close()
+        stream = VideoStream(self.path)
+        entries = stream.index.entries
+        self.assertIsInstance(entries, MappedEntries)
+        stream.close()
+        self.assertTrue(entries.map.closed)
+
+    def test_stale_index_rebuilt(self):
+        VideoStream(self.path).close()
+        with open(self.path, "ab") as f:
+            f.write(b"00003abc")
+
+        self.assertIsNone(FrameIndex.load(self.path))
+
+        stream = VideoStream(self.path)
+        self.assertEqual(stream.frameCount(), 51)
+        stream.close()
+
+    def test_seek(self):
+        stream = VideoStream(self.path)
+        self.assertEqual(stream.frameCount(), 50)
+        self.assertEqual(stream.duration(), 50 / VideoStream.FPS)
+
+        stream.seekTime(1.0)
+        self.assertEqual(stream.nextFrame(), self.FRAMES[VideoStream.FPS])
+        self.assertEqual(stream.frameNbr(), VideoStream.FPS + 1)
+
+        stream.seek(1000)
+        self.assertFalse(stream.nextFrame())
+        stream.close()
+
+    def test_shared_frame_store(self):
+        first = VideoStream(self.path)
+        second = VideoStream(self.path)
+        self.assertIs(first.store, second.store)
+        self.assertEqual(first.store.refs, 2)
+
+        frame = first.nextFrame()
+        self.assertIsInstance(frame, memoryview)
+        self.assertEqual(second.nextFrame(), frame)
+
+        first.close()
+        self.assertEqual(second.nextFrame(), self.FRAMES[1])
+
+        store = second.store
+        second.close()
+        self.assertEqual(store.refs, 0)
+        self.assertNotIn(store.filename, FrameStore._stores)
+
+    def test_parse_range(self):
+        worker = ServerWorker({})
+
+        self.assertEqual(worker.parseRange("npt=12.5-"), 12.5)
+        self.assertEqual(worker.parseRange("npt=3-10"), 3.0)
+        self.assertIsNone(worker.parseRange("npt=now-"))
+        self.assertIsNone(worker.parseRange("clock=19961108T142300Z-"))
+        self.assertIsNone(worker.parseRange(None))
+
+
+class TestVideoContainer(unittest.TestCase):
+    # The last frame is too large for the 5-digit length prefix of .Mjpeg files
+    FRAMES = [bytes([i]) * (100 + i) for i in range(30)] + [b"\xff" * 150000]
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".Mjpeg")
+        os.close(fd)
+
+    def tearDown(self):
+        for path in (self.path, self.path + ".tmp", FrameIndex.index_path(self.path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def write(self, fps, frames=FRAMES):
+        with ContainerWriter(self.path, fps, 640, 480) as writer:
+            for frame in frames:
+                writer.write(frame)
+
+    def test_round_trip(self):
+        self.write(25)
+        stream = VideoStream(self.path)
+        self.assertEqual((stream.fps, stream.width, stream.height), (25, 640, 480))
+        self.assertEqual(stream.frameCount(), len(self.FRAMES))
+        for frame in self.FRAMES:
+            self.assertEqual(stream.nextFrame(), frame)
+        self.assertFalse(stream.nextFrame())
+        stream.close()
+
+        # The index is part of the container
+        self.assertFalse(os.path.exists(FrameIndex.index_path(self.path)))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_frame_rate(self):
+        self.write("30000/1001")
+        with open(self.path, "rb") as f:
+            self.assertEqual(str(readHeader(f.read(CONTAINER_HEADER.size)).fps), "30000/1001")
+
+        stream = VideoStream(self.path)
+        self.assertAlmostEqual(stream.duration(), len(self.FRAMES) * 1001 / 30000)
+        stream.seekTime(1.0)
+        self.assertEqual(stream.frameNbr(), 29)
+
+        worker = ServerWorker({})
+        worker.clientInfo["videoStream"] = stream
+        self.assertAlmostEqual(worker.frameRate(), 30000 / 1001)
+        stream.close()
+
+    def test_unfinished(self):
+        writer = ContainerWriter(self.path, 25)
+        for frame in self.FRAMES[:5]:
+            writer.write(frame)
+        writer.file.write(b"\x00\x10")  # Part of the next length
+        writer.file.close()
+        os.replace(writer.tmp, self.path)
+
+        # No index yet, so the frames are found by their lengths
+        stream = VideoStream(self.path)
+        self.assertEqual(stream.fps, 25)
+        self.assertEqual(stream.frameCount(), 5)
+        for frame in self.FRAMES[:5]:
+            self.assertEqual(stream.nextFrame(), frame)
+        stream.close()
+
+    def test_abort(self):
+        with self.assertRaises(RuntimeError):
+            with ContainerWriter(self.path, 25) as writer:
+                writer.write(b"frame")
+                raise RuntimeError
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+
+class TestBatchSender(unittest.TestCase):
+    def send_and_receive(self, gso):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", 0))
+        sink.settimeout(1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        packets = ServerWorker({}).makeRtp(bytes(range(256)) * 20, 1)
+        sender = BatchSender(sock, gso)
+        sender.send(packets, sink.getsockname())
+        received = [sink.recv(65536) for _ in packets]
+
+        sock.close()
+        sink.close()
+        return packets, received, sender.calls
+
+    def test_send_each(self):
+        packets, received, calls = self.send_and_receive(False)
+
+        self.assertEqual(received, [b"".join(packet) for packet in packets])
+        self.assertEqual(calls, len(packets))
+
+    def test_send_gso(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        supported = gsoSupported(sock)
+        sock.close()
+        if not supported:
+            self.skipTest("UDP GSO not supported")
+
+        packets, received, calls = self.send_and_receive(True)
+
+        self.assertEqual(received, [b"".join(packet) for packet in packets])
+        self.assertEqual(calls, 1)
+
+    def test_gso_failure_sends_only_the_rest(self):
+        class FailingSocket:
+            """Takes the first GSO batch, then fails GSO with EIO."""
+
+            def __init__(self):
+                self.datagrams = []
+
+            def sendmsg(self, buffers, ancdata, flags, address):
+                data = b"".join(buffers)
+                if not ancdata:
+                    self.datagrams.append(data)
+                elif self.datagrams:
+                    raise OSError(errno.EIO, "GSO not offloaded")
+                else:
+                    segment = SEGMENT_SIZE.unpack(ancdata[0][2])[0]
+                    self.datagrams.extend(
+                        data[i : i + segment] for i in range(0, len(data), segment)
+                    )
+                return len(data)
+
+        sock = FailingSocket()
+        packets = [[bytes([n % 256]) * 100] for n in range(130)]
+        sender = BatchSender(sock, True)
+        sender.send(packets, ("127.0.0.1", 5004))
+
+        self.assertEqual(sock.datagrams, [packet[0] for packet in packets])
+        self.assertEqual(sender.sentPackets, 130)
+        self.assertFalse(sender.gso)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingSession:
+    def __init__(self, clock, cost=0.0):
+        self.clock = clock
+        self.cost = cost
+        self.sent = []
+
+    def sendFrame(self):
+        self.sent.append(self.clock.now)
+        self.clock.now += self.cost
+        return True
+
+
+class TestFrameScheduler(unittest.TestCase):
+    def test_deadlines_do_not_drift(self):
+        clock = FakeClock()
+        scheduler = FrameScheduler(clock)
+        session = RecordingSession(clock, cost=0.01)
+        entry = scheduler.add(session, 0.05)
+
+        for _ in range(10):
+            clock.now = scheduler.runDue()
+
+        self.assertEqual(len(session.sent), 10)
+        self.assertAlmostEqual(entry.deadline, 100.5)
+        for i, sent in enumerate(session.sent):
+            self.assertAlmostEqual(sent, 100.0 + i * 0.05)
+
+    def test_sessions_sent_in_deadline_order(self):
+        clock = FakeClock()
+        scheduler = FrameScheduler(clock)
+        first = RecordingSession(clock)
+        scheduler.add(first, 0.05)
+        clock.now += 0.02
+        second = RecordingSession(clock)
+        scheduler.add(second, 0.05)
+
+        clock.now += 0.04
+        self.assertAlmostEqual(scheduler.runDue(), 100.07)
+        self.assertEqual(len(first.sent), 2)
+        self.assertEqual(len(second.sent), 1)
+
+    def test_lateness_and_remove(self):
+        clock = FakeClock()
+        scheduler = FrameScheduler(clock)
+        session = RecordingSession(clock)
+        entry = scheduler.add(session, 0.05)
+
+        scheduler.runDue()
+        clock.now += 0.06
+        scheduler.runDue()
+        self.assertAlmostEqual(entry.stats.last, 0.01)
+        self.assertAlmostEqual(entry.stats.max, 0.01)
+        self.assertEqual(entry.stats.count, 2)
+
+        clock.now += 1.0
+        scheduler.runDue()
+        self.assertEqual(entry.stats.resyncs, 1)
+
+        scheduler.remove(entry)
+        clock.now += 1.0
+        self.assertIsNone(scheduler.runDue())
+        self.assertEqual(len(session.sent), 3)
+
+    def test_finished_session_dropped(self):
+        clock = FakeClock()
+        scheduler = FrameScheduler(clock)
+
+        class TwoFrameSession(RecordingSession):
+            def sendFrame(self):
+                return len(self.sent) < 2 and super().sendFrame()
+
+        session = TwoFrameSession(clock)
+        entry = scheduler.add(session, 0.05)
+
+        for _ in range(3):
+            clock.now += 0.05
+            deadline = scheduler.runDue()
+        self.assertIsNone(deadline)
+        self.assertFalse(entry.active)
+        self.assertEqual(scheduler.heap, [])
+        self.assertEqual(len(session.sent), 2)
+
+    def test_loop_remove_from_within_send(self):
+        class StoppingSession:
+            def sendFrame(self):
+                scheduler.remove(self.entry)
+                return True
+
+        async def play():
+            nonlocal scheduler
+            scheduler = LoopFrameScheduler(asyncio.get_running_loop())
+            session = StoppingSession()
+            session.entry = scheduler.add(session, 0.01)
+            await asyncio.sleep(0.05)
+            self.assertFalse(session.entry.active)
+
+        scheduler = None
+        thread = threading.Thread(target=asyncio.run, args=(play(),), daemon=True)
+        thread.start()
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+
+
+class TestJitterBuffer(unittest.TestCase):
+    def make_buffer(self, **kwargs):
+        clock = FakeClock()
+        return clock, JitterBuffer(latency=0.1, clock=clock, **kwargs)
+
+    def test_extend(self):
+        self.assertEqual(extend(2, 65534, 16), 65538)
+        self.assertEqual(extend(65534, 65538, 16), 65534)
+        self.assertEqual(extend(10, 5, 16), 10)
+        self.assertEqual(extend(0, 0xFFFFFFFF, 32), 0x100000000)
+
+    def test_reorders_and_waits_for_latency(self):
+        clock, buffer = self.make_buffer()
+        buffer.push(4500, b"a")
+        buffer.push(13500, b"c")
+        buffer.push(9000, b"b")
+
+        self.assertIsNone(buffer.pop())
+        self.assertAlmostEqual(buffer.nextDeadline(), 100.1)
+        self.assertEqual(buffer.depth(), 3)
+
+        played = []
+        for _ in range(3):
+            clock.now = buffer.nextDeadline()
+            played.append(buffer.pop())
+        self.assertEqual(played, [b"a", b"b", b"c"])
+        self.assertEqual(buffer.stats.framesPlayed, 3)
+        self.assertEqual(buffer.depth(), 0)
+
+    def test_late_frame_dropped(self):
+        clock, buffer = self.make_buffer()
+        buffer.push(9000, b"b")
+        clock.now += 1
+        self.assertEqual(buffer.pop(), b"b")
+
+        buffer.push(4500, b"a")
+        self.assertEqual(buffer.stats.late, 1)
+        self.assertIsNone(buffer.pop())
+
+    def test_timestamp_wraparound(self):
+        clock, buffer = self.make_buffer()
+        buffer.push(0xFFFFFFFF - 4499, b"a")
+        buffer.push(4, b"b")
+
+        clock.now += 1
+        self.assertEqual(buffer.pop(), b"b")
+        self.assertEqual(buffer.stats.dropped, 1)
+        buffer.push(4504, b"c")
+        self.assertEqual(buffer.stats.late, 0)
+
+    def test_sequence_wraparound_loss(self):
+        clock, buffer = self.make_buffer()
+        for seq in (65533, 65534, 0, 2):
+            buffer.addPacket(seq)
+
+        self.assertEqual(buffer.stats.packetsExpected(), 6)
+        self.assertEqual(buffer.stats.packetsLost(), 2)
+
+    def test_delay_adapts_to_jitter(self):
+        clock, buffer = self.make_buffer()
+        for i in range(1, 50):
+            clock.now = 100.0 + i * 0.05 + (0.2 if i % 2 else 0)
+            buffer.push(i * 4500, b"x")
+
+        self.assertGreater(buffer.stats.jitter, 0.1)
+        self.assertGreater(buffer.delay(), 0.3)
+
+    def test_overflow_drops_oldest(self):
+        clock, buffer = self.make_buffer(maxFrames=2)
+        for i in range(1, 4):
+            buffer.push(i * 4500, bytes([i]))
+
+        self.assertEqual(buffer.stats.dropped, 1)
+        clock.now = buffer.nextDeadline()
+        self.assertEqual(buffer.pop(), bytes([2]))
+
+
+class TestRtcp(unittest.TestCase):
+    BLOCK = ReportBlock(0xCAFEBABE, 64, -3, 70000, 450, 0x12345678, 65536)
+
+    def test_sender_report_roundtrip(self):
+        ntp = ntpTime(1_700_000_000.5)
+        packet = RtcpPacket.senderReport(0x1234, ntp, 9000, 10, 12000, [self.BLOCK])
+        data = packet.encode()
+
+        self.assertEqual(len(data), 8 + 20 + 24)
+        self.assertEqual(data[0], 0x81)
+        self.assertEqual(data[1], SR)
+
+        decoded = RtcpPacket.decode(data)
+        self.assertEqual(decoded.ssrc, 0x1234)
+        self.assertEqual(decoded.ntp, ntp)
+        self.assertEqual(
+            (decoded.rtpTimestamp, decoded.packetCount, decoded.octetCount), (9000, 10, 12000)
+        )
+        self.assertEqual(decoded.blocks, [self.BLOCK])
+
+    def test_compound_skips_unknown_types(self):
+        rr = RtcpPacket.receiverReport(1, [self.BLOCK]).encode()
+        # An SDES packet with one empty chunk
+        sdes = bytes([0x81, 202, 0, 1, 0, 0, 0, 1])
+
+        packets = RtcpPacket.decodeCompound(rr + sdes + rr)
+
+        self.assertEqual([p.packetType for p in packets], [RR, RR])
+        self.assertEqual(packets[1].blocks[0].cumulativeLost, -3)
+
+    def test_reception_fraction_lost(self):
+        now = [0.0]
+        stats = ReceptionStats(clock=lambda: now[0])
+        self.assertIsNone(stats.reportBlock())
+
+        # 65534 .. 3 with two packets missing, across the 16-bit wrap
+        for seq in (65534, 65535, 1, 3):
+            stats.onPacket(seq, 0, 42)
+
+        block = stats.reportBlock()
+        self.assertEqual(block.ssrc, 42)
+        self.assertEqual(block.cumulativeLost, 2)
+        self.assertEqual(block.fractionLost, 2 * 256 // 6)
+        self.assertEqual(block.highestSeq, 65536 + 3)
+
+        # Nothing new lost since the last report
+        stats.onPacket(4, 0, 42)
+        self.assertEqual(stats.reportBlock().fractionLost, 0)
+
+    def test_reception_jitter_and_delay_since_sr(self):
+        now = [0.0]
+        stats = ReceptionStats(clockRate=1000, clock=lambda: now[0])
+        # Packets 100 units apart arriving 0.1 and 0.2 s apart
+        stats.onPacket(0, 0, 7)
+        now[0] = 0.1
+        stats.onPacket(1, 100, 7)
+        now[0] = 0.3
+        stats.onPacket(2, 200, 7)
+        self.assertAlmostEqual(stats.jitter, 100 / 16)
+
+        ntp = ntpTime(1_700_000_000)
+        stats.onSenderReport(ntp)
+        now[0] = 0.8
+        block = stats.reportBlock()
+        self.assertEqual(block.lsr, ntpMiddle(ntp))
+        self.assertEqual(block.dlsr, 32768)
+
+    def test_quality_round_trip_time(self):
+        sent = 1_700_000_000.0
+        block = ReportBlock(1, 128, 5, 100, 900, ntpMiddle(ntpTime(sent)), 65536 // 2)
+
+        quality = SessionQuality()
+        quality.update(block, now=sent + 0.75)
+
+        self.assertEqual(quality.fractionLost, 0.5)
+        self.assertAlmostEqual(quality.jitter, 0.01)
+        self.assertAlmostEqual(quality.rtt, 0.25, places=3)
+
+    def test_channel_routes_by_ssrc(self):
+        reports = []
+
+        class Session:
+            def onReceiverReport(self, block):
+                reports.append(block)
+
+        channel = RtcpChannel()
+        channel.register(self.BLOCK.ssrc, Session())
+        channel.receive(RtcpPacket.receiverReport(1, [self.BLOCK]).encode(), None)
+        channel.receive(b"\x00\x01\x00\x00", None)
+        channel.unregister(self.BLOCK.ssrc)
+        channel.receive(RtcpPacket.receiverReport(1, [self.BLOCK]).encode(), None)
+
+        self.assertEqual(reports, [self.BLOCK])
+        self.assertEqual(channel.errors, 1)
+
+
+class TestQualityLadder(unittest.TestCase):
+    def setUp(self):
+        self.path = write_test_video([b"a" * 4000] * 40)
+        self.paths = [self.path]
+        for level, size in ((1, 2000), (2, 500)):
+            tier = write_test_video([b"b" * size] * 40)
+            os.replace(tier, tierPath(self.path, level))
+            self.paths.append(tierPath(self.path, level))
+
+    def tearDown(self):
+        for path in self.paths + [tierPath(self.path, 3)]:
+            for p in (path, FrameIndex.index_path(path)):
+                if os.path.exists(p):
+                    os.remove(p)
+
+    def report(self, ladder, now, loss, octets):
+        quality = SessionQuality()
+        quality.fractionLost = loss
+        ladder.clock = lambda: now
+        ladder.onReport(quality, octets)
+
+    def test_tiers_discovered_in_order(self):
+        self.assertEqual(tierPaths(self.path), self.paths)
+
+        # A tier of a different length is left out
+        short = write_test_video([b"c"] * 5)
+        os.replace(short, tierPath(self.path, 3))
+        ladder = QualityLadder(self.path)
+        self.assertEqual(len(ladder.streams), 3)
+        self.assertGreater(ladder.bitrates[0], ladder.bitrates[1])
+        ladder.close()
+
+    def test_switches_on_loss_and_recovers(self):
+        ladder = QualityLadder(self.path)
+        for _ in range(10):
+            ladder.stream().nextFrame()
+
+        # Only a quarter of 400 kbit/s gets through: below tier 1's 320 kbit/s
+        self.report(ladder, 0.0, 0.0, 0)
+        self.report(ladder, 1.0, 0.75, 50000)
+        self.assertEqual(ladder.target, 2)
+        self.assertEqual(ladder.level, 0)
+
+        self.assertTrue(ladder.switch())
+        self.assertEqual(ladder.stream().frameNbr(), 10)
+        self.assertEqual(bytes(ladder.stream().nextFrame()), b"b" * 500)
+        self.assertFalse(ladder.switch())
+
+        # Clean reports grow the capacity estimate until tier 1 fits
+        for second in range(2, 20):
+            self.report(ladder, second, 0.0, 50000)
+        self.assertEqual(ladder.target, 1)
+        ladder.close()
+
+
+class CapturingWorker(ServerWorker):
+    """A ServerWorker that keeps what it sends instead of sending it."""
+
+    def __init__(self, ssrc, seq):
+        super().__init__({"ssrc": ssrc, "rtpSeq": seq})
+        self.sent = []
+
+    def sendPackets(self, packets):
+        self.sent.extend(bytes(b"".join(packet)) for packet in packets)
+
+    def sendReport(self):
+        pass
+
+
+class TestBroadcast(unittest.TestCase):
+    FRAMES = [bytes([1]) * 3000, bytes([2]) * 100]
+
+    def setUp(self):
+        self.path = write_test_video(self.FRAMES)
+
+    def tearDown(self):
+        for path in (self.path, FrameIndex.index_path(self.path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def decode(self, data):
+        packet = RtpPacket()
+        packet.decode(data)
+        return packet
+
+    def test_frame_restamped_per_session(self):
+        channel = BroadcastChannel(self.path)
+        sessions = [CapturingWorker(0x1111, 10), CapturingWorker(0x2222, 0xFFFF)]
+        for session in sessions:
+            channel.add(session)
+
+        channel.sendFrame()
+
+        for session, first in zip(sessions, (10, 0xFFFF)):
+            packets = [self.decode(data) for data in session.sent]
+            self.assertEqual(len(packets), 3)
+            self.assertEqual({p.ssrc() for p in packets}, {session.clientInfo["ssrc"]})
+            self.assertEqual(
+                [p.seqNum() for p in packets], [(first + i) & 0xFFFF for i in range(3)]
+            )
+            self.assertEqual(session.clientInfo["rtpSeq"], (first + 3) & 0xFFFF)
+            self.assertEqual(session.clientInfo["rtpPackets"], 3)
+
+            reassembler = FrameReassembler()
+            frames = [reassembler.add(p) for p in packets]
+            self.assertEqual(frames[-1], self.FRAMES[0])
+        channel.close()
+
+    def test_channel_loops_with_rising_timestamps(self):
+        channel = BroadcastChannel(self.path)
+        session = CapturingWorker(1, 0)
+        channel.add(session)
+        for _ in range(3):
+            self.assertTrue(channel.sendFrame())
+
+        reassembler = FrameReassembler()
+        frames = []
+        timestamps = []
+        for data in session.sent:
+            packet = self.decode(data)
+            frame = reassembler.add(packet)
+            if frame:
+                frames.append(frame)
+                timestamps.append(packet.timestamp())
+
+        self.assertEqual(frames, self.FRAMES + self.FRAMES[:1])
+        self.assertEqual(timestamps, sorted(set(timestamps)))
+        self.assertEqual(channel.remove(session), 0)
+        channel.close()
+
+    def test_channel_shared_until_last_leaves(self):
+        scheduler = FrameScheduler(clock=FakeClock())
+        live = LiveChannels(scheduler)
+        first, second = object(), object()
+
+        channel = live.subscribe(self.path, first)
+        self.assertIs(live.subscribe(self.path, second), channel)
+        self.assertEqual(len(scheduler.heap), 1)
+
+        live.unsubscribe(channel, first)
+        self.assertTrue(channel.entry.active)
+        live.unsubscribe(channel, second)
+        self.assertFalse(channel.entry.active)
+        self.assertEqual(live.channels, {})
+
+
+class TestFrameCache(unittest.TestCase):
+    def entry(self, size):
+        return [(b"h" * 8, b"d" * (size - 8 - FRAGMENT_OVERHEAD))]
+
+    def test_least_recently_used_evicted(self):
+        cache = FrameCache(budget=3000)
+        cache.put("a", self.entry(1000))
+        cache.put("b", self.entry(1000))
+        cache.put("c", self.entry(1000))
+        self.assertIsNotNone(cache.get("a"))
+
+        cache.put("d", self.entry(1000))
+
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertEqual(cache.size, 3000)
+        self.assertEqual(
+            (cache.stats.hits, cache.stats.misses, cache.stats.evictions), (2, 1, 1)
+        )
+
+    def test_budget_limits(self):
+        cache = FrameCache(budget=1500)
+        fragments = self.entry(2000)
+        self.assertIs(cache.put("big", fragments), fragments)
+        self.assertEqual(len(cache), 0)
+
+        cache.put("a", self.entry(1000))
+        cache.resize(0)
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_sessions_share_packetized_frames(self):
+        path = write_test_video([bytes([i]) * 3000 for i in range(4)])
+        cache = FrameCache()
+        sessions = [CapturingWorker(ssrc, 0) for ssrc in (1, 2)]
+        try:
+            for session in sessions:
+                session.cache = cache
+                session.clientInfo["videoStream"] = VideoStream(path)
+                while session.sendFrame():
+                    pass
+                session.clientInfo["videoStream"].close()
+        finally:
+            for p in (path, FrameIndex.index_path(path)):
+                os.remove(p)
+
+        self.assertEqual((cache.stats.misses, cache.stats.hits), (4, 4))
+        first, second = ([data[12:] for data in s.sent] for s in sessions)
+        self.assertEqual(first, second)
+        self.assertEqual(sessions[1].clientInfo["videoStream"].frameNbr(), 4)
+
+
+class TestSessionRouter(unittest.TestCase):
+    def setUp(self):
+        self.channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(3)]
+        self.created = []
+        self.routers = [
+            SessionRouter(i, self.channels, self.created.append) for i in range(3)
+        ]
+
+    def tearDown(self):
+        for pair in self.channels:
+            for sock in pair:
+                sock.close()
+
+    def test_session_ids_encode_owner(self):
+        for router in self.routers:
+            for _ in range(100):
+                session = router.newSessionId()
+                self.assertTrue(100000 <= session <= 999999)
+                self.assertEqual(router.owner(session), router.index)
+
+    def test_connection_handed_to_owner(self):
+        attached = []
+
+        class Worker:
+            def attach(self, rtspSocket, data):
+                attached.append((rtspSocket, data))
+
+        session = self.routers[2].newSessionId()
+        self.routers[2].register(session, Worker())
+
+        listener = socket.create_server(("127.0.0.1", 0))
+        client = socket.create_connection(listener.getsockname())
+        conn, peer = listener.accept()
+        data = f"PLAY movie.Mjpeg RTSP/1.0\nCSeq: 2\nSession: {session}\n\n".encode()
+
+        self.routers[0].route(session, (conn, peer), data)
+        self.assertEqual(conn.fileno(), -1)
+        self.routers[2].receive()
+
+        (adopted, peerName), received = attached[0]
+        self.assertEqual(received, data)
+        self.assertEqual(peerName, client.getsockname())
+        adopted.sendall(b"RTSP/1.0 200 OK\n\n")
+        self.assertEqual(client.recv(64), b"RTSP/1.0 200 OK\n\n")
+
+        for sock in (adopted, client, listener):
+            sock.close()
+
+    def connect(self):
+        listener = socket.create_server(("127.0.0.1", 0))
+        client = socket.create_connection(listener.getsockname())
+        conn, peer = listener.accept()
+        listener.close()
+        self.addCleanup(client.close)
+        return client, (conn, peer)
+
+    def test_worker_routes_by_session(self):
+        attached = []
+
+        class Worker:
+            def attach(self, rtspSocket, data):
+                attached.append((rtspSocket, data))
+
+        session = self.routers[2].newSessionId()
+        self.routers[2].register(session, Worker())
+
+        client, rtspSocket = self.connect()
+        worker = PreforkWorker({"rtspSocket": rtspSocket}, self.routers[0])
+        data = f"PLAY movie.Mjpeg RTSP/1.0\nCSeq: 2\nSession: {session};timeout=60\n\n".encode()
+        # Held back until the first request is complete
+        worker.feedRtsp(data[:20])
+        self.assertFalse(worker.handedOff)
+        worker.feedRtsp(data[20:])
+        self.assertTrue(worker.handedOff)
+        self.assertEqual(rtspSocket[0].fileno(), -1)
+
+        self.routers[2].receive()
+        (adopted, peer), received = attached[0]
+        self.addCleanup(adopted.close)
+        self.assertEqual(received, data)
+        self.assertEqual(peer, client.getsockname())
+
+    def test_failed_hand_off_closes_connection(self):
+        client, rtspSocket = self.connect()
+        self.channels[2][1].close()
+        session = self.routers[2].newSessionId()
+        with self.assertRaises(OSError):
+            self.routers[0].route(session, rtspSocket, b"PLAY")
+        self.assertEqual(rtspSocket[0].fileno(), -1)
+
+    def test_attach_moves_interleaved_rtp(self):
+        client, rtspSocket = self.connect()
+        worker = PreforkWorker({"rtspSocket": rtspSocket, "interleaved": (0, 1)}, self.routers[0])
+        worker.openRtp()
+        newClient, newSocket = self.connect()
+        worker.attach(newSocket, b"")
+        self.assertIs(worker.clientInfo["rtpSender"].sock, newSocket[0])
+
+        worker.clientInfo["rtpSender"].send([[b"frame"]])
+        newClient.settimeout(2)
+        self.assertEqual(newClient.recv(64), frame_bytes(0, b"frame"))
+        rtspSocket[0].close()
+        newClient.close()
+
+    def test_unknown_session_gets_new_worker(self):
+        workers = []
+
+        class Worker:
+            def __init__(self, clientInfo):
+                self.clientInfo = clientInfo
+                self.fed = []
+                self.running = False
+                workers.append(self)
+
+            def run(self):
+                self.running = True
+
+            def feedRtsp(self, data):
+                self.fed.append(data)
+
+        router = SessionRouter(1, self.channels, Worker)
+        session = router.newSessionId()
+        client, rtspSocket = self.connect()
+        self.addCleanup(rtspSocket[0].close)
+        worker = PreforkWorker({"rtspSocket": rtspSocket}, router)
+        data = f"PLAY movie.Mjpeg RTSP/1.0\nCSeq: 2\nSession: {session}\n\n".encode()
+        worker.feedRtsp(data)
+
+        # Owned here but not registered: a new worker answers it
+        (created,) = workers
+        self.assertIs(created.clientInfo["rtspSocket"], rtspSocket)
+        self.assertTrue(created.routed)
+        self.assertTrue(created.running)
+        self.assertEqual(created.fed, [data])
+
+
+class TestInterleaved(unittest.TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def test_parse_channels(self):
+        self.assertEqual(parseChannels("RTP/AVP/TCP;unicast;interleaved=2-3"), (2, 3))
+        self.assertEqual(parseChannels("RTP/AVP/TCP;interleaved=4"), (4, 5))
+        self.assertIsNone(parseChannels("RTP/UDP; client_port= 25000"))
+
+    def test_frame_sent_in_one_call(self):
+        sender = InterleavedSender(self.server, threading.Lock())
+        packets = [[b"head", b"er1"], [memoryview(b"header2")]]
+
+        self.assertTrue(sender.send(packets))
+        self.assertEqual(sender.calls, 1)
+        self.client.settimeout(1)
+        data = b""
+        while len(data) < 2 * 4 + 14:
+            data += self.client.recv(64)
+        self.assertEqual(
+            RtspParser(RtspResponse).feed(data),
+            [InterleavedFrame(0, b"header1"), InterleavedFrame(0, b"header2")],
+        )
+
+    def test_frame_skipped_when_connection_full(self):
+        sender = InterleavedSender(self.server, threading.Lock())
+        self.server.setblocking(False)
+        try:
+            while True:
+                self.server.send(b"\0" * 65536)
+        except BlockingIOError:
+            pass
+
+        self.assertFalse(sender.send([[b"frame"]]))
+        self.assertEqual(sender.dropped, 1)
+
+    def test_rest_of_partly_sent_frame_is_kept(self):
+        sender = InterleavedSender(self.server, threading.Lock())
+        packets = [[bytes([n]) * 60000] for n in range(64)]
+
+        # The connection takes only part of the frame, without waiting
+        self.assertTrue(sender.send(packets))
+        self.assertTrue(sender.pending)
+        # No other frame starts until this one is out
+        self.assertFalse(sender.send([[b"next"]]))
+        self.assertEqual(sender.dropped, 1)
+
+        # A reply waits for the rest of the frame, with the client reading
+        reply = b"RTSP/1.0 200 OK\nCSeq: 2\n\n"
+        thread = threading.Thread(target=sender.sendMessage, args=(reply,))
+        thread.start()
+        self.client.settimeout(2)
+        data = b""
+        while not data.endswith(reply):
+            data += self.client.recv(1 << 16)
+        thread.join()
+
+        received = RtspParser(RtspResponse).feed(data)
+        self.assertEqual(received[:-1], [InterleavedFrame(0, p[0]) for p in packets])
+        self.assertEqual(received[-1].status(), RtspStatus.OK)
+        self.assertEqual(sender.pending, [])
+
+    def test_partly_sent_frame_keeps_its_headers(self):
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sender = InterleavedSender(self.server, threading.Lock())
+        encoder = RtpEncoder(2, 0, 0, 0, 26, 99999)
+
+        def frame_packets(count, seqnum, timestamp):
+            headers = encoder.encodeFrame(count, seqnum, timestamp)
+            return [[header, bytes([seqnum % 256]) * 1000] for header in headers]
+
+        self.assertTrue(sender.send(frame_packets(200, 100, 1000)))
+        self.assertTrue(sender.pending)
+        # Encoding the next frame reuses the header buffer
+        second = frame_packets(200, 300, 2000)
+
+        received = bytearray()
+        total = 400 * (4 + 12 + 1000)
+
+        def read():
+            while len(received) < total:
+                received.extend(self.client.recv(1 << 16))
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        deadline = time.monotonic() + 2
+        while not sender.send(second):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+        sender.sendMessage(b"")
+        reader.join(2)
+
+        frames = RtspParser(RtspResponse).feed(bytes(received))
+        headers = [RTP_HEADER.unpack_from(frame.payload)[2:4] for frame in frames]
+        self.assertEqual(
+            headers,
+            [(seqnum, 1000) for seqnum in range(100, 300)]
+            + [(seqnum, 2000) for seqnum in range(300, 500)],
+        )
+
+    def test_frame_skipped_while_connection_in_use(self):
+        lock = threading.Lock()
+        sender = InterleavedSender(self.server, lock)
+        with lock:
+            self.assertFalse(sender.send([[b"frame"]]))
+        self.assertEqual(sender.dropped, 1)
+        self.assertEqual(sender.calls, 0)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_and_labels(self):
+        registry = Registry()
+        counter = registry.counter("requests_total", "Requests", ("method",))
+        counter.inc(labels=("PLAY",))
+        counter.inc(2, ("PLAY",))
+        counter.inc(labels=('SAY "HI"',))
+
+        text = registry.render()
+        self.assertIn("# TYPE requests_total counter\n", text)
+        self.assertIn('requests_total{method="PLAY"} 3\n', text)
+        self.assertIn('requests_total{method="SAY \\"HI\\""} 1\n', text)
+        self.assertIs(registry.counter("requests_total", "Requests"), counter)
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = Registry()
+        histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        lines = registry.render().splitlines()
+        self.assertIn('latency_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 3', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn("latency_seconds_sum 2.65", lines)
+        self.assertIn("latency_seconds_count 4", lines)
+
+    def test_gauges_read_when_scraped(self):
+        registry = Registry()
+        state = {"a": 1}
+        registry.gauge(
+            "sessions", "Sessions", lambda: {(k,): v for k, v in state.items()}, ("state",)
+        )
+        registry.gauge("missing", "Not there yet", lambda: None)
+
+        state["a"] = 5
+        text = registry.render()
+        self.assertIn('sessions{state="a"} 5', text)
+        self.assertNotIn("\nmissing ", text)
+
+    def test_scrape_endpoint(self):
+        registry = Registry()
+        registry.counter("frames_total", "Frames").inc(7)
+        server = MetricsServer(0, registry).start()
+        try:
+            url = f"http://127.0.0.1:{server.port()}/metrics"
+            with urllib.request.urlopen(url, timeout=2) as response:
+                self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+                self.assertIn(b"frames_total 7", response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_session_metrics(self):
+        worker = CapturingWorker(1, 0)
+        worker.clientInfo["session"] = 123456
+        worker.state = worker.PLAYING
+        worker.countSent(0, 3, 4000)
+        self.assertGreaterEqual(ServerWorkerModule.sessionStates()[("playing",)], 1)
+
+        # Timed by method, even when the state machine ignores it
+        latency = ServerWorkerModule.RTSP_SECONDS
+        before = latency.count(("PAUSE",))
+        worker.state = worker.READY
+        request = RtspRequest(RtspMethod.PAUSE, "movie.Mjpeg")
+        request.set_header("CSeq", 2)
+        worker.processRtspRequest(request)
+        self.assertEqual(latency.count(("PAUSE",)), before + 1)
+
+        packets = ServerWorkerModule.sessionValues(lambda info: info.get("rtpPackets", 0))
+        self.assertEqual(packets[(123456,)], 3)
+
+    def test_quality_gauges_skip_sessions_without_reports(self):
+        worker = CapturingWorker(1, 0)
+        worker.clientInfo["session"] = 234567
+        jitter = ServerWorkerModule.qualityValue("jitter")
+        self.assertNotIn((234567,), ServerWorkerModule.sessionValues(jitter))
+        text = Registry.shared().render()
+        self.assertNotIn('rtp_session_jitter_seconds{session="234567"}', text)
+        self.assertNotIn('rtp_session_fraction_lost{session="234567"}', text)
+
+        worker.clientInfo["quality"] = SessionQuality()
+        self.assertEqual(ServerWorkerModule.sessionValues(jitter)[(234567,)], 0.0)
+
+    def setup(self, worker, path, transport):
+        request = RtspRequest(RtspMethod.SETUP, path)
+        request.set_header("CSeq", 1)
+        if transport is not None:
+            request.set_header("Transport", transport)
+        worker.processRtspRequest(request)
+        return worker.replies[-1].status()
+
+    def test_failed_setup_leaves_no_session(self):
+        path = write_test_video([bytes([1]) * 100])
+        self.addCleanup(os.remove, path)
+        for transport, status in (
+            (None, RtspStatus.BAD_REQUEST),
+            ("RTP/UDP;unicast", RtspStatus.UNSUPPORTED_TRANSPORT),
+            ("RTP/UDP; client_port= rtp", RtspStatus.UNSUPPORTED_TRANSPORT),
+            ("RTP/AVP/TCP;interleaved=a-b", RtspStatus.UNSUPPORTED_TRANSPORT),
+        ):
+            worker = ParameterWorker("127.0.0.1")
+            self.assertEqual(self.setup(worker, path, transport), status)
+
+            self.assertEqual(worker.state, worker.INIT)
+            self.assertNotIn("session", worker.clientInfo)
+            self.assertNotIn("quality", worker.clientInfo)
+            self.assertNotIn(os.path.realpath(path), FrameStore._stores)
+        ServerWorkerModule.sessionValues(ServerWorkerModule.qualityValue("fractionLost"))
+
+    def test_setup_releases_video_when_rtp_fails(self):
+        path = write_test_video([bytes([1]) * 100])
+        self.addCleanup(os.remove, path)
+
+        self.addCleanup(
+            lambda: os.path.exists(FrameIndex.index_path(path))
+            and os.remove(FrameIndex.index_path(path))
+        )
+
+        class NoPortWorker(ParameterWorker):
+            def openRtp(self):
+                raise OSError("no ports left")
+
+        worker = NoPortWorker("127.0.0.1")
+        self.assertEqual(
+            self.setup(worker, path, "RTP/UDP; client_port= 25000"), RtspStatus.NOT_FOUND
+        )
+        self.assertNotIn("videoStream", worker.clientInfo)
+        self.assertNotIn(os.path.realpath(path), FrameStore._stores)
+
+
+class ParameterWorker(ServerWorker):
+    """A ServerWorker that keeps its RTSP replies."""
+
+    def __init__(self, peer):
+        super().__init__({"rtspSocket": (None, (peer, 40000))})
+        self.replies = []
+
+    def sendRtsp(self, data):
+        self.replies.append(RtspParser(RtspResponse).feed(bytes(data))[0])
+
+    def setParameter(self, body):
+        request = RtspRequest(RtspMethod.SET_PARAMETER, "*")
+        request.set_header("CSeq", len(self.replies) + 1)
+        request.body = body
+        (request,) = RtspParser(RtspRequest).feed(request.encode().encode("latin-1"))
+        self.processRtspRequest(request)
+        return self.replies[-1].status()
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.profiler = Profiler(self.dir, rate=500)
+
+    def tearDown(self):
+        self.profiler.stop()
+        for name in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def test_spans_only_while_profiling(self):
+        feed = RtspParser.feed
+        before = SPAN_SECONDS.count(("parse",))
+
+        self.profiler.start()
+        self.assertIsNot(RtspParser.feed, feed)
+        RtspParser(RtspRequest).feed(b"PLAY a RTSP/1.0\nCSeq: 1\n\n")
+        self.assertEqual(SPAN_SECONDS.count(("parse",)), before + 1)
+
+        path = self.profiler.stop()
+        self.assertIs(RtspParser.feed, feed)
+        RtspParser(RtspRequest).feed(b"PLAY a RTSP/1.0\nCSeq: 1\n\n")
+        self.assertEqual(SPAN_SECONDS.count(("parse",)), before + 1)
+        self.assertTrue(path.endswith(".folded"))
+
+    def test_collapsed_stacks(self):
+        done = threading.Event()
+
+        def busy():
+            while not done.is_set():
+                sum(range(1000))
+
+        worker = threading.Thread(target=busy, name="busy")
+        worker.start()
+        sampler = StackSampler(rate=500)
+        sampler.start()
+        time.sleep(0.1)
+        sampler.stop()
+        done.set()
+        worker.join()
+
+        path = os.path.join(self.dir, "stacks.folded")
+        sampler.write(path)
+        with open(path) as file:
+            lines = file.read().splitlines()
+        busy_lines = [line for line in lines if line.startswith("busy;")]
+        self.assertTrue(busy_lines)
+        stack, count = busy_lines[0].rsplit(" ", 1)
+        self.assertIn("busy (tests.py:", stack)
+        self.assertGreater(int(count), 0)
+        self.assertGreater(sampler.samples, 0)
+
+    def test_set_parameter(self):
+        local = ParameterWorker("127.0.0.1")
+        remote = ParameterWorker("192.0.2.1")
+        profiler = Profiler.shared()
+
+        self.assertEqual(local.setParameter(b""), RtspStatus.OK)
+        self.assertEqual(remote.setParameter(b"profiling: on\r\n"), RtspStatus.FORBIDDEN)
+        self.assertFalse(profiler.enabled())
+        self.assertEqual(
+            local.setParameter(b"volume: 11\r\n"), RtspStatus.PARAMETER_NOT_UNDERSTOOD
+        )
+
+        profiler.sampling = False
+        try:
+            self.assertEqual(local.setParameter(b"profiling: on\r\n"), RtspStatus.OK)
+            local.profilerThread.join()
+            self.assertTrue(profiler.enabled())
+            self.assertEqual(local.setParameter(b"profiling: off\r\n"), RtspStatus.OK)
+            local.profilerThread.join()
+            self.assertFalse(profiler.enabled())
+        finally:
+            profiler.stop()
+            profiler.sampling = True
+
+
+class PortRtcpChannel(RtcpChannel):
+    def port(self):
+        return 5001
+
+
+class TestSessionRegistry(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.registry = SessionRegistry(timeout=60, clock=self.clock)
+        self.client, server = socket.socketpair()
+        self.client.settimeout(2)
+        self.worker = ServerWorker(
+            {"rtspSocket": (server, ("127.0.0.1", 40000))},
+            rtcpChannel=PortRtcpChannel(),
+            registry=self.registry,
+        )
+        self.path = write_test_video([b"frame"] * 5)
+
+    def tearDown(self):
+        self.worker.expire()
+        self.client.close()
+        for path in (self.path, FrameIndex.index_path(self.path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def request(self, text):
+        self.worker.feedRtsp(text.encode())
+        return RtspParser(RtspResponse).feed(self.client.recv(4096))[0]
+
+    def setup(self):
+        return self.request(
+            f"SETUP {self.path} RTSP/1.0\nCSeq: 1\nTransport: RTP/UDP; client_port= 5000-5001\n\n"
+        )
+
+    def test_eof_ends_thread(self):
+        self.client.close()
+        thread = threading.Thread(target=self.worker.recvRtspRequest)
+        thread.start()
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.registry.sessions(), [])
+
+    def test_keepalives(self):
+        self.clock.now += 50
+        reply = self.request("OPTIONS * RTSP/1.0\nCSeq: 1\n\n")
+        self.assertEqual(reply.status(), RtspStatus.OK)
+        self.assertIn("GET_PARAMETER", reply.get_header("Public"))
+
+        self.clock.now += 50
+        reply = self.request("GET_PARAMETER * RTSP/1.0\nCSeq: 2\n\n")
+        self.assertEqual(reply.status(), RtspStatus.OK)
+        self.assertEqual(self.registry.reap(), 0)
+
+    def test_idle_session_reaped(self):
+        reply = self.setup()
+        session, timeout = parseSession(reply.get_header("Session"))
+        self.assertEqual(timeout, 60)
+        store = self.worker.clientInfo["videoStream"].store
+        rtpSocket = self.worker.clientInfo["rtpSocket"]
+
+        self.clock.now += 61
+        self.assertEqual(self.registry.reap(), 1)
+        self.assertEqual(self.registry.sessions(), [])
+        self.assertNotIn("videoStream", self.worker.clientInfo)
+        self.assertEqual(store.refs, 0)
+        self.assertEqual(rtpSocket.fileno(), -1)
+        # The connection is closed too, ending its thread
+        self.assertEqual(self.client.recv(4096), b"")
+
+    def test_session_ends_with_connection(self):
+        self.setup()
+        rtpSocket = self.worker.clientInfo["rtpSocket"]
+        self.client.close()
+        self.worker.recvRtspRequest()
+        self.assertEqual(self.registry.sessions(), [])
+        self.assertNotIn("videoStream", self.worker.clientInfo)
+        self.assertEqual(rtpSocket.fileno(), -1)
+
+    def test_udp_session_outlives_connection(self):
+        # Where a new connection can take over, as in the prefork server
+        self.worker.REATTACHABLE = True
+        self.setup()
+        self.client.close()
+        self.worker.recvRtspRequest()
+        self.assertEqual(self.registry.sessions(), [self.worker])
+        self.assertIn("videoStream", self.worker.clientInfo)
+
+        self.clock.now += 61
+        self.assertEqual(self.registry.reap(), 1)
+        self.assertNotIn("videoStream", self.worker.clientInfo)
+
+
+class TestLoadGenerator(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([3, 1, 2], 0), 1)
+        self.assertEqual(percentile([], 50), 0.0)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_compare_by_direction(self):
+        baseline = {
+            "rtp": {"packet_encode_per_sec": 1000.0, "packets_per_frame": 44},
+            "loopback": {"rtsp_latency_ms_p50": 2.0, "packet_loss_pct": 0.0},
+        }
+        current = {
+            "rtp": {"packet_encode_per_sec": 850.0, "packets_per_frame": 10},
+            "loopback": {"rtsp_latency_ms_p50": 1.0, "packet_loss_pct": 3.0},
+        }
+
+        rows = {row[0]: row[3:] for row in benchmarks.compare(baseline, current, 0.1)}
+        self.assertEqual(
+            set(rows), {"rtp.packet_encode_per_sec", "loopback.rtsp_latency_ms_p50"}
+        )
+        self.assertAlmostEqual(rows["rtp.packet_encode_per_sec"][0], -0.15)
+        self.assertTrue(rows["rtp.packet_encode_per_sec"][1])
+        self.assertAlmostEqual(rows["loopback.rtsp_latency_ms_p50"][0], 0.5)
+        self.assertFalse(rows["loopback.rtsp_latency_ms_p50"][1])
+
+    def test_compare_command_fails_on_regression(self):
+        paths = []
+        for results in ({"b": {"x_per_sec": 100.0}}, {"b": {"x_per_sec": 95.0}}):
+            fd, path = tempfile.mkstemp(suffix=".json")
+            os.close(fd)
+            benchmarks.save(path, results)
+            paths.append(path)
+
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(benchmarks.main(["compare", *paths]), 0)
+                self.assertEqual(benchmarks.main(["compare", *paths, "-t", "0.01"]), 1)
+        finally:
+            for path in paths:
+                os.remove(path)
+
+
+class FullSocket:
+    """A non-blocking socket with room for `room` more datagrams."""
+
+    def __init__(self, room):
+        self.room = room
+        self.datagrams = []
+
+    def sendmsg(self, buffers, ancdata, flags, address):
+        if not self.room:
+            raise BlockingIOError
+        self.room -= 1
+        self.datagrams.append(b"".join(buffers))
+
+
+class QueueingTransport:
+    """A datagram transport that keeps what it's given."""
+
+    def __init__(self):
+        self.queued = []
+
+    def get_write_buffer_size(self):
+        return sum(len(data) for data in self.queued)
+
+    def sendto(self, data, address):
+        self.queued.append(bytes(data))
+
+
+class TestLoopRtpSender(unittest.TestCase):
+    def setUp(self):
+        self.sock = FullSocket(2)
+        self.rtp = LoopRtpSender()
+        self.rtp.transport = QueueingTransport()
+        self.rtp.sender = BatchSender(self.sock, False)
+
+    def test_rest_of_frame_queued_when_kernel_full(self):
+        header = bytearray(b"h1")
+        self.rtp.send([[header, b"a"], [header, b"b"], [header, b"c"]], ("127.0.0.1", 5004))
+        # Later frames queue behind it, copied from their buffers
+        self.rtp.send([[header, b"d"]], ("127.0.0.1", 5004))
+        header[:] = b"h2"
+
+        self.assertEqual(self.sock.datagrams, [b"h1a", b"h1b"])
+        self.assertEqual(self.rtp.transport.queued, [b"h1c", b"h1d"])
+
+    def test_frames_skipped_when_queue_full(self):
+        self.sock.room = 0
+        self.rtp.transport.queued.append(bytes(MAX_WRITE_BUFFER + 1))
+        self.rtp.send([[b"frame"]], ("127.0.0.1", 5004))
+
+        self.assertEqual(self.rtp.dropped, 1)
+        self.assertEqual(len(self.rtp.transport.queued), 1)
+
+
+    def test_interleaved_frames_copied(self):
+        class Transport:
+            written = []
+
+            def get_write_buffer_size(self):
+                return 0
+
+            def write(self, data):
+                self.written.append(data)
+
+        worker = AsyncServerWorker(
+            {"rtspSocket": (None, ("127.0.0.1", 40000)), "interleaved": (0, 1)},
+            Transport(),
+            self.rtp,
+            None,
+            None,
+        )
+        header = bytearray(b"h1")
+        worker.sendPackets([[header, b"a"]])
+        header[:] = b"h2"
+
+        self.assertEqual(Transport.written, [frame_bytes(0, b"h1a")])
+
+
+class TestAsyncServer(unittest.TestCase):
+    FRAMES = [bytes([i]) * 3000 for i in range(5)]
+
+    def setUp(self):
+        self.path = write_test_video(self.FRAMES)
+
+    def tearDown(self):
+        for path in (self.path, FrameIndex.index_path(self.path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def stream_frames(self, count):
+        loop = asyncio.get_running_loop()
+        packets = asyncio.Queue()
+
+        class Receiver(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                packets.put_nowait(data)
+
+        client_rtp, _ = await loop.create_datagram_endpoint(
+            Receiver, local_addr=("127.0.0.1", 0)
+        )
+        _, server_rtp = await loop.create_datagram_endpoint(
+            LoopRtpSender, local_addr=("127.0.0.1", 0)
+        )
+        _, rtcp = await loop.create_datagram_endpoint(
+            LoopRtcpChannel, local_addr=("127.0.0.1", 0)
+        )
+        scheduler = LoopFrameScheduler(loop)
+        server = await loop.create_server(
+            lambda: RtspProtocol(server_rtp, scheduler, rtcp), "127.0.0.1", 0
+        )
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", server.sockets[0].getsockname()[1]
+        )
+
+        rtp_port = client_rtp.get_extra_info("sockname")[1]
+        writer.write(
+            f"SETUP {self.path} RTSP/1.0\nCSeq: 1\nTransport: RTP/UDP; client_port= {rtp_port}\n\n".encode()
+        )
+        setup_reply = RtspResponse.decode((await reader.read(1024)).decode())
+        session = setup_reply.get_header("Session")
+
+        writer.write(f"PLAY {self.path} RTSP/1.0\nCSeq: 2\nSession: {session}\n\n".encode())
+        play_reply = RtspResponse.decode((await reader.read(1024)).decode())
+
+        reassembler = FrameReassembler()
+        frames = []
+        while len(frames) < count:
+            packet = RtpPacket()
+            packet.decode(await asyncio.wait_for(packets.get(), 2))
+            frame = reassembler.add(packet)
+            if frame:
+                frames.append(frame)
+
+        # A receiver report reaches the session's quality record
+        ssrc = packet.ssrc()
+        session = rtcp.sessions[ssrc]
+        report = RtcpPacket.receiverReport(1, [ReportBlock(ssrc, 0, 0, 0, 0, 0, 0)])
+        rtcp.transport.sendto(report.encode(), ("127.0.0.1", rtcp.port()))
+        while session.clientInfo["quality"].reports == 0:
+            await asyncio.sleep(0.01)
+
+        writer.write(f"TEARDOWN {self.path} RTSP/1.0\nCSeq: 3\nSession: {session}\n\n".encode())
+        await reader.read(1024)
+        writer.close()
+        server.close()
+        client_rtp.close()
+        server_rtp.transport.close()
+        rtcp.transport.close()
+        self.assertNotIn(ssrc, rtcp.sessions)
+
+        return setup_reply, play_reply, frames
+
+    async def stream_interleaved(self, count):
+        loop = asyncio.get_running_loop()
+        _, server_rtp = await loop.create_datagram_endpoint(
+            LoopRtpSender, local_addr=("127.0.0.1", 0)
+        )
+        _, rtcp = await loop.create_datagram_endpoint(
+            LoopRtcpChannel, local_addr=("127.0.0.1", 0)
+        )
+        scheduler = LoopFrameScheduler(loop)
+        protocols = []
+
+        def protocol():
+            protocols.append(RtspProtocol(server_rtp, scheduler, rtcp))
+            return protocols[-1]
+
+        server = await loop.create_server(protocol, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", server.sockets[0].getsockname()[1]
+        )
+        parser = RtspParser(RtspResponse)
+
+        async def messages():
+            while True:
+                for message in parser.feed(await asyncio.wait_for(reader.read(65536), 2)):
+                    yield message
+
+        incoming = messages()
+        writer.write(
+            f"SETUP {self.path} RTSP/1.0\nCSeq: 1\n"
+            "Transport: RTP/AVP/TCP;unicast;interleaved=0-1\n\n".encode()
+        )
+        setup_reply = await incoming.__anext__()
+        session = setup_reply.get_header("Session")
+        writer.write(f"PLAY {self.path} RTSP/1.0\nCSeq: 2\nSession: {session}\n\n".encode())
+        play_reply = await incoming.__anext__()
+
+        reassembler = FrameReassembler()
+        frames = []
+        async for message in incoming:
+            if message.channel != 0:
+                continue
+            packet = RtpPacket()
+            packet.decode(message.payload)
+            frame = reassembler.add(packet)
+            if frame:
+                frames.append(frame)
+                if len(frames) == count:
+                    break
+
+        # Receiver reports come back on the RTCP channel
+        quality = protocols[0].worker.clientInfo["quality"]
+        report = RtcpPacket.receiverReport(1, [ReportBlock(packet.ssrc(), 0, 0, 0, 0, 0, 0)])
+        writer.write(frame_bytes(1, report.encode()))
+        while quality.reports == 0:
+            await asyncio.sleep(0.01)
+
+        writer.write(f"TEARDOWN {self.path} RTSP/1.0\nCSeq: 3\nSession: {session}\n\n".encode())
+        writer.close()
+        server.close()
+        server_rtp.transport.close()
+        rtcp.transport.close()
+        return setup_reply, play_reply, frames
+
+    def test_interleaved(self):
+        setup_reply, play_reply, frames = asyncio.run(self.stream_interleaved(3))
+
+        self.assertEqual(setup_reply.status(), RtspStatus.OK)
+        self.assertIn("interleaved=0-1", setup_reply.get_header("Transport"))
+        self.assertEqual(play_reply.status(), RtspStatus.OK)
+        self.assertEqual(frames, self.FRAMES[:3])
+
+    def test_setup_play_teardown(self):
+        setup_reply, play_reply, frames = asyncio.run(self.stream_frames(3))
+
+        self.assertEqual(setup_reply.status(), RtspStatus.OK)
+        self.assertIn("server_port=", setup_reply.get_header("Transport"))
+        self.assertEqual(play_reply.get_header("CSeq"), "2")
+        self.assertEqual(frames, self.FRAMES[:3])
+
+
+def jpeg_bytes(size):
+    data = io.BytesIO()
+    Image.new("RGB", size, (200, 30, 30)).save(data, "JPEG")
+    return data.getvalue()
+
+
+@unittest.skipUnless(FrameDecoder, "Pillow is not installed")
+class TestFrameDecoder(unittest.TestCase):
+    def run_decoder(self, decoder, frames):
+        for frameNbr, data in enumerate(frames, 1):
+            decoder.submit(frameNbr, data)
+        # Done callbacks run on the pool's threads before they exit
+        decoder.executor.shutdown(wait=True)
+
+    def test_handed_on_in_order(self):
+        delays = {b"1": 0.2, b"2": 0.0, b"3": 0.1}
+        done = []
+
+        class SlowDecoder(FrameDecoder.FrameDecoder):
+            def decode(self, data):
+                time.sleep(delays[data])
+                done.append(data)
+                return data
+
+        images = []
+        self.run_decoder(SlowDecoder(images.append, workers=3), [b"1", b"2", b"3"])
+        self.assertEqual(done, [b"2", b"3", b"1"])
+        self.assertEqual(images, [b"1", b"2", b"3"])
+
+    def test_decoded_within_size(self):
+        data = jpeg_bytes((1024, 576))
+        self.assertEqual(FrameDecoder.decode(data).size, (1024, 576))
+        # Drafted at half scale
+        self.assertEqual(FrameDecoder.decode(data, (512, 288)).size, (512, 288))
+        # Drafted at half scale, then thumbnailed the rest of the way
+        image = FrameDecoder.decode(data, (300, 300))
+        self.assertLessEqual(image.width, 300)
+        self.assertLessEqual(image.height, 300)
+
+    def test_failed_frames_counted(self):
+        class BrokenDecoder(FrameDecoder.FrameDecoder):
+            def decode(self, data):
+                if data == b"broken":
+                    raise ValueError("broken frame")
+                return super().decode(data)
+
+        images = []
+        decoder = BrokenDecoder(images.append, size=(64, 64))
+        self.run_decoder(decoder, [b"not a jpeg", b"broken", jpeg_bytes((128, 128))])
+        self.assertEqual(decoder.stats.failed, 2)
+        self.assertEqual(decoder.stats.frames, 1)
+        self.assertEqual([image.size for image in images], [(64, 64)])
+
+
+class FakeMaster:
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, ms, callback):
+        self.scheduled.append(callback)
+
+
+@unittest.skipUnless(ClientModule, "Pillow is not installed")
+class TestClientPlayout(unittest.TestCase):
+    def make_client(self):
+        class QuietClient(ClientModule.Client):
+            """A client without the window or the RTSP connection."""
+
+            def __init__(self):
+                self.master = FakeMaster()
+                self.frameNbr = 0
+                self.playThread = None
+                self.jitterBuffer = JitterBuffer(latency=0)
+                self.frameQueue = queue.Queue(ClientModule.FRAME_QUEUE_SIZE)
+                self.staleFrames = 0
+                self.decoder = None
+                self.overlay = None
+                self.refreshMs = 1
+                self.interleaved = True
+                self.state = self.READY
+                self.teardownAcked = 0
+                self.playEvent = threading.Event()
+                self.shown = []
+
+            def sendRtspRequest(self, requestCode):
+                # Act on the reply straight away
+                if requestCode == self.PLAY:
+                    self.state = self.PLAYING
+                elif requestCode == self.PAUSE:
+                    self.state = self.READY
+                    self.playEvent.set()
+
+            def updateMovie(self, image):
+                self.shown.append((image, threading.current_thread()))
+
+        client = QuietClient()
+
+        def stop():
+            client.teardownAcked = 1
+            client.jitterBuffer.reset()
+            if client.playThread is not None:
+                client.playThread.join()
+
+        self.addCleanup(stop)
+        return client
+
+    def test_decoded_off_the_tk_thread(self):
+        client = self.make_client()
+        decodedOn = []
+
+        class PassDecoder(FrameDecoder.FrameDecoder):
+            def decode(self, data):
+                decodedOn.append(threading.current_thread())
+                return data
+
+        client.decoder = PassDecoder(client.queueFrame, workers=1)
+        for frameNbr in range(1, 6):
+            client.decoder.submit(frameNbr, str(frameNbr).encode())
+        client.decoder.executor.shutdown(wait=True)
+        client.renderFrame()
+
+        self.assertEqual(len(decodedOn), 5)
+        self.assertNotIn(threading.current_thread(), decodedOn)
+        # Shown on the thread running the render loop, the newest frame only
+        self.assertEqual(client.shown, [(b"5", threading.current_thread())])
+        self.assertEqual(client.staleFrames, 4)
+        self.assertEqual(client.master.scheduled, [client.renderFrame])
+
+    def test_stale_frames_dropped(self):
+        client = self.make_client()
+        for image in (b"1", b"2", b"3"):
+            client.queueFrame(image)
+        # The queue holds two, the oldest makes way
+        self.assertEqual(client.staleFrames, 1)
+
+        client.renderFrame()
+        client.renderFrame()
+        client.queueFrame(b"4")
+        client.renderFrame()
+
+        self.assertEqual([image for image, _ in client.shown], [b"3", b"4"])
+        self.assertEqual(client.staleFrames, 2)
+
+    def test_resume_waits_for_last_play_thread(self):
+        client = self.make_client()
+        client.playMovie()
+        first = client.playThread
+        client.pauseMovie()
+
+        start = time.monotonic()
+        client.playMovie()
+        # Woken rather than left to time out its wait
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertFalse(first.is_alive())
+        self.assertIsNot(client.playThread, first)
+        self.assertTrue(client.playThread.is_alive())
+
+
 if __name__ == "__main__":
     unittest.main()